@@ -17,6 +17,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from telegram_bot import run_bot_webhook_set
 from utilities.history_messages import set_user_active_session, set_user_bot_mode
+from utilities.prompt_registry import install_reload_signal
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -342,6 +343,8 @@ def main():
     logging.info(f"[Main] BUILD_TAG={os.getenv('BUILD_TAG', 'unknown')}")
     _align_port_with_codespaces_webhook()
     _reset_test_user_session_if_configured()
+    # Example: edit instructions_general.txt, then `kill -HUP <pid>` to drop cached prompts immediately.
+    install_reload_signal()
 
     setup_port_forwarding()
     child_services: list[subprocess.Popen] = []
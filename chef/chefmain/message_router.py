@@ -1,10 +1,12 @@
+import asyncio
 import json
 import os
 import sys
 import logging
-import requests
 import time
 import importlib.util
+
+import httpx
 try:
     from dotenv import load_dotenv
     # Load default .env
@@ -24,8 +26,17 @@ if base_dir not in sys.path:
     sys.path.insert(0, base_dir)
 if parent_dir not in sys.path:
     sys.path.append(parent_dir)
-from message_user import process_message_object
-from utilities.history_messages import message_history_process, archive_message_history
+from message_user import process_message_object_async
+from utilities import cancellation, resilience, tool_engine
+from utilities.context_window import build_context
+from utilities.history_messages import (
+    message_history_process,
+    schedule_context_summary,
+    update_session_system_prompt,
+)
+from utilities.http_clients import get_async_client, run_sync
+from utilities.stream_protocol import DeltaEmitter
+from utilities.prompt_registry import get_compiled_prompt, register_prompt
 
 _bot_config_module = None
 
@@ -60,6 +71,81 @@ def _get_bot_instructions_path(bot_mode: str | None) -> str:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Provider prompt caching: payloads keep a byte-identical prefix across turns (static instructions,
+# then stored history); per-turn context goes last. Usage blocks report how much of it was cached.
+# Example: {"general": {"calls": 40, "prompt_tokens": 52000, "cached_tokens": 41000,
+#           "cache_hit_ratio": 0.79, "ttft_ms_cached": 310, "ttft_ms_uncached": 820}}
+_prompt_cache_stats = {}
+
+
+def _cached_prompt_tokens(usage: dict) -> int:
+    # xAI reports prompt_tokens_details.cached_tokens; older responses used cached_prompt_text_tokens.
+    details = usage.get("prompt_tokens_details") or {}
+    return int(details.get("cached_tokens") or usage.get("cached_prompt_text_tokens") or 0)
+
+
+def _record_prompt_usage(bot_mode, usage, ttft_ms=None) -> dict | None:
+    if not isinstance(usage, dict):
+        return None
+    prompt_tokens = int(usage.get("prompt_tokens") or 0)
+    cached_tokens = _cached_prompt_tokens(usage)
+    stats = _prompt_cache_stats.setdefault(
+        bot_mode or "default",
+        {
+            "calls": 0,
+            "prompt_tokens": 0,
+            "cached_tokens": 0,
+            "cached_calls": 0,
+            "ttft_ms_cached_total": 0,
+            "ttft_cached_samples": 0,
+            "ttft_ms_uncached_total": 0,
+            "ttft_uncached_samples": 0,
+        },
+    )
+    stats["calls"] += 1
+    stats["prompt_tokens"] += prompt_tokens
+    stats["cached_tokens"] += cached_tokens
+    if cached_tokens:
+        stats["cached_calls"] += 1
+    if ttft_ms is not None:
+        bucket = "cached" if cached_tokens else "uncached"
+        stats[f"ttft_ms_{bucket}_total"] += ttft_ms
+        stats[f"ttft_{bucket}_samples"] += 1
+    logging.info(
+        "xai_usage: bot_mode=%s, prompt_tokens=%s, cached_tokens=%s, completion_tokens=%s, ttft_ms=%s",
+        bot_mode,
+        prompt_tokens,
+        cached_tokens,
+        usage.get("completion_tokens"),
+        ttft_ms,
+    )
+    return {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens}
+
+
+def prompt_cache_stats() -> dict:
+    """Per-mode cached-token totals, hit ratio and mean TTFT split by cache hit/miss."""
+    report = {}
+    for mode, stats in _prompt_cache_stats.items():
+        prompt_tokens = stats["prompt_tokens"]
+        report[mode] = {
+            "calls": stats["calls"],
+            "cached_calls": stats["cached_calls"],
+            "prompt_tokens": prompt_tokens,
+            "cached_tokens": stats["cached_tokens"],
+            "cache_hit_ratio": round(stats["cached_tokens"] / prompt_tokens, 3) if prompt_tokens else None,
+            "ttft_ms_cached": (
+                int(stats["ttft_ms_cached_total"] / stats["ttft_cached_samples"])
+                if stats["ttft_cached_samples"]
+                else None
+            ),
+            "ttft_ms_uncached": (
+                int(stats["ttft_ms_uncached_total"] / stats["ttft_uncached_samples"])
+                if stats["ttft_uncached_samples"]
+                else None
+            ),
+        }
+    return report
+
 
 class MessageRouter:
     def __init__(self, openai_api_key=None):
@@ -83,8 +169,8 @@ class MessageRouter:
         )
 
         # Before: instructions pulled from a helper and combined elsewhere.
-        # After example: paste paths below and the function will join them in order.
-        self.combined_instructions = self.load_instructions()
+        # After example: the prompt registry compiles the default prompt once per process.
+        self.combined_instructions = get_compiled_prompt(None, None, self._compile_system_prompt).text
 
     def load_instructions(self, bot_mode: str | None = None):
         """Load and join instruction files listed below (edit manually)."""
@@ -105,6 +191,20 @@ class MessageRouter:
                 logging.warning(f"Could not read instruction file '{path}': {exc}")
         return "\n\n".join(collected)
 
+    def _compile_system_prompt(self, bot_mode: str | None, source_interface: str | None):
+        """compile_fn for utilities.prompt_registry: returns (prompt_text, instruction_paths).
+
+        The text is the static instructions only; the frontend note is per-turn context
+        (see _build_frontend_context_note), so ``source_interface`` does not change it.
+        """
+        instruction_path = _get_bot_instructions_path((bot_mode or "").lower())
+        return self.load_instructions(bot_mode=bot_mode), [instruction_path] if instruction_path else []
+
+    def _store_prompt_reference(self, session_doc: dict, user_id: str, compiled_prompt) -> None:
+        """Blocking: register the prompt text once, then point the session at its hash/version."""
+        version = register_prompt(compiled_prompt)
+        update_session_system_prompt(session_doc, user_id, compiled_prompt.content_hash, version)
+
     def _build_search_tool_schema(self):
         # Before example: web search routing was hard-coded by command prefix.
         # After example: model can call a standard function tool when policy allows.
@@ -211,7 +311,7 @@ class MessageRouter:
             return False
         return True
 
-    def _execute_tool_call(
+    async def _execute_tool_call(
         self,
         tool_call,
         verbatim_user_query: str | None = None,
@@ -219,6 +319,7 @@ class MessageRouter:
         stream_callback=None,
         should_stop=None,
     ):
+        """``stream_callback`` here receives raw text deltas (normally ``DeltaEmitter.emit``)."""
         # Before example: command-prefix routing called Perplexity directly in route_message.
         # After example: tool execution is centralized and tied to tool_call payload.
         function_payload = tool_call.get("function") or {}
@@ -244,8 +345,15 @@ class MessageRouter:
             query[:160],
         )
 
+        context_messages = list(conversation_messages or [])
+        if not str(verbatim_user_query or "").strip():
+            # Parallel calls: each model-written query replaces the user's combined question as the last turn.
+            # Example: "rest times for steak and pork?" -> [..., user: "steak resting time"] and [..., user: "pork ..."].
+            while context_messages and context_messages[-1].get("role") != "user":
+                context_messages.pop()
+            context_messages = context_messages[:-1]
         perplexity_query_payload = self._build_perplexity_context_messages(
-            conversation_messages=conversation_messages,
+            conversation_messages=context_messages,
             current_user_query=query,
         )
         logging.info(
@@ -256,56 +364,20 @@ class MessageRouter:
             perplexity_query_payload[-1].get("role") if perplexity_query_payload else "none",
         )
 
-        from utilities.perplexity import search_perplexity
-        return search_perplexity(
+        from utilities.perplexity import search_perplexity_async
+        return await search_perplexity_async(
             perplexity_query_payload,
             stream_callback=stream_callback,
             should_stop=should_stop,
         )
 
-    # === INTERFACETEST-STYLE STREAMING BLOCK START (easy to undo) ===
-    def _emit_text_stream(self, text, stream_callback=None, should_stop=None):
-        """
-        Emit progressive text updates for a single-message edit UI.
-        Returns (final_text_to_keep, stopped_early).
-        """
-        full_text = str(text or "")
-        if not full_text:
-            return "", False
-
-        if not callable(stream_callback):
-            return full_text, False
-
-        words = full_text.split()
-        if not words:
-            stream_callback(full_text)
-            return full_text, False
+    def _xai_headers(self):
+        return {
+            "Authorization": f"Bearer {self.xai_api_key}",
+            "Content-Type": "application/json",
+        }
 
-        built_words = []
-        last_emitted_chars = 0
-        for index, word in enumerate(words):
-            if callable(should_stop) and should_stop():
-                partial = " ".join(built_words).strip()
-                if partial:
-                    stream_callback(partial)
-                return partial, True
-
-            built_words.append(word)
-            preview = " ".join(built_words)
-            is_last = index == len(words) - 1
-            punctuated = word.endswith((".", "!", "?", ",", ";", ":"))
-            grew_enough = (len(preview) - last_emitted_chars) >= 80
-            if is_last or punctuated or grew_enough:
-                stream_callback(preview)
-                last_emitted_chars = len(preview)
-                # Before example: all chunks arrived instantly.
-                # After example:  tiny pause creates visible progressive edits.
-                time.sleep(0.03)
-
-        return " ".join(built_words).strip(), False
-    # === INTERFACETEST-STYLE STREAMING BLOCK END ===
-
-    def _call_model(self, model, messages, tools=None):
+    async def _call_model(self, model, messages, tools=None, bot_mode=None):
         # Before example: request/response parsing was duplicated in multiple places.
         # After example: one helper sends the call and returns the assistant message object.
         payload = {
@@ -318,97 +390,128 @@ class MessageRouter:
             payload["tools"] = tools
             payload["tool_choice"] = "auto"
 
-        response = requests.post(
-            "https://api.x.ai/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {self.xai_api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            timeout=180,
-        )
+        # Before example: requests.post(..., timeout=180) blocked the event loop.
+        # After example:  the pooled xai client is awaited (read timeout set in http_clients).
+        client = get_async_client("xai")
+        response = None
+        async with cancellation.guard():
+            response = await client.post(
+                "/v1/chat/completions",
+                headers=self._xai_headers(),
+                json=payload,
+            )
+        if response is None:
+            # /stop aborted the request; nothing was generated.
+            return {}
         response.raise_for_status()
         data = response.json()
+        _record_prompt_usage(bot_mode, data.get("usage"))
         choices = data.get("choices") or []
         if not choices:
             return {}
         return choices[0].get("message") or {}
 
-    def _call_model_stream(self, model, messages, tools=None, stream_callback=None, should_stop=None):
-        """Call xAI with server-side streaming and assemble assistant message."""
+    async def _call_model_stream(
+        self, model, messages, tools=None, emitter=None, should_stop=None, bot_mode=None, on_first_token=None
+    ):
+        """Call xAI with server-side streaming and assemble assistant message.
+
+        Each content token is forwarded once as a delta through ``emitter``. The final chunk's
+        usage block (``stream_options.include_usage``) is recorded with the time to first token.
+        ``on_first_token`` is awaited before the first delta (the hedging claim in utilities/resilience.py).
+        """
         payload = {
             "model": model,
             "messages": messages,
             "max_tokens": 256,
             "temperature": 0.7,
             "stream": True,
+            "stream_options": {"include_usage": True},
         }
         if tools:
             payload["tools"] = tools
             payload["tool_choice"] = "auto"
 
-        response = requests.post(
-            "https://api.x.ai/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {self.xai_api_key}",
-                "Content-Type": "application/json",
-            },
-            json=payload,
-            stream=True,
-            timeout=180,
-        )
-        response.raise_for_status()
-
         content_parts = []
         tool_calls_by_index = {}
-
-        for raw_line in response.iter_lines(decode_unicode=True):
-            if callable(should_stop) and should_stop():
-                break
-            if not raw_line:
-                continue
-
-            line = str(raw_line).strip()
-            if line.startswith("data:"):
-                line = line[5:].strip()
-            if not line or line == "[DONE]":
-                continue
-
-            try:
-                chunk = json.loads(line)
-            except Exception:
-                continue
-
-            choices = chunk.get("choices") or []
-            if not choices:
-                continue
-            delta = (choices[0] or {}).get("delta") or {}
-
-            token = delta.get("content")
-            if token:
-                content_parts.append(str(token))
-                if callable(stream_callback):
-                    # Before example: general replies were emitted only after full completion.
-                    # After example:  each new token updates the in-flight Telegram/web stream.
-                    stream_callback("".join(content_parts))
-
-            tool_deltas = delta.get("tool_calls") or []
-            for item in tool_deltas:
-                idx = int(item.get("index", 0))
-                assembled = tool_calls_by_index.setdefault(
-                    idx,
-                    {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
-                )
-                if item.get("id"):
-                    assembled["id"] = str(item["id"])
-                if item.get("type"):
-                    assembled["type"] = str(item["type"])
-                fn = item.get("function") or {}
-                if fn.get("name"):
-                    assembled["function"]["name"] += str(fn["name"])
-                if fn.get("arguments"):
-                    assembled["function"]["arguments"] += str(fn["arguments"])
-
+        usage = None
+        ttft_ms = None
+        started = time.monotonic()
+
+        client = get_async_client("xai")
+        # Before example: /stop waited for the next SSE line (or the 180s read timeout) to be noticed.
+        # After example:  the token cancels this block, the response closes at once and the partial
+        #                 content below is returned as if the stream had ended there.
+        async with cancellation.guard():
+            async with client.stream(
+                "POST",
+                "/v1/chat/completions",
+                headers=self._xai_headers(),
+                json=payload,
+            ) as response:
+                if response.is_error:
+                    # Read the body so HTTPStatusError carries the upstream error text.
+                    await response.aread()
+                    response.raise_for_status()
+
+                async for raw_line in response.aiter_lines():
+                    if callable(should_stop) and should_stop():
+                        break
+                    if not raw_line:
+                        continue
+
+                    line = str(raw_line).strip()
+                    if line.startswith("data:"):
+                        line = line[5:].strip()
+                    if not line or line == "[DONE]":
+                        continue
+
+                    try:
+                        chunk = json.loads(line)
+                    except Exception:
+                        continue
+
+                    if chunk.get("usage"):
+                        # Sent on the last chunk (choices: []); earlier chunks may carry a running copy.
+                        usage = chunk["usage"]
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    delta = (choices[0] or {}).get("delta") or {}
+
+                    if ttft_ms is None and (delta.get("content") or delta.get("tool_calls")):
+                        ttft_ms = int((time.monotonic() - started) * 1000)
+                        if on_first_token is not None:
+                            await on_first_token()
+                    token = delta.get("content")
+                    if token:
+                        content_parts.append(str(token))
+                        # Before example: every token re-sent "".join(content_parts) to the callback.
+                        # After example:  only the new token is sent; consumers append it.
+                        if emitter is not None:
+                            await emitter.emit(str(token))
+
+                    tool_deltas = delta.get("tool_calls") or []
+                    for item in tool_deltas:
+                        idx = int(item.get("index", 0))
+                        assembled = tool_calls_by_index.setdefault(
+                            idx,
+                            {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
+                        )
+                        if item.get("id"):
+                            assembled["id"] = str(item["id"])
+                        if item.get("type"):
+                            assembled["type"] = str(item["type"])
+                        fn = item.get("function") or {}
+                        if fn.get("name"):
+                            assembled["function"]["name"] += str(fn["name"])
+                        if fn.get("arguments"):
+                            assembled["function"]["arguments"] += str(fn["arguments"])
+
+        if tool_calls_by_index and cancellation.is_cancelled():
+            # Arguments may be cut off mid-JSON; never run a tool call the user stopped.
+            tool_calls_by_index = {}
+        _record_prompt_usage(bot_mode, usage, ttft_ms)
         assistant_message = {
             "role": "assistant",
             "content": "".join(content_parts),
@@ -419,8 +522,46 @@ class MessageRouter:
             ]
         return assistant_message
 
-    def _build_frontend_context_note(self, message_object: dict | None) -> str:
-        """Add tiny context so the model knows which frontend produced this turn."""
+    async def _call_xai(self, model, messages, tools=None, emitter=None, should_stop=None, bot_mode=None, deadline=None):
+        """Stream (``emitter`` given) or call xAI through utilities/resilience.py.
+
+        Before example: one stalled connection held the turn until the 180s read timeout.
+        After example:  a slow first token past the model's p95 is hedged, repeated failures open
+                        the breaker, and XAI_FALLBACK_MODEL answers instead when set.
+        """
+
+        def attempt_for(target_model):
+            def attempt(on_first_token):
+                if emitter is not None:
+                    return self._call_model_stream(
+                        model=target_model,
+                        messages=messages,
+                        tools=tools,
+                        emitter=emitter,
+                        should_stop=should_stop,
+                        bot_mode=bot_mode,
+                        on_first_token=on_first_token,
+                    )
+                return self._call_model(model=target_model, messages=messages, tools=tools, bot_mode=bot_mode)
+
+            return attempt
+
+        fallback = None
+        fallback_model = os.getenv("XAI_FALLBACK_MODEL", "").strip()
+        if fallback_model and fallback_model != model:
+            failover_attempt = attempt_for(fallback_model)
+
+            def fallback_attempt(on_first_token):
+                # Tokens the failed primary already streamed are replaced, not appended to.
+                if emitter is not None:
+                    emitter.replace_on_next_emit()
+                return failover_attempt(on_first_token)
+
+            fallback = (f"xai:{fallback_model}", fallback_attempt)
+        return await resilience.call_provider(f"xai:{model}", attempt_for(model), fallback=fallback, deadline=deadline)
+
+    def _resolve_frontend_source(self, message_object: dict | None) -> str:
+        """Example: {"source_interface": "Web"} -> "web"; unknown/missing -> ""."""
         if not isinstance(message_object, dict):
             return ""
         source = str(
@@ -428,6 +569,16 @@ class MessageRouter:
             or message_object.get("source")
             or ""
         ).strip().lower()
+        return source if source in {"telegram", "web"} else ""
+
+    def _build_frontend_context_note(self, message_object: dict | None) -> str:
+        """Add tiny context so the model knows which frontend produced this turn.
+
+        Sent as a late per-turn system message, never inside the cached system prompt.
+        """
+        return self._frontend_note_for_source(self._resolve_frontend_source(message_object))
+
+    def _frontend_note_for_source(self, source: str | None) -> str:
         if source not in {"telegram", "web"}:
             return ""
         if source == "telegram":
@@ -441,22 +592,75 @@ class MessageRouter:
             "- Continue only from stored conversation history."
         )
 
-    def route_message(self, messages=None, message_object=None, stream=False, stream_callback=None, should_stop=None):
-        """Route a message from a user to OpenAI, persist history, and return the response.
+    def route_message(
+        self, messages=None, message_object=None, stream=False, stream_callback=None, should_stop=None, cancel_token=None
+    ):
+        """Synchronous entry point for scripts and the CLI below.
+
+        Runs :meth:`route_message_async` on a private event loop. Code that already
+        runs inside an event loop (Telegram handlers, the SSE backend) must await
+        ``route_message_async`` directly instead.
+        """
+        return run_sync(
+            self.route_message_async(
+                messages=messages,
+                message_object=message_object,
+                stream=stream,
+                stream_callback=stream_callback,
+                should_stop=should_stop,
+                cancel_token=cancel_token,
+            )
+        )
+
+    async def route_message_async(
+        self, messages=None, message_object=None, stream=False, stream_callback=None, should_stop=None, cancel_token=None
+    ):
+        """Route a message from a user to xAI, persist history, and return the response.
 
         Tool calling behavior:
         - Uses standard function-calling flow (assistant tool call -> tool result -> assistant follow-up).
+        - All tool calls of one assistant message run concurrently (utilities/tool_engine.py); with
+          TOOL_MAX_ROUNDS > 1 the model may read the results and request further rounds, all within
+          TOOL_LOOP_DEADLINE_SEC. With the default of 1 the tool output is the reply, verbatim.
         - Internet search tool is available only in general mode.
         - Policy on when to call tools must stay instruction-driven (not code-gated heuristics).
+
+        Provider calls are awaited on pooled async clients; blocking history/Telegram
+        helpers run via ``asyncio.to_thread`` so one slow turn never stalls other chats.
         
         Args:
             messages: Optional list of message dictionaries for the conversation history
             message_object: Optional dictionary containing user_message and other data
             stream: If True, emit progressive updates through stream_callback
-            stream_callback: Callable that receives full partial text for single-message edits
+            stream_callback: Callable (or coroutine function) that receives ``StreamDelta`` objects
+                (seq-numbered text increments; see utilities/stream_protocol.py)
             should_stop: Callable that returns True when generation should stop safely
+            cancel_token: Optional ``CancelToken`` (utilities/cancellation.py); cancelling it aborts
+                in-flight xAI/Perplexity/Gemini requests at once instead of at the next SSE line.
+                Defaults to the token of an enclosing ``cancel_scope``.
         """
+        if cancel_token is not None and cancellation.current_token() is not cancel_token:
+            # Install the token for every task this turn starts (tools, hedged attempts).
+            with cancellation.cancel_scope(cancel_token):
+                return await self.route_message_async(
+                    messages=messages,
+                    message_object=message_object,
+                    stream=stream,
+                    stream_callback=stream_callback,
+                    should_stop=should_stop,
+                    cancel_token=cancel_token,
+                )
+        cancel_token = cancellation.current_token()
+        if should_stop is None and cancel_token is not None:
+            should_stop = cancel_token.is_cancelled
         user_id = str(message_object.get("user_id", "unknown")) if message_object else "unknown"
+        emitter = DeltaEmitter(stream_callback if stream else None)
+        # Example: the web handler opened request_deadline(180) 2s ago -> provider calls get ~178s.
+        # Direct callers without a scope still get RESILIENCE_REQUEST_DEADLINE_SEC from here.
+        turn_deadline = resilience.earliest(
+            resilience.current_deadline(),
+            resilience.deadline_after(resilience.RESILIENCE_REQUEST_DEADLINE_SEC),
+        )
         logging.info(f"route_message start: user_id={user_id}, has_message_object={bool(message_object)}")
         logging.debug(f"DEBUG: route_message called with messages={messages}, message_object={message_object}")
         
@@ -468,7 +672,9 @@ class MessageRouter:
 
         if message_object and "user_message" in message_object:
             user_message = message_object["user_message"]
-            full_message_object = message_history_process(message_object, {"role": "user", "content": user_message})
+            full_message_object = await asyncio.to_thread(
+                message_history_process, message_object, {"role": "user", "content": user_message}
+            )
             # Use the full message history from the updated object
             messages = full_message_object.get("messages", [])
             if messages:
@@ -485,36 +691,81 @@ class MessageRouter:
             effective_bot_mode = message_object.get("bot_mode")
         if not effective_bot_mode:
             effective_bot_mode = os.getenv("BOT_MODE") or "chefmain"
-        self.combined_instructions = self.load_instructions(bot_mode=effective_bot_mode)
-        system_prompt = self.combined_instructions + self._build_frontend_context_note(message_object)
+        # Before example: instruction file re-read + prompt rebuilt on every turn.
+        # After example:  compiled once per mode; reloaded when the file mtime changes. The frontend
+        #                 note is per-turn context (appended late below), so Telegram and web turns of
+        #                 one session share a byte-identical, provider-cacheable prefix.
+        compiled_prompt = get_compiled_prompt(effective_bot_mode, None, self._compile_system_prompt)
+        system_prompt = compiled_prompt.text
         system_instruction = {"role": "system", "content": system_prompt}
+        stored_prompt_hash = (
+            full_message_object.get("system_prompt_hash") if isinstance(full_message_object, dict) else None
+        )
 
         # Ensure messages is a proper list
         if not isinstance(messages, list):
             logging.debug(f"DEBUG: Converting messages from {type(messages)} to list")
             messages = []
         
-        # Ensure system instruction is present at the start AFTER loading conversation history
-        instructions_applied = False
-
-        if not messages or len(messages) == 0 or not isinstance(messages[0], dict) or messages[0].get("role") != "system":
-            # Before: an empty history after /restart stayed empty. After example: we re-seed with the base prompt.
-            messages.insert(0, system_instruction)
-            instructions_applied = True
-        elif messages[0].get("content") != system_prompt:
-            # Before: first-turn system prompt could linger and miss updated mode/frontend context.
-            # After example: system prompt is refreshed each turn while keeping a single system entry.
-            messages[0]["content"] = system_prompt
-            instructions_applied = True
-
-        if instructions_applied and full_message_object and message_object:
-            full_message_object["messages"] = messages
+        # Sessions reference the prompt by hash; the text always comes from the compiled prompt in memory.
+        # Before example: messages[0] = the full instructions, rewritten into the session on every change.
+        # After example:  history = [user, assistant, ...]; payload = [system_instruction] + history.
+        legacy_head = None
+        if messages and isinstance(messages[0], dict) and messages[0].get("role") == "system":
+            # Older sessions (or the empty seed) still carry an inline head; the write below drops it.
+            legacy_head = messages.pop(0)
+        messages.insert(0, system_instruction)
+
+        if (
+            full_message_object
+            and message_object
+            and (stored_prompt_hash != compiled_prompt.content_hash or legacy_head is not None)
+        ):
+            full_message_object["messages"] = messages[1:]
             user_identifier = str(message_object.get("user_id", "unknown"))
-            archive_message_history(full_message_object, user_identifier)
+            await asyncio.to_thread(
+                self._store_prompt_reference,
+                full_message_object,
+                user_identifier,
+                compiled_prompt,
+            )
+
+        if full_message_object and message_object:
+            # Before example: a 300-message session sent its whole 80-message tail (~40k tokens) every turn.
+            # After example:  [system, summary of turns 0-220, ...turns 221-300 that fit CONTEXT_TOKEN_BUDGET].
+            window = build_context(
+                system_instruction,
+                messages[1:],
+                message_count=full_message_object.get("message_count"),
+                summary=full_message_object.get("context_summary"),
+                session_tokens=(
+                    full_message_object.get("token_estimate")
+                    if full_message_object.get("token_estimate_complete")
+                    else None
+                ),
+            )
+            messages = window["messages"]
+            logging.info(
+                "context_window: user_id=%s, estimated_tokens=%s, window_start=%s, needs_summary=%s",
+                user_id,
+                window["estimated_tokens"],
+                window["window_start"],
+                window["needs_summary"],
+            )
+            if window["needs_summary"]:
+                # Runs on the context_window worker; this turn goes out with the current summary.
+                schedule_context_summary(user_id, full_message_object)
 
         # Clean messages before sending to OpenAI: remove any with content None, but preserve those with tool_calls
         messages = [m for m in messages if m.get('content') is not None or m.get('tool_calls') is not None]
 
+        # Before example: [system(instructions + "Current frontend: Web UI chat."), ...history]
+        # After example:  [system(instructions), ...history, system("Frontend context: ...")]
+        # Only the tail after the stored history varies per turn, so the prefix stays cacheable.
+        frontend_note = self._build_frontend_context_note(message_object).strip()
+        if frontend_note:
+            messages.append({"role": "system", "content": frontend_note})
+
         last_user_content = None
         for entry in reversed(messages):
             if entry.get("role") == "user":
@@ -529,11 +780,16 @@ class MessageRouter:
             if callable(should_stop) and should_stop():
                 assistant_content = "Stopped by user before generation started."
                 if message_object:
-                    message_history_process(message_object, {"role": "assistant", "content": assistant_content})
+                    await asyncio.to_thread(
+                        message_history_process,
+                        message_object,
+                        {"role": "assistant", "content": assistant_content},
+                        return_history=False,
+                    )
                 if message_object and (not stream or not callable(stream_callback)):
                     partial = message_object.copy()
                     partial["user_message"] = assistant_content
-                    process_message_object(partial)
+                    await process_message_object_async(partial)
                 return assistant_content
 
             # Before: OpenAI call timing was opaque; after example: log start/end with model + duration.
@@ -564,89 +820,99 @@ class MessageRouter:
                 self.xai_api_key[-4:] if self.xai_api_key else "NONE",
             )
 
-            used_native_stream = False
-            if stream and callable(stream_callback):
-                assistant_message = self._call_model_stream(
-                    model=xai_model,
-                    messages=messages,
-                    tools=search_tools,
-                    stream_callback=stream_callback,
-                    should_stop=should_stop,
-                )
-                used_native_stream = True
-            else:
-                assistant_message = self._call_model(
-                    model=xai_model,
-                    messages=messages,
-                    tools=search_tools,
-                )
+            assistant_message = await self._call_xai(
+                model=xai_model,
+                messages=messages,
+                tools=search_tools,
+                emitter=emitter if emitter.enabled else None,
+                should_stop=should_stop,
+                bot_mode=effective_bot_mode,
+                deadline=turn_deadline,
+            )
             assistant_content = assistant_message.get("content") or ""
             tool_calls = assistant_message.get("tool_calls") or []
 
+            tool_rounds = 0
             if tool_calls:
                 tool_context_messages = list(messages)
-                logging.info(
-                    "xai_tool_round start: user_id=%s round=%s tool_calls=%s",
-                    user_id,
-                    1,
-                    len(tool_calls),
-                )
-                messages.append(
-                    {
-                        "role": "assistant",
-                        "content": assistant_message.get("content"),
-                        "tool_calls": tool_calls,
-                    }
+                deadline = resilience.earliest(
+                    resilience.deadline_after(tool_engine.TOOL_LOOP_DEADLINE_SEC), turn_deadline
                 )
-                if len(tool_calls) > 1:
-                    logging.warning(
-                        "xai_tool_round multiple_calls: user_id=%s count=%s using_first_call_only",
+                while tool_calls:
+                    tool_rounds += 1
+                    logging.info(
+                        "xai_tool_round start: user_id=%s round=%s tool_calls=%s",
                         user_id,
+                        tool_rounds,
                         len(tool_calls),
                     )
-
-                tool_call = tool_calls[0]
-                tool_call_id = tool_call.get("id") or "tool_call_1_1"
-                function_name = (tool_call.get("function") or {}).get("name")
-                try:
-                    tool_output = self._execute_tool_call(
-                        tool_call,
-                        verbatim_user_query=str(last_user_content or ""),
-                        conversation_messages=tool_context_messages,
-                        stream_callback=stream_callback if stream else None,
-                        should_stop=should_stop if stream else None,
+                    messages.append(
+                        {
+                            "role": "assistant",
+                            "content": assistant_message.get("content"),
+                            "tool_calls": tool_calls,
+                        }
                     )
-                except Exception as tool_exc:
-                    tool_output = f"Tool execution error: {tool_exc}"
-
-                messages.append(
-                    {
-                        "role": "tool",
-                        "tool_call_id": tool_call_id,
-                        "name": function_name,
-                        "content": tool_output,
-                    }
-                )
-
-                # User preference: return Perplexity output verbatim (no rewrite, no trim).
-                assistant_content = tool_output if isinstance(tool_output, str) else str(tool_output)
-
-            # Stream non-tool model text via progressive single-message updates.
-            if (
-                stream
-                and assistant_content
-                and effective_bot_mode == "general"
-                and not tool_calls
-                and not used_native_stream
-            ):
-                streamed_text, stopped_early = self._emit_text_stream(
-                    assistant_content,
-                    stream_callback=stream_callback,
-                    should_stop=should_stop,
-                )
-                assistant_content = streamed_text
-                if stopped_early:
-                    assistant_content = (assistant_content + "\n\n[Stopped by user]").strip()
+                    # Any preamble the model streamed before the tool call is replaced by the tool answer.
+                    await emitter.reset()
+                    # A lone first-round search gets the user's words verbatim; parallel calls each
+                    # keep their own model-written query, otherwise they would all search the same text.
+                    verbatim_query = (
+                        str(last_user_content or "") if len(tool_calls) == 1 and tool_rounds == 1 else None
+                    )
+                    tool_outputs = await tool_engine.run_tool_calls(
+                        tool_calls,
+                        lambda call, callback, verbatim_query=verbatim_query: self._execute_tool_call(
+                            call,
+                            verbatim_user_query=verbatim_query,
+                            conversation_messages=tool_context_messages,
+                            stream_callback=callback,
+                            should_stop=should_stop if stream else None,
+                        ),
+                        emit=emitter.emit if emitter.enabled else None,
+                        deadline=deadline,
+                    )
+                    for index, (tool_call, tool_output) in enumerate(zip(tool_calls, tool_outputs), start=1):
+                        messages.append(
+                            {
+                                "role": "tool",
+                                "tool_call_id": tool_call.get("id") or f"tool_call_{tool_rounds}_{index}",
+                                "name": (tool_call.get("function") or {}).get("name"),
+                                "content": tool_output,
+                            }
+                        )
+
+                    # User preference: return Perplexity output verbatim (no rewrite, no trim).
+                    assistant_content = tool_engine.combine_tool_outputs(tool_outputs)
+                    if (
+                        tool_rounds >= tool_engine.TOOL_MAX_ROUNDS
+                        or resilience.remaining(deadline) == 0
+                        or (callable(should_stop) and should_stop())
+                    ):
+                        break
+
+                    # TOOL_MAX_ROUNDS > 1: the model reads the results and answers or asks for more tools.
+                    # Before example: follow-up via _call_model, then the finished text replayed word by word.
+                    # After example:  the follow-up streams natively into the same message; the tool results
+                    #                 stay visible until its first token replaces them.
+                    try:
+                        if emitter.enabled:
+                            emitter.replace_on_next_emit()
+                        assistant_message = await self._call_xai(
+                            model=xai_model,
+                            messages=messages,
+                            tools=search_tools,
+                            emitter=emitter if emitter.enabled else None,
+                            should_stop=should_stop,
+                            bot_mode=effective_bot_mode,
+                            deadline=deadline,
+                        )
+                    except asyncio.TimeoutError:
+                        logging.warning("xai_tool_round deadline: user_id=%s round=%s", user_id, tool_rounds)
+                        break
+                    tool_calls = assistant_message.get("tool_calls") or []
+                    if not tool_calls and assistant_message.get("content"):
+                        assistant_content = assistant_message["content"]
 
             if (
                 message_object
@@ -656,11 +922,20 @@ class MessageRouter:
             ):
                 partial = message_object.copy()
                 partial["user_message"] = assistant_content
-                process_message_object(partial)
+                await process_message_object_async(partial)
+
+            # Consumers end on exactly the returned text (e.g. Perplexity citations arrive as one tail delta).
+            if emitter.enabled:
+                await emitter.finish(assistant_content)
 
             # --- Append assistant response to user history ---
             if message_object:
-                message_history_process(message_object, {"role": "assistant", "content": assistant_content})
+                await asyncio.to_thread(
+                    message_history_process,
+                    message_object,
+                    {"role": "assistant", "content": assistant_content},
+                    return_history=False,
+                )
 
             # Example before/after: empty response -> troubleshoot logs; non-empty -> user sees reply
             openai_duration_ms = int((time.monotonic() - openai_start) * 1000)
@@ -681,7 +956,7 @@ class MessageRouter:
                 # Example before/after: empty reply -> silent; now emits explicit stdout marker.
                 print(f"XAI_CALL_EMPTY_RESPONSE user_id={user_id}")
             return assistant_content
-        except requests.HTTPError as http_err:
+        except httpx.HTTPStatusError as http_err:
             status = getattr(getattr(http_err, "response", None), "status_code", "unknown")
             body = getattr(getattr(http_err, "response", None), "text", str(http_err))
             logging.error(f"HTTP Error {status}: {body}")
@@ -690,8 +965,21 @@ class MessageRouter:
                 error_message = f"Sorry, I hit an upstream error ({status}). Please try again."
                 partial = message_object.copy()
                 partial["user_message"] = error_message
-                process_message_object(partial)
+                await process_message_object_async(partial)
             return f"HTTP Error {status}: {body}"
+        except (asyncio.TimeoutError, TimeoutError, httpx.TimeoutException) as timeout_err:
+            # Before example: the turn deadline fired and str(TimeoutError()) is "", so the caller got
+            #                 "Error processing your message: " and the user a generic error.
+            # After example:  both say the request timed out.
+            logging.warning(
+                "route_message timed out: user_id=%s error=%s", user_id, type(timeout_err).__name__
+            )
+            if message_object and self._should_emit_chat_output(message_object):
+                error_message = "Sorry, the request timed out. Please try again."
+                partial = message_object.copy()
+                partial["user_message"] = error_message
+                await process_message_object_async(partial)
+            return "Error processing your message: request timed out"
         except Exception as e:
             logging.error(f"Error in openai API call in message_router.py: {str(e)}", exc_info=True)
             if message_object and self._should_emit_chat_output(message_object):
@@ -699,7 +987,7 @@ class MessageRouter:
                 error_message = "Sorry, I ran into an error while generating a response. Please try again."
                 partial = message_object.copy()
                 partial["user_message"] = error_message
-                process_message_object(partial)
+                await process_message_object_async(partial)
             return f"Error processing your message: {str(e)}"
     
 # Simple command-line interface for testing
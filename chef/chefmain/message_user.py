@@ -1,12 +1,22 @@
 # chef/message_user.py
 
-import requests
+import asyncio
+import concurrent.futures
+import os
 import re 
 import logging
 
+import telegram_delivery
+
 # It's good practice to get a logger specific to this module
 logger = logging.getLogger(__name__)
 
+# Resolved once per process; see register_bot_token/get_bot_token.
+_bot_token = None
+
+# Queued chunks can wait behind per-chat pacing and retry_after, so allow well past one HTTP timeout.
+DELIVERY_WAIT_TIMEOUT_SEC = float(os.getenv("TELEGRAM_DELIVERY_WAIT_SEC", "120"))
+
 
 
 # THIS IS THE FUNCTION THAT WORKS WITH THE Application OBJECT
@@ -31,70 +41,62 @@ def extract_token_from_string_representation(application_string_repr):
     return None
 
 
-def extract_token_from_file(session_info):
-    """Reads the application data file for the user and extracts the bot token using regex."""
-    user_id = session_info.get('user_id')
-    if not user_id:
-        logger.error("No user_id found in session_info for token extraction.")
-        return None
-    filename = f"application_data_for_{user_id}.txt"
-    try:
-        with open(filename, "r") as f:
-            application_data_str = f.read()
-            print(f"DEBUG: Application data string (first 100 chars): {application_data_str[:100]}") # Debugging output
-        # More robust regex: match token='...' or token="..." or token=... (no quotes)
-        match = re.search(r"token[=:\s]*['\"]?([a-zA-Z0-9:_-]+)['\"]?", application_data_str)
-        print(f"DEBUG: Regex match result: {match.group(1)}") # Debugging output
-        if match:
-            return match.group(1)
-        logger.error(f"Could not find token in application data file for user_id {user_id}. Contents: {application_data_str[:200]}")
-        return None
-    except FileNotFoundError:
-        logger.error(f"Application data file not found for user_id {user_id}: {filename}")
-        return None
-    except Exception as e:
-        logger.error(f"Error reading application data file for user_id {user_id}: {e}")
-        return None
+def _resolve_token_from_env():
+    """Pick the bot token with the same runtime rules as telegram_bot.setup_bot."""
+    # Example before/after: K_SERVICE set -> TELEGRAM_KEY; CODESPACES=true -> TELEGRAM_DEV_KEY
+    if os.getenv("K_SERVICE"):
+        return os.getenv("TELEGRAM_KEY")
+    if os.getenv("CODESPACES") == "true":
+        return os.getenv("TELEGRAM_DEV_KEY")
+    if os.getenv("ENVIRONMENT", "development") == "development":
+        return os.getenv("TELEGRAM_DEV_KEY")
+    return os.getenv("TELEGRAM_KEY")
 
 
-def process_message_object(message_object):
-    """
-    Extracts necessary information from the message_object and sends a message
-    to the Telegram user. The content of message_object['user_message'] is sent.
-    """
-    print(f"DEBUG: process_message_object called. Type of message_object: {type(message_object)}") # Debugging output
+def register_bot_token(token):
+    """Store the bot token once at startup (called from telegram_bot.setup_bot)."""
+    global _bot_token
+    _bot_token = token or None
+
+
+def get_bot_token():
+    """Return the cached bot token, resolving it from env on first use."""
+    global _bot_token
+    if _bot_token is None:
+        _bot_token = _resolve_token_from_env() or None
+    return _bot_token
 
+
+def _resolve_outbound_message(message_object):
+    """Validate message_object and return (chat_id, bot_token, text), or None when nothing should be sent."""
     # Validate the structure of message_object
     if not isinstance(message_object, dict):
         logger.error(f"Invalid message_object: Expected a dictionary, got {type(message_object)}.")
-        return
+        return None
 
     required_keys = ['session_info', 'user_message']
     missing_keys = [key for key in required_keys if key not in message_object]
     if missing_keys:
         logger.error(f"Invalid message_object: Missing required keys: {', '.join(missing_keys)}. Available keys: {list(message_object.keys())}")
-        return
+        return None
 
     session_info = message_object.get('session_info')
     if not isinstance(session_info, dict):
         logger.error(f"Invalid session_info in message_object: Expected a dictionary, got {type(session_info)}.")
-        return
+        return None
         
     chat_id_to_send = session_info.get('chat_id')
     if not chat_id_to_send:
         logger.error("chat_id missing or invalid in message_object's session_info.")
-        return
+        return None
     
-    # === THE CRITICAL FIX IS HERE ===
-    # Use the function that correctly extracts the token from the application data file
-    bot_token = extract_token_from_file(session_info)
-    # === END OF CRITICAL FIX ===
+    # Before example: every reply re-opened application_data_for_<user>.txt and regex-parsed the token.
+    # After example:  the token is resolved once per process and reused from memory.
+    bot_token = get_bot_token()
     
     if not bot_token:
-        # extract_token_from_application_object already logs the error,
-        # but we can add context here.
-        logger.error(f"Failed to extract bot token for chat_id {chat_id_to_send}. Message cannot be sent.")
-        return
+        logger.error(f"No Telegram bot token configured for chat_id {chat_id_to_send}. Message cannot be sent.")
+        return None
     
     # The content of 'user_message' should be the tool output or AI's final textual response.
     # Ensure it's converted to a string before sending.
@@ -102,66 +104,102 @@ def process_message_object(message_object):
 
     if not message_to_send.strip(): # Do not send empty or whitespace-only messages
         logger.info(f"Message content for chat_id {chat_id_to_send} is empty or whitespace only. Message not sent.")
-        return
+        return None
 
     logger.info(f"Attempting to send message to chat_id: {chat_id_to_send}")
-    # For security, avoid logging the full token or log only a small, non-sensitive part if necessary for debugging.
-    # logger.debug(f"Using bot_token (last 6 chars for verification): ...{bot_token[-6:]}") 
     logger.info(f"Message content (first 200 chars): '{message_to_send[:200]}...'")
+    return chat_id_to_send, bot_token, message_to_send
 
+
+def process_message_object(message_object):
+    """
+    Extracts necessary information from the message_object and sends a message
+    to the Telegram user. The content of message_object['user_message'] is sent.
+    """
+    resolved = _resolve_outbound_message(message_object)
+    if not resolved:
+        return None
+    chat_id_to_send, bot_token, message_to_send = resolved
     # Call the function to send the message via Telegram API
-    send_telegram_message(chat_id_to_send, bot_token, message_to_send)
+    return send_telegram_message(chat_id_to_send, bot_token, message_to_send)
+
+
+async def process_message_object_async(message_object):
+    """Async twin of :func:`process_message_object` for callers on an event loop."""
+    resolved = _resolve_outbound_message(message_object)
+    if not resolved:
+        return None
+    chat_id_to_send, bot_token, message_to_send = resolved
+    return await send_telegram_message_async(chat_id_to_send, bot_token, message_to_send)
+
+
+def _split_message_chunks(chat_id, message_text, max_length=4000):
+    # max_length adjusted based on user feedback
+    if len(message_text) <= max_length:
+        return [message_text]
+    logger.info(f"Message for chat_id {chat_id} is longer than {max_length} characters. Splitting into chunks.")
+    return [message_text[i:i + max_length] for i in range(0, len(message_text), max_length)]
+
+
+def _summarize_responses(responses):
+    if not responses: # Should not happen if there's at least one chunk
+        return None
+    if len(responses) == 1:
+        return responses[0] # Return single response directly
+    # For multiple chunks, you might want to return all responses or a summary
+    # For now, returning all responses.
+    return responses
 
 
 def send_telegram_message(chat_id, token, message_text):
     """Sends a message to a specific Telegram chat_id using the provided bot token.
     If the message exceeds 4000 characters, it's sent in chunks.
     """
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    max_length = 4000  # Adjusted based on user feedback
+    message_chunks = _split_message_chunks(chat_id, message_text)
+    # Before example: chunks were posted back-to-back and a 429 dropped the rest of the reply.
+    # After example:  chunks go through telegram_delivery, which paces per chat/global and retries 429s.
+    futures = [telegram_delivery.send_message(chat_id, chunk, token) for chunk in message_chunks]
     responses = []
-
-    if len(message_text) <= max_length:
-        message_chunks = [message_text]
-    else:
-        logger.info(f"Message for chat_id {chat_id} is longer than {max_length} characters. Splitting into chunks.")
-        message_chunks = [message_text[i:i + max_length] for i in range(0, len(message_text), max_length)]
-
-    for i, chunk in enumerate(message_chunks):
-        payload = {
-            'chat_id': chat_id,
-            'text': str(chunk)  # Ensure chunk is explicitly a string
-        }
+    for i, future in enumerate(futures):
         try:
-            # It's good practice to set a timeout for network requests.
-            logger.info(f"Sending chunk {i+1}/{len(message_chunks)} to chat_id {chat_id}...")
-            response = requests.post(url, data=payload, timeout=10)
-            response.raise_for_status()  # Raises an HTTPError for bad responses (4XX or 5XX)
-            logger.info(f"Chunk {i+1}/{len(message_chunks)} sent successfully to chat_id {chat_id}. Response: {response.json()}")
-            responses.append(response.json())
-        except requests.exceptions.Timeout:
+            result = future.result(timeout=DELIVERY_WAIT_TIMEOUT_SEC)
+        except concurrent.futures.TimeoutError:
             logger.error(f"Timeout error sending chunk {i+1}/{len(message_chunks)} to chat_id {chat_id}.")
-            responses.append({'ok': False, 'error_code': 'timeout', 'description': 'Request timed out.'})
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Error sending chunk {i+1}/{len(message_chunks)} to chat_id {chat_id}: {e}")
-            error_response = {'ok': False, 'error_code': 'request_exception', 'description': str(e)}
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error(f"Telegram API Response Status: {e.response.status_code}, Content: {e.response.text}")
-                error_response['telegram_status_code'] = e.response.status_code
-                error_response['telegram_content'] = e.response.text
-            responses.append(error_response)
+            result = {'ok': False, 'error_code': 'timeout', 'description': 'Request timed out.'}
         except Exception as e:  # Catch any other unexpected errors
             logger.error(f"Unexpected error in send_telegram_message (chunk {i+1}/{len(message_chunks)}) for chat_id {chat_id}: {e}", exc_info=True)
-            responses.append({'ok': False, 'error_code': 'unexpected_error', 'description': str(e)})
+            result = {'ok': False, 'error_code': 'unexpected_error', 'description': str(e)}
+        _log_chunk_result(chat_id, i, len(message_chunks), result)
+        responses.append(result)
 
-    if not responses: # Should not happen if there's at least one chunk
-        return None
-    if len(responses) == 1:
-        return responses[0] # Return single response directly
+    return _summarize_responses(responses)
+
+
+async def send_telegram_message_async(chat_id, token, message_text):
+    """Async twin of :func:`send_telegram_message`; awaits the same delivery queue."""
+    message_chunks = _split_message_chunks(chat_id, message_text)
+    futures = [telegram_delivery.send_message(chat_id, chunk, token) for chunk in message_chunks]
+    responses = []
+    for i, future in enumerate(futures):
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), timeout=DELIVERY_WAIT_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            logger.error(f"Timeout error sending chunk {i+1}/{len(message_chunks)} to chat_id {chat_id}.")
+            result = {'ok': False, 'error_code': 'timeout', 'description': 'Request timed out.'}
+        except Exception as e:
+            logger.error(f"Unexpected error in send_telegram_message_async (chunk {i+1}/{len(message_chunks)}) for chat_id {chat_id}: {e}", exc_info=True)
+            result = {'ok': False, 'error_code': 'unexpected_error', 'description': str(e)}
+        _log_chunk_result(chat_id, i, len(message_chunks), result)
+        responses.append(result)
+
+    return _summarize_responses(responses)
+
+
+def _log_chunk_result(chat_id, index, total, result):
+    if result.get('ok'):
+        logger.info(f"Chunk {index+1}/{total} sent successfully to chat_id {chat_id}.")
     else:
-        # For multiple chunks, you might want to return all responses or a summary
-        # For now, returning all responses.
-        return responses
+        logger.error(f"Chunk {index+1}/{total} failed for chat_id {chat_id}: {result}")
 
 if __name__ == "__main__":
     # This block is for testing this module directly.
@@ -7,21 +7,32 @@ MessageRouter + history storage so Telegram and web share the same session.
 
 from __future__ import annotations
 
+import asyncio
 import json
 import os
 import re
 import time
 from datetime import datetime, timezone
-from queue import Queue
-from threading import Thread
 
-from flask import Flask, Response, jsonify, request, stream_with_context
+from aiohttp import web
 
-from message_router import MessageRouter
-from utilities.history_messages import get_full_history_message_object, get_user_bot_mode
+from message_router import MessageRouter, prompt_cache_stats
+from utilities.cancellation import CancelToken, cancellation_stats
+from utilities.context_window import context_window_stats
+from utilities.history_messages import (
+    get_full_history_message_object,
+    get_user_bot_mode,
+    history_cache_stats,
+    mode_cache_stats,
+)
+from utilities.http_clients import close_async_clients, get_client_stats, prewarm_async_clients
+from utilities.mongo_clients import get_mongo_pool_stats
+from utilities.perplexity_cache import perplexity_cache_stats
+from utilities.resilience import request_deadline, resilience_stats
+from utilities.tool_engine import tool_engine_stats
 
 
-APP = Flask(__name__)
+ROUTES = web.RouteTableDef()
 
 
 def _now_iso() -> str:
@@ -87,14 +98,30 @@ def _extract_session_payload(uid: str, bot_mode: str | None = None) -> dict:
     }
 
 
-@APP.get("/health")
-def health():
-    return jsonify({"ok": True, "service": "perplexity_clone_shared_backend"})
+@ROUTES.get("/health")
+async def health(request: web.Request):
+    # Example: "http_clients": {"xai": {"requests": 12, "new_connections": 1, "reused": 11, ...}}
+    return web.json_response(
+        {
+            "ok": True,
+            "service": "perplexity_clone_shared_backend",
+            "http_clients": get_client_stats(),
+            "mongo_pools": get_mongo_pool_stats(),
+            "mode_cache": mode_cache_stats(),
+            "history_cache": history_cache_stats(),
+            "context_window": context_window_stats(),
+            "prompt_cache": prompt_cache_stats(),
+            "tool_engine": tool_engine_stats(),
+            "perplexity_cache": perplexity_cache_stats(),
+            "resilience": resilience_stats(),
+            "cancellation": cancellation_stats(),
+        }
+    )
 
 
-@APP.get("/")
-def root():
-    return jsonify(
+@ROUTES.get("/")
+async def root(request: web.Request):
+    return web.json_response(
         {
             "ok": True,
             "service": "perplexity_clone_shared_backend",
@@ -104,18 +131,24 @@ def root():
     )
 
 
-@APP.get("/api/session/<canonical_user_id>")
-def session(canonical_user_id: str):
-    uid = _normalize_canonical_user_id(canonical_user_id)
+@ROUTES.get("/api/session/{canonical_user_id}")
+async def session(request: web.Request):
+    uid = _normalize_canonical_user_id(request.match_info.get("canonical_user_id"))
     if not uid:
-        return jsonify({"message": "canonical_user_id is required"}), 400
-    bot_mode = str(request.args.get("bot_mode", "")).strip().lower()
-    return jsonify(_extract_session_payload(uid, bot_mode=bot_mode))
-
-
-@APP.post("/api/chat")
-def chat():
-    payload = request.get_json(silent=True) or {}
+        return web.json_response({"message": "canonical_user_id is required"}, status=400)
+    bot_mode = str(request.query.get("bot_mode", "")).strip().lower()
+    # History lookups are blocking pymongo/file reads; keep them off the event loop.
+    return web.json_response(await asyncio.to_thread(_extract_session_payload, uid, bot_mode))
+
+
+@ROUTES.post("/api/chat")
+async def chat(request: web.Request):
+    try:
+        payload = await request.json()
+    except Exception:
+        payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
     uid = _normalize_canonical_user_id(payload.get("canonical_user_id", ""))
     message = str(payload.get("message", "")).strip()
     source = str(payload.get("source", "web")).strip().lower() or "web"
@@ -123,19 +156,25 @@ def chat():
     stream_enabled = bool(payload.get("stream"))
 
     if not uid:
-        return jsonify({"message": "canonical_user_id is required"}), 400
+        return web.json_response({"message": "canonical_user_id is required"}, status=400)
     if not message:
-        return jsonify({"message": "message is required"}), 400
+        return web.json_response({"message": "message is required"}, status=400)
     if source not in {"web", "telegram"}:
-        return jsonify({"message": "source must be one of: web, telegram"}), 400
+        return web.json_response({"message": "source must be one of: web, telegram"}, status=400)
+
+    router = MessageRouter()
+    message_object = await asyncio.to_thread(
+        _build_message_object, uid=uid, message=message, source=source, bot_mode=bot_mode
+    )
 
     if not stream_enabled:
-        router = MessageRouter()
-        message_object = _build_message_object(uid=uid, message=message, source=source, bot_mode=bot_mode)
-        assistant_text = router.route_message(message_object=message_object)
-        session_payload = _extract_session_payload(uid, bot_mode=message_object.get("bot_mode"))
+        with request_deadline():
+            assistant_text = await router.route_message_async(message_object=message_object)
+        session_payload = await asyncio.to_thread(
+            _extract_session_payload, uid, message_object.get("bot_mode")
+        )
 
-        return jsonify(
+        return web.json_response(
             {
                 "canonical_user_id": uid,
                 "bot_mode": session_payload.get("bot_mode"),
@@ -148,77 +187,81 @@ def chat():
         )
 
     # Streaming mode: emit SSE content deltas as they are produced by MessageRouter/search_perplexity.
-    queue: Queue[tuple[str, dict]] = Queue()
+    # Before example: a worker thread pushed partials into a Queue that the WSGI generator drained.
+    # After example:  route_message_async is awaited here and each partial is written straight to the socket.
+    response = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+        }
+    )
+    await response.prepare(request)
 
-    def _run_stream() -> None:
-        try:
-            router = MessageRouter()
-            message_object = _build_message_object(uid=uid, message=message, source=source, bot_mode=bot_mode)
+    async def _write_event(event: str, data: dict) -> None:
+        await response.write(_sse(event, data).encode("utf-8"))
 
-            def _on_partial(partial_text: str) -> None:
-                queue.put(("partial", {"text": str(partial_text or "")}))
+    cancel_token = CancelToken()
 
-            assistant_text = router.route_message(
+    async def _on_delta(delta) -> None:
+        # Before example: each partial was the full text and the delta came from a startswith diff.
+        # After example:  the router's StreamDelta is forwarded as-is, e.g. {"seq": 3, "text": " wor", "reset": false}.
+        if cancel_token.is_cancelled():
+            return
+        try:
+            await _write_event("content", delta.to_dict())
+        except ConnectionResetError:
+            # The browser went away: stop paying for upstream tokens nobody will read.
+            cancel_token.cancel("client_disconnected")
+
+    try:
+        with request_deadline():
+            assistant_text = await router.route_message_async(
                 message_object=message_object,
                 stream=True,
-                stream_callback=_on_partial,
-            )
-            session_payload = _extract_session_payload(uid, bot_mode=message_object.get("bot_mode"))
-            queue.put(
-                (
-                    "done",
-                    {
-                        "canonical_user_id": uid,
-                        "bot_mode": session_payload.get("bot_mode"),
-                        "active_session_id": session_payload.get("active_session_id"),
-                        "assistant_text": assistant_text,
-                        "thinking": "",
-                        "sources": [],
-                        "message_count": session_payload.get("message_count"),
-                    },
-                )
+                stream_callback=_on_delta,
+                cancel_token=cancel_token,
             )
-        except Exception as exc:
-            queue.put(("error", {"message": str(exc)}))
-        finally:
-            queue.put(("eof", {}))
-
-    Thread(target=_run_stream, daemon=True).start()
-
-    def _generate():
-        last_partial = ""
-        while True:
-            kind, data = queue.get()
-            if kind == "partial":
-                partial = str(data.get("text", ""))
-                delta = partial[len(last_partial):] if partial.startswith(last_partial) else partial
-                last_partial = partial
-                if delta:
-                    yield _sse("content", {"text": delta})
-                continue
-            if kind == "done":
-                full_text = str(data.get("assistant_text", ""))
-                remaining = full_text[len(last_partial):] if full_text.startswith(last_partial) else full_text
-                if remaining:
-                    yield _sse("content", {"text": remaining})
-                yield _sse("done", data)
-                continue
-            if kind == "error":
-                yield _sse("error", data)
-                continue
-            if kind == "eof":
-                break
-
-    return Response(
-        stream_with_context(_generate()),
-        mimetype="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        },
-    )
+        session_payload = await asyncio.to_thread(
+            _extract_session_payload, uid, message_object.get("bot_mode")
+        )
+        await _write_event(
+            "done",
+            {
+                "canonical_user_id": uid,
+                "bot_mode": session_payload.get("bot_mode"),
+                "active_session_id": session_payload.get("active_session_id"),
+                "assistant_text": assistant_text,
+                "thinking": "",
+                "sources": [],
+                "message_count": session_payload.get("message_count"),
+            },
+        )
+    except Exception as exc:
+        await _write_event("error", {"message": str(exc)})
+
+    await response.write_eof()
+    return response
+
+
+async def _close_pooled_clients(app: web.Application) -> None:
+    await close_async_clients()
+
+
+async def _prewarm_pooled_clients(app: web.Application) -> None:
+    if os.getenv("HTTP_PREWARM", "1").strip().lower() in {"0", "false", "no", "off"}:
+        return
+    await prewarm_async_clients(("xai", "perplexity"))
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.add_routes(ROUTES)
+    app.on_startup.append(_prewarm_pooled_clients)
+    app.on_cleanup.append(_close_pooled_clients)
+    return app
 
 
 if __name__ == "__main__":
-    APP.run(host="0.0.0.0", port=_resolve_port(), debug=False)
+    web.run_app(create_app(), host="0.0.0.0", port=_resolve_port())
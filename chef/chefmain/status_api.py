@@ -1,9 +1,16 @@
+import hashlib
+import json
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 
 from flask import Flask, jsonify, request
-from pymongo import MongoClient, DESCENDING
+from pymongo import DESCENDING
+
+from utilities.mongo_clients import get_mongo_client, get_mongo_pool_stats
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
@@ -14,6 +21,38 @@ MONGODB_URI = os.getenv("MONGODB_URI", "")
 DB_NAME = os.getenv("MONGODB_DB_NAME", "chef_chatbot")
 COLLECTION_NAME = os.getenv("MONGODB_COLLECTION_NAME", "user_recipe_status")
 
+# Before: every poll ran a sorted find_one. After: polls are served from memory; a change stream
+# on user_recipe_status invalidates entries, and STATUS_CACHE_TTL_SEC bounds staleness when change
+# streams are unavailable (standalone mongod, missing privileges).
+STATUS_CACHE_TTL_SEC = float(os.getenv("STATUS_CACHE_TTL_SEC", "3"))
+# Safety net even with a healthy change stream (missed events, clock skew).
+STATUS_CACHE_MAX_AGE_SEC = float(os.getenv("STATUS_CACHE_MAX_AGE_SEC", "300"))
+STATUS_CHANGE_STREAM_ENABLED = os.getenv("STATUS_CHANGE_STREAM", "1").strip().lower() not in {"0", "false", "no", "off"}
+STATUS_LONG_POLL_MAX_SEC = float(os.getenv("STATUS_LONG_POLL_MAX_SEC", "30"))
+# Without a change stream, long-poll waiters re-check Mongo this often.
+STATUS_LONG_POLL_INTERVAL_SEC = float(os.getenv("STATUS_LONG_POLL_INTERVAL_SEC", "1"))
+# LRU bound: user_id comes from the query string, so any key holder could otherwise grow the cache.
+STATUS_CACHE_MAX_ENTRIES = int(os.getenv("STATUS_CACHE_MAX_ENTRIES", "10000"))
+# Re-reads allowed when an invalidation lands while a miss is reading Mongo.
+STATUS_FETCH_RACE_RETRIES = 2
+
+_status_cache = OrderedDict()
+_status_versions = {}
+# Bumped by invalidate_status(None); covers users that have no _status_versions entry yet.
+_status_epoch = [0]
+_status_changed = threading.Condition()
+_watcher_thread = None
+_watcher_state = {"running": False, "available": None, "events": 0, "errors": 0}
+_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "not_modified": 0,
+    "long_polls": 0,
+    "long_poll_wakeups": 0,
+    "fetch_races": 0,
+    "evictions": 0,
+}
+
 # Before: GET /latest_status?user_id=123 with header x-api-key: mysecret
 # After:  {"user_id":"123","latest_step":"chop onions","updated_at":"2026-01-28T18:42:00Z"}
 
@@ -30,6 +69,156 @@ def _extract_api_key(req):
     return ""
 
 
+def _get_status_collection():
+    # Before: MongoClient(...) opened and closed per request. After: the shared pooled client.
+    return get_mongo_client(MONGODB_URI)[DB_NAME][COLLECTION_NAME]
+
+
+def _fetch_latest_status(user_id):
+    # Before: doc={"user_id":"123","latest_step":"whisk eggs","updated_at": datetime}
+    # After:  payload={"user_id":"123","latest_step":"whisk eggs","updated_at":"2026-01-28T18:42:00Z"}
+    doc = _get_status_collection().find_one({"user_id": user_id}, sort=[("updated_at", DESCENDING)])
+    if not doc:
+        return {"user_id": user_id, "latest_step": None, "updated_at": None}
+
+    latest_step = doc.get("latest_step") or doc.get("step") or doc.get("status")
+    updated_at = doc.get("updated_at") or doc.get("created_at")
+    if isinstance(updated_at, datetime):
+        updated_at = updated_at.isoformat()
+    return {"user_id": user_id, "latest_step": latest_step, "updated_at": updated_at}
+
+
+def _etag_for(payload):
+    digest = hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f'"{digest[:20]}"'
+
+
+def _cache_ttl():
+    return STATUS_CACHE_MAX_AGE_SEC if _watcher_state["running"] else STATUS_CACHE_TTL_SEC
+
+
+def _status_version(user_id):
+    return _status_epoch[0], _status_versions.get(user_id, 0)
+
+
+def get_latest_status(user_id):
+    """Return (payload, etag) for ``user_id``, from the cache when it is still fresh."""
+    _ensure_watcher()
+    with _status_changed:
+        entry = _status_cache.get(user_id)
+        if entry is not None and time.monotonic() - entry["fetched_at"] < _cache_ttl():
+            _status_cache.move_to_end(user_id)
+            _cache_stats["hits"] += 1
+            return entry["payload"], entry["etag"]
+    _cache_stats["misses"] += 1
+    for attempt in range(STATUS_FETCH_RACE_RETRIES + 1):
+        with _status_changed:
+            version = _status_version(user_id)
+        payload = _fetch_latest_status(user_id)
+        etag = _etag_for(payload)
+        with _status_changed:
+            if _status_version(user_id) != version:
+                # Before example: invalidate_status landed between find_one and this write, and the
+                #                 pre-change payload was then served for STATUS_CACHE_MAX_AGE_SEC.
+                # After example:  the read is discarded and repeated.
+                _cache_stats["fetch_races"] += 1
+                if attempt < STATUS_FETCH_RACE_RETRIES:
+                    continue
+                # Still racing a busy writer: answer with this read but do not cache it.
+                return payload, etag
+            previous = _status_cache.get(user_id)
+            _status_cache[user_id] = {"payload": payload, "etag": etag, "fetched_at": time.monotonic()}
+            _status_cache.move_to_end(user_id)
+            while len(_status_cache) > max(1, STATUS_CACHE_MAX_ENTRIES):
+                _status_cache.popitem(last=False)
+                _cache_stats["evictions"] += 1
+            if previous is not None and previous["etag"] != etag:
+                # A TTL refetch found a new step: wake long-poll waiters too.
+                _status_versions[user_id] = _status_versions.get(user_id, 0) + 1
+                _status_changed.notify_all()
+        return payload, etag
+
+
+def invalidate_status(user_id=None):
+    """Drop cached status (one user or all) and wake matching long-poll waiters."""
+    with _status_changed:
+        if user_id is None:
+            _status_cache.clear()
+            _status_epoch[0] += 1
+            for key in list(_status_versions):
+                _status_versions[key] += 1
+        else:
+            _status_cache.pop(user_id, None)
+            _status_versions[user_id] = _status_versions.get(user_id, 0) + 1
+        _status_changed.notify_all()
+
+
+def _wait_for_new_status(user_id, etag, timeout):
+    """Block until ``user_id``'s status differs from ``etag`` or ``timeout`` elapses."""
+    deadline = time.monotonic() + timeout
+    while True:
+        payload, current = get_latest_status(user_id)
+        remaining = deadline - time.monotonic()
+        if current != etag or remaining <= 0:
+            return payload, current
+        with _status_changed:
+            version = _status_versions.get(user_id, 0)
+            # With a change stream we sleep until notified; otherwise re-check every interval.
+            wait_for = remaining if _watcher_state["running"] else min(remaining, STATUS_LONG_POLL_INTERVAL_SEC)
+            woke = _status_changed.wait_for(lambda: _status_versions.get(user_id, 0) != version, timeout=wait_for)
+        if woke:
+            _cache_stats["long_poll_wakeups"] += 1
+        elif not _watcher_state["running"]:
+            # Force the next get_latest_status to re-read Mongo instead of the TTL cache.
+            _status_cache.pop(user_id, None)
+
+
+def _watch_status_changes():
+    resume_token = None
+    backoff = 1.0
+    while True:
+        try:
+            pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+            with _get_status_collection().watch(
+                pipeline, full_document="updateLookup", resume_after=resume_token
+            ) as stream:
+                _watcher_state["running"] = True
+                _watcher_state["available"] = True
+                backoff = 1.0
+                logging.info("status_change_stream started collection=%s", COLLECTION_NAME)
+                for change in stream:
+                    resume_token = stream.resume_token
+                    _watcher_state["events"] += 1
+                    user_id = (change.get("fullDocument") or {}).get("user_id")
+                    # Deletes carry no fullDocument, so drop everything rather than guess the user.
+                    invalidate_status(str(user_id) if user_id is not None else None)
+        except Exception as exc:
+            _watcher_state["running"] = False
+            _watcher_state["errors"] += 1
+            message = str(exc)
+            if "replica set" in message.lower() or isinstance(exc, NotImplementedError):
+                # Example: standalone mongod -> "$changeStream stage is only supported on replica sets".
+                _watcher_state["available"] = False
+                logging.warning("status_change_stream unavailable, using TTL=%ss error=%s", STATUS_CACHE_TTL_SEC, exc)
+                return
+            logging.warning("status_change_stream error=%s retry_in=%ss", exc, backoff)
+            invalidate_status()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+
+def _ensure_watcher():
+    global _watcher_thread
+    if not STATUS_CHANGE_STREAM_ENABLED or _watcher_state["available"] is False:
+        return
+    if _watcher_thread is not None and _watcher_thread.is_alive():
+        return
+    with _status_changed:
+        if _watcher_thread is None or not _watcher_thread.is_alive():
+            _watcher_thread = threading.Thread(target=_watch_status_changes, name="status-change-stream", daemon=True)
+            _watcher_thread.start()
+
+
 @app.get("/latest_status")
 def latest_status():
     if not API_KEY:
@@ -46,27 +235,44 @@ def latest_status():
     if not user_id:
         return jsonify({"error": "user_id required"}), 400
 
-    # Before: doc={"user_id":"123","latest_step":"whisk eggs","updated_at": datetime}
-    # After:  response={"user_id":"123","latest_step":"whisk eggs","updated_at":"2026-01-28T18:42:00Z"}
-    client = MongoClient(MONGODB_URI)
+    # Before: devices polled every second. After example:
+    #   GET /latest_status?user_id=123&wait=25  with  If-None-Match: "9b1c..."
+    #   -> blocks until the step changes (200 + new ETag) or 25s pass (304).
+    known_etag = request.headers.get("If-None-Match", "").strip()
     try:
-        collection = client[DB_NAME][COLLECTION_NAME]
-        doc = collection.find_one({"user_id": user_id}, sort=[("updated_at", DESCENDING)])
-    finally:
-        client.close()
+        wait_sec = min(max(float(request.args.get("wait", "0") or 0), 0.0), STATUS_LONG_POLL_MAX_SEC)
+    except ValueError:
+        return jsonify({"error": "wait must be a number of seconds"}), 400
 
-    if not doc:
-        return jsonify({"user_id": user_id, "latest_step": None, "updated_at": None}), 200
+    if wait_sec and known_etag:
+        _cache_stats["long_polls"] += 1
+        payload, etag = _wait_for_new_status(user_id, known_etag, wait_sec)
+    else:
+        payload, etag = get_latest_status(user_id)
+
+    if known_etag and known_etag == etag:
+        _cache_stats["not_modified"] += 1
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(payload)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
-    latest_step = doc.get("latest_step") or doc.get("step") or doc.get("status")
-    updated_at = doc.get("updated_at") or doc.get("created_at")
-    if isinstance(updated_at, datetime):
-        updated_at = updated_at.isoformat()
 
-    return jsonify({"user_id": user_id, "latest_step": latest_step, "updated_at": updated_at}), 200
+@app.get("/health")
+def health():
+    # Example: {"ok": true, "mongo_pools": {"cluster0.abc.mongodb.net": {"open_connections": 2, "in_use": 0, ...}}}
+    return jsonify(
+        {
+            "ok": True,
+            "mongo_pools": get_mongo_pool_stats(),
+            "status_cache": {**_cache_stats, "entries": len(_status_cache), "change_stream": dict(_watcher_state)},
+        }
+    ), 200
 
 
 if __name__ == "__main__":
     # Before: STATUS_API_KEY=mysecret MONGODB_URI=... python status_api.py
-    # After:  Server runs on http://127.0.0.1:5000
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5000")))
+    # After:  Server runs on http://127.0.0.1:5000 (threaded, so long-polls don't block other requests)
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", "5000")), threaded=True)
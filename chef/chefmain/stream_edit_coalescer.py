@@ -0,0 +1,149 @@
+"""Adaptive edit coalescing for the single-message Telegram stream.
+
+Before example: the editor woke on every token, edited at most every 0.35s no matter
+how long the answer was, and kept editing at that pace right after a 429.
+After example:  ``StreamEditCoalescer`` shows the first text right away, then
+- waits longer between edits as the message grows and after recent 429s,
+- spends from a per-chat edit budget shared by every stream in that chat,
+- skips edits whose rendered text did not change,
+- always flushes the final text in ``finish()``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from telegram_delivery import TokenBucket, recent_rate_limits
+from utilities.stream_protocol import DeltaAccumulator, StreamDelta
+
+logger = logging.getLogger(__name__)
+
+STREAM_EDIT_BASE_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_BASE_INTERVAL_SEC", "0.6"))
+STREAM_EDIT_MAX_INTERVAL_SEC = float(os.getenv("STREAM_EDIT_MAX_INTERVAL_SEC", "4.0"))
+# Every this many characters adds one base interval to the gap between edits.
+STREAM_EDIT_CHARS_PER_STEP = int(os.getenv("STREAM_EDIT_CHARS_PER_STEP", "1000"))
+STREAM_EDIT_BUDGET_PER_MIN = float(os.getenv("STREAM_EDIT_BUDGET_PER_MIN", "30"))
+STREAM_EDIT_BUDGET_BURST = float(os.getenv("STREAM_EDIT_BUDGET_BURST", "5"))
+
+# LRU bound on remembered budgets; an evicted chat has been idle long enough to be back at full burst.
+STREAM_EDIT_BUDGET_MAX_CHATS = int(os.getenv("STREAM_EDIT_BUDGET_MAX_CHATS", "1000"))
+
+# chat_id -> TokenBucket; overlapping streams in one chat share a budget.
+_chat_edit_budgets: OrderedDict = OrderedDict()
+
+
+def _edit_budget(chat_id) -> TokenBucket:
+    bucket = _chat_edit_budgets.get(chat_id)
+    if bucket is None:
+        bucket = TokenBucket(STREAM_EDIT_BUDGET_PER_MIN / 60.0, STREAM_EDIT_BUDGET_BURST)
+        _chat_edit_budgets[chat_id] = bucket
+        while len(_chat_edit_budgets) > max(1, STREAM_EDIT_BUDGET_MAX_CHATS):
+            _chat_edit_budgets.popitem(last=False)
+    else:
+        _chat_edit_budgets.move_to_end(chat_id)
+    return bucket
+
+
+def edit_interval_for(text_length: int, recent_429s: int = 0) -> float:
+    """Seconds to wait after an edit, e.g. 0.6s for a short answer, ~1.8s at 2000 chars."""
+    steps = 1 + (max(0, text_length) / max(1, STREAM_EDIT_CHARS_PER_STEP))
+    interval = STREAM_EDIT_BASE_INTERVAL_SEC * steps * (2 ** min(max(0, recent_429s), 3))
+    return min(STREAM_EDIT_MAX_INTERVAL_SEC, interval)
+
+
+class StreamEditCoalescer:
+    def __init__(self, chat_id, send_edit, render=None, rate_limit_probe=None):
+        """``send_edit`` is ``async (text) -> None``; ``render`` maps the latest text to what is shown."""
+        self.chat_id = chat_id
+        self._send_edit = send_edit
+        self._render = render or (lambda text: text)
+        self._rate_limit_probe = rate_limit_probe or recent_rate_limits
+        self._accumulator = DeltaAccumulator()
+        self._last_sent = None
+        self._next_edit_at = 0.0
+        self._changed = asyncio.Event()
+        self._task = None
+        self.stats = {"updates": 0, "edits": 0, "skipped_noop": 0, "first_edit_ms": None}
+        self._started_at = time.monotonic()
+
+    def apply_delta(self, delta: StreamDelta) -> None:
+        """Append one streamed delta; safe to call on every token (no join happens here)."""
+        if self._accumulator.apply(delta):
+            self.stats["updates"] += 1
+            self._changed.set()
+
+    def update(self, text: str) -> None:
+        """Replace the whole text (for producers that only have full snapshots)."""
+        self.apply_delta(StreamDelta(self._accumulator.last_seq + 1, str(text or ""), reset=True))
+
+    @property
+    def latest_text(self) -> str:
+        return self._accumulator.text
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            wait = self._next_edit_at - time.monotonic()
+            if wait > 0:
+                # Tokens that arrive while we wait are folded into this edit.
+                await asyncio.sleep(wait)
+            latest = self._accumulator.text
+            if not latest or self._render(latest) == self._last_sent:
+                # No-op edits never spend budget.
+                self.stats["skipped_noop"] += 1
+                continue
+            budget_wait = _edit_budget(self.chat_id).reserve()
+            if budget_wait > 0:
+                await asyncio.sleep(budget_wait)
+            await self._edit(self._accumulator.text)
+
+    async def _edit(self, raw_text: str) -> None:
+        if not raw_text:
+            return
+        text = self._render(raw_text)
+        if text == self._last_sent:
+            self.stats["skipped_noop"] += 1
+            return
+        await self._send_edit(text)
+        self._last_sent = text
+        self.stats["edits"] += 1
+        if self.stats["first_edit_ms"] is None:
+            self.stats["first_edit_ms"] = int((time.monotonic() - self._started_at) * 1000)
+        recent_429s = self._rate_limit_probe(self.chat_id)
+        self._next_edit_at = time.monotonic() + edit_interval_for(len(raw_text), recent_429s)
+
+    async def finish(self, final_text: str) -> None:
+        """Stop live edits and always show ``final_text`` (already rendered by the caller)."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        final_text = str(final_text or "")
+        if final_text and final_text == self._last_sent:
+            self.stats["skipped_noop"] += 1
+        elif final_text:
+            # The final flush is never dropped; it still counts against the chat's budget.
+            _edit_budget(self.chat_id).reserve()
+            await self._send_edit(final_text)
+            self._last_sent = final_text
+            self.stats["edits"] += 1
+        logger.info(
+            "stream_edit_summary chat_id=%s updates=%s edits=%s skipped_noop=%s first_edit_ms=%s",
+            self.chat_id,
+            self.stats["updates"],
+            self.stats["edits"],
+            self.stats["skipped_noop"],
+            self.stats["first_edit_ms"],
+        )
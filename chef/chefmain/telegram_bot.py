@@ -48,6 +48,13 @@ import requests
 from testscripts.openai_simple_ping import call_openai_hi
 from testscripts.xai_simple_ping import call_xai_hi
 from message_router import MessageRouter # Import MessageRouter
+from message_user import register_bot_token
+from turn_scheduler import TurnScheduler
+from utilities.cancellation import CancelToken
+from utilities.http_clients import prewarm_async_clients
+from utilities.resilience import request_deadline
+import telegram_delivery
+from stream_edit_coalescer import StreamEditCoalescer
 from utilities.firebase import firebase_get_media_url
 
 # Set up logging
@@ -73,9 +80,27 @@ message_router = None # Add global variable for the router
 # Global dictionary to store user contexts
 user_contexts = {}
 
+# Before example: concurrent updates could run two turns for one user at once and reorder history.
+# After example:  turns are FIFO per user, users run in parallel up to TURN_MAX_CONCURRENCY.
+turn_scheduler = TurnScheduler(max_concurrent_turns=int(os.getenv("TURN_MAX_CONCURRENCY", "16")))
+
+
+def _control_lane(command_handler):
+    """Wrap a command so it runs in the scheduler's fast lane ahead of queued turns."""
+
+    async def wrapped(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return await turn_scheduler.submit_control(
+            update.effective_user.id,
+            lambda: command_handler(update, context),
+        )
+
+    wrapped.__name__ = getattr(command_handler, "__name__", "control_command")
+    return wrapped
+
 # === INTERFACETEST-STYLE STREAMING BLOCK START (easy to undo) ===
 _general_stream_state_lock = threading.Lock()
 _general_stream_state_by_user = {}
+GENERAL_STREAM_TYPING_INTERVAL_SEC = 4.0
 
 
 def _is_general_edit_streaming_enabled() -> bool:
@@ -83,16 +108,22 @@ def _is_general_edit_streaming_enabled() -> bool:
     return os.getenv("GENERAL_EDIT_STREAMING", "1").strip().lower() not in {"0", "false", "no", "off"}
 
 
-def _stream_start_run(user_id: int) -> int:
+def _stream_start_run(user_id: int) -> tuple[int, CancelToken]:
     with _general_stream_state_lock:
         state = _general_stream_state_by_user.get(user_id) or {"run_id": 0, "active": False, "stop_requested": False}
+        previous_token = state.get("cancel_token") if state.get("active") else None
         run_id = int(state.get("run_id", 0)) + 1
+        cancel_token = CancelToken()
         _general_stream_state_by_user[user_id] = {
             "run_id": run_id,
             "active": True,
             "stop_requested": False,
+            "cancel_token": cancel_token,
         }
-        return run_id
+    if previous_token is not None:
+        # A newer run makes the old one stop; abort its upstream requests too.
+        previous_token.cancel("superseded")
+    return run_id, cancel_token
 
 
 def _stream_request_stop(user_id: int) -> bool:
@@ -102,7 +133,12 @@ def _stream_request_stop(user_id: int) -> bool:
             return False
         state["stop_requested"] = True
         _general_stream_state_by_user[user_id] = state
-        return True
+        cancel_token = state.get("cancel_token")
+    # Before example: only the flag above; the stream noticed it at the next SSE line.
+    # After example:  in-flight xAI/Perplexity responses are closed right now.
+    if cancel_token is not None:
+        cancel_token.cancel("stop")
+    return True
 
 
 def _stream_should_stop(user_id: int, run_id: int) -> bool:
@@ -165,134 +201,137 @@ def _split_telegram_text(text: str, limit: int = 3900) -> list[str]:
 
 
 async def _safe_edit_stream_message(bot, chat_id: int, message_id: int, text: str) -> None:
+    # Edits share the per-chat/global pacing of telegram_delivery with normal replies.
     try:
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=_clip_telegram_text(text))
+        result = await telegram_delivery.edit_message_text_async(
+            chat_id, message_id, _clip_telegram_text(text), bot.token
+        )
     except Exception as exc:
-        # Ignore "message is not modified" edit races while streaming.
-        if "message is not modified" not in str(exc).lower():
-            logging.warning("stream_edit_failed chat_id=%s message_id=%s error=%s", chat_id, message_id, exc)
+        result = {"ok": False, "description": str(exc)}
+    # Ignore "message is not modified" edit races while streaming.
+    if not result.get("ok") and "message is not modified" not in str(result.get("description", "")).lower():
+        logging.warning("stream_edit_failed chat_id=%s message_id=%s error=%s", chat_id, message_id, result)
+
+
+async def _deliver_stream_text(bot, chat_id: int, text: str, mergeable: bool = True):
+    """Send one message through telegram_delivery; returns its message_id or None.
+
+    The status message is sent with ``mergeable=False`` because every stream edit targets its id.
+    """
+    result = await telegram_delivery.send_message_async(chat_id, text, bot.token, mergeable=mergeable)
+    if not result.get("ok"):
+        logging.warning("stream_send_failed chat_id=%s error=%s", chat_id, result)
+        return None
+    return (result.get("result") or {}).get("message_id")
 
 
 async def _handle_general_single_message_stream(update: Update, context: ContextTypes.DEFAULT_TYPE, message_object: dict) -> None:
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
-    run_id = _stream_start_run(user_id)
+    run_id, cancel_token = _stream_start_run(user_id)
     logging.info(
         "tg_stream_start user_id=%s run_id=%s preview='%s'",
         user_id,
         run_id,
         str(message_object.get("user_message", ""))[:120],
     )
-    status_msg = None
+    status_message_id = None
     try:
-        status_msg = await update.message.reply_text(
-            "Thinking... streaming in one message. Send /stop to stop."
+        status_message_id = await _deliver_stream_text(
+            context.bot,
+            chat_id,
+            "Thinking... streaming in one message. Send /stop to stop.",
+            mergeable=False,
         )
     except Exception as exc:
         logging.warning("tg_stream_status_send_failed user_id=%s run_id=%s error=%s", user_id, run_id, exc)
 
-    stream_state = {
-        "latest_text": "",
-        "final_text": "",
-        "done": False,
-        "error": None,
-    }
-    state_lock = threading.Lock()
+    async def send_edit(text: str) -> None:
+        await _safe_edit_stream_message(context.bot, chat_id, status_message_id, text)
 
-    def stream_callback(partial_text: str) -> None:
-        with state_lock:
-            stream_state["latest_text"] = str(partial_text or "")
+    # Before example: an editor loop woke on every token and edited at a fixed 0.35s pace.
+    # After example:  the coalescer paces edits by length, recent 429s and a per-chat budget.
+    coalescer = StreamEditCoalescer(
+        chat_id,
+        send_edit,
+        render=lambda text: _preview_stream_text(text) + " ▌",
+    )
+
+    def stream_callback(delta) -> None:
+        # Router sends StreamDelta increments; the coalescer joins them only when it edits.
+        coalescer.apply_delta(delta)
 
     def should_stop() -> bool:
         return _stream_should_stop(user_id, run_id)
 
-    router_instance = MessageRouter()
-
-    def worker() -> None:
-        try:
-            final = router_instance.route_message(
-                message_object=message_object,
-                stream=True,
-                stream_callback=stream_callback,
-                should_stop=should_stop,
-            )
-            with state_lock:
-                stream_state["final_text"] = str(final or "")
-        except Exception as exc:
-            with state_lock:
-                stream_state["error"] = str(exc)
-        finally:
-            with state_lock:
-                stream_state["done"] = True
-
-    worker_task = asyncio.create_task(asyncio.to_thread(worker))
-
-    last_sent = ""
-    last_typing_at = 0.0
-    edit_count = 0
-    while True:
-        await asyncio.sleep(0.35)
-        now = time.monotonic()
-        with state_lock:
-            latest_text = stream_state["latest_text"]
-            done = bool(stream_state["done"])
-            error = stream_state["error"]
-            final_text = stream_state["final_text"]
-
-        if status_msg and latest_text and latest_text != last_sent:
-            preview = _preview_stream_text(latest_text)
-            await _safe_edit_stream_message(
-                context.bot,
-                chat_id,
-                status_msg.message_id,
-                preview + (" ▌" if not done else ""),
-            )
-            last_sent = latest_text
-            edit_count += 1
-
-        if now - last_typing_at >= 4.0 and not done:
+    async def typing_loop() -> None:
+        # Typing only matters until the first visible edit (e.g. while a tool call runs).
+        while coalescer.stats["edits"] == 0:
             try:
                 await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
             except Exception:
                 pass
-            last_typing_at = now
-
-        if done:
-            await worker_task
-            if error:
-                if status_msg:
-                    await _safe_edit_stream_message(
-                        context.bot,
-                        chat_id,
-                        status_msg.message_id,
-                        f"Streaming failed: {error}",
-                    )
-                else:
-                    await update.message.reply_text(f"Streaming failed: {error}")
-            else:
-                final_display = final_text or latest_text or "No output was generated."
-                chunks = _split_telegram_text(final_display)
-                if status_msg:
-                    await _safe_edit_stream_message(
-                        context.bot,
-                        chat_id,
-                        status_msg.message_id,
-                        chunks[0],
-                    )
-                    for chunk in chunks[1:]:
-                        await update.message.reply_text(chunk)
-                else:
-                    for chunk in chunks:
-                        await update.message.reply_text(chunk)
-                logging.info(
-                    "tg_stream_done user_id=%s run_id=%s edits=%s final_len=%s chunks=%s",
-                    user_id,
-                    run_id,
-                    edit_count,
-                    len(final_display),
-                    len(chunks),
-                )
-            break
+            await asyncio.sleep(GENERAL_STREAM_TYPING_INTERVAL_SEC)
+
+    router_instance = MessageRouter()
+    if status_message_id:
+        coalescer.start()
+    typing_task = asyncio.create_task(typing_loop())
+    final_text = ""
+    error = None
+    try:
+        final = await router_instance.route_message_async(
+            message_object=message_object,
+            stream=True,
+            stream_callback=stream_callback,
+            should_stop=should_stop,
+            cancel_token=cancel_token,
+        )
+        final_text = str(final or "")
+    except Exception as exc:
+        error = str(exc)
+    finally:
+        typing_task.cancel()
+        try:
+            await typing_task
+        except asyncio.CancelledError:
+            pass
+
+    latest_text = coalescer.latest_text
+    if error:
+        if status_message_id:
+            await coalescer.finish(f"Streaming failed: {error}")
+        else:
+            await _deliver_stream_text(context.bot, chat_id, f"Streaming failed: {error}")
+    else:
+        final_display = final_text or latest_text or "No output was generated."
+        chunks = _split_telegram_text(final_display)
+        if status_message_id:
+            await coalescer.finish(chunks[0])
+            for chunk in chunks[1:]:
+                await _deliver_stream_text(context.bot, chat_id, chunk)
+        else:
+            for chunk in chunks:
+                await _deliver_stream_text(context.bot, chat_id, chunk)
+        logging.info(
+            "tg_stream_done user_id=%s run_id=%s edits=%s skipped_noop=%s first_edit_ms=%s final_len=%s chunks=%s",
+            user_id,
+            run_id,
+            coalescer.stats["edits"],
+            coalescer.stats["skipped_noop"],
+            coalescer.stats["first_edit_ms"],
+            len(final_display),
+            len(chunks),
+        )
+    if cancel_token.is_cancelled():
+        # Example: tg_stream_stopped reason=stop release_ms=4 (time from /stop to sockets closed).
+        logging.info(
+            "tg_stream_stopped user_id=%s run_id=%s reason=%s release_ms=%s",
+            user_id,
+            run_id,
+            cancel_token.reason,
+            cancel_token.release_ms,
+        )
 
     _stream_finish_run(user_id, run_id)
 
@@ -301,7 +340,7 @@ async def stop_stream(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     stopped = _stream_request_stop(user_id)
     if stopped:
-        await update.message.reply_text("Stop requested. I will stop at the next safe checkpoint.")
+        await update.message.reply_text("Stop requested. Stopping now.")
     else:
         await update.message.reply_text("No active stream to stop.")
 # === INTERFACETEST-STYLE STREAMING BLOCK END ===
@@ -371,7 +410,7 @@ def _is_mode_switch_backfill_enabled() -> bool:
     raw = os.getenv("ENABLE_MEDIA_BACKFILL_ON_MODE_SWITCH", "0").strip().lower()
     return raw in {"1", "true", "yes", "on"}
 
-def get_user_handler(user_id, session_info, user_message, application_data=None):
+async def get_user_handler(user_id, session_info, user_message, application_data=None):
     """
     Creates or retrieves a user context dictionary.
     
@@ -387,6 +426,9 @@ def get_user_handler(user_id, session_info, user_message, application_data=None)
     Returns:
         A dictionary containing the user's context.
     """
+    # Before example: a mode-cache miss ran a blocking Mongo find_one on the event loop.
+    # After example:  the lookup runs in a worker thread, so other chats keep flowing meanwhile.
+    bot_mode = await asyncio.to_thread(get_user_bot_mode, user_id)
     if user_id not in user_contexts:
         # Create a new user context
         user_context = {
@@ -398,7 +440,7 @@ def get_user_handler(user_id, session_info, user_message, application_data=None)
             # After example: router sees this as a Telegram-origin turn for shared-session continuity.
             'source_interface': 'telegram',
             # Before: stale bot_mode stuck in memory; After: bot_mode is read fresh each message.
-            'bot_mode': get_user_bot_mode(user_id),
+            'bot_mode': bot_mode,
             # Add other relevant data here as needed
         }
         user_contexts[user_id] = user_context
@@ -411,8 +453,9 @@ def get_user_handler(user_id, session_info, user_message, application_data=None)
         user_context['user_message'] = user_message
         # Keep this explicit on every turn so prompt context remains stable.
         user_context['source_interface'] = 'telegram'
-        # Before: /1 switch updated Mongo but not in-memory context; After: syncs from Mongo every turn.
-        user_context['bot_mode'] = get_user_bot_mode(user_id)
+        # Before: /1 switch updated Mongo but not in-memory context; After: syncs every turn.
+        # The lookup is served by the mode-store cache, so this no longer costs a find_one per message.
+        user_context['bot_mode'] = bot_mode
     return user_context
 
 # def get_user_handler(user_id, application_data, session_info):
@@ -466,9 +509,19 @@ async def web_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"{base_url}/?uid={user_id}")
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Before example: two quick messages from one user could both enter message_history_process.
+    # After example:  the second message waits in that user's lane until the first turn finishes.
+    # The turn is only enqueued here (the lane worker task owns it), so this update's
+    # concurrent_updates slot is free again at once and /stop or other users never wait for it.
+    turn_scheduler.enqueue_turn(
+        update.effective_user.id,
+        lambda: _process_message_turn(update, context),
+    )
+
+
+async def _process_message_turn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.message.from_user.id
-        application_data = context.application
         user_input = update.message.text
         logging.info(f"handle_message start: user_id={user_id}, has_text={bool(update.message.text)}")
 
@@ -488,13 +541,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'last_name': update.message.from_user.last_name
         }
 
-        #store application token
-        with open(f"application_data_for_{session_info['user_id']}.txt", "w") as f:
-            f.write(str(application_data))
+        # Before example: every message wrote application_data_for_<user>.txt so replies could regex the token back out.
+        # After example:  setup_bot registers the token once with message_user; no per-turn disk I/O.
         
         # Pass session_info to get_user_handler
 
-        message_object = get_user_handler(user_id, session_info, user_input)
+        message_object = await get_user_handler(user_id, session_info, user_input)
 
 
         user_input = "" # Initialize user_input
@@ -683,7 +735,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Centralized call to agentchat and response handling for all types
         #status user handler class agent chat rather than passing the message
         
-        message_object =  get_user_handler(user_id, session_info, user_input)
+        message_object = await get_user_handler(user_id, session_info, user_input)
         # Example before/after: no user preview -> unclear payload; now logs first 200 chars.
         logging.info(f"handle_message: user_message_preview='{str(user_input)[:200]}'")
 
@@ -715,13 +767,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.info(f"handle_message: routing message for user_id={user_id}")
         # Before example: general mode sent a single final message only.
         # After example:  general mode can stream by editing one Telegram message.
-        if (
-            _is_general_edit_streaming_enabled()
-            and str(message_object.get("bot_mode", "")).strip().lower() == "general"
-        ):
-            await _handle_general_single_message_stream(update, context, message_object)
-        else:
-            router_instance_for_this_call.route_message(message_object=message_object)
+        # Before example: a stalled xAI/Perplexity connection held this turn for up to 180s per read.
+        # After example:  every provider call in the turn shares one RESILIENCE_REQUEST_DEADLINE_SEC budget.
+        with request_deadline():
+            if (
+                _is_general_edit_streaming_enabled()
+                and str(message_object.get("bot_mode", "")).strip().lower() == "general"
+            ):
+                await _handle_general_single_message_stream(update, context, message_object)
+            else:
+                # Before example: sync route_message froze every other chat until xAI answered.
+                # After example:  the turn is awaited, so other updates keep flowing meanwhile.
+                await router_instance_for_this_call.route_message_async(message_object=message_object)
         logging.info(f"Message object for user {user_id} passed to message router.")
         
             
@@ -847,7 +904,7 @@ def _reset_history_file(logs_dir: str, user_id: str) -> None:
 async def bot_mode_switch_cook(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Before example: /1 toggled modes; After example: /cook forces cheflog every time.
     user_id = update.effective_user.id
-    current_mode = get_user_bot_mode(str(user_id))
+    current_mode = await asyncio.to_thread(get_user_bot_mode, str(user_id))
     next_mode = "cheflog"
     try:
         session_info = await _apply_restart_flow(
@@ -865,7 +922,7 @@ async def bot_mode_switch_cook(update: Update, context: ContextTypes.DEFAULT_TYP
 async def bot_mode_switch_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Before example: /1 toggled modes; After example: /log forces dietlog every time.
     user_id = update.effective_user.id
-    current_mode = get_user_bot_mode(str(user_id))
+    current_mode = await asyncio.to_thread(get_user_bot_mode, str(user_id))
     next_mode = "dietlog"
     try:
         session_info = await _apply_restart_flow(
@@ -884,7 +941,7 @@ async def bot_mode_switch_general(update: Update, context: ContextTypes.DEFAULT_
     # Before example: /general fell through to normal chat mode.
     # After example:  /general forces general mode every time.
     user_id = update.effective_user.id
-    current_mode = get_user_bot_mode(str(user_id))
+    current_mode = await asyncio.to_thread(get_user_bot_mode, str(user_id))
     next_mode = "general"
     if current_mode == next_mode:
         # Before example: /general in general mode still reset session and added avoidable latency.
@@ -959,6 +1016,15 @@ async def xai_simple(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 #setup bot loads message handler commands into application
+async def _prewarm_http_clients(app: Application) -> None:
+    # Before example: the first turn after a deploy paid DNS + TCP + TLS to xAI and Perplexity.
+    # After example:  pools on the bot loop (and the delivery loop) are opened at startup.
+    if os.getenv("HTTP_PREWARM", "1").strip().lower() in {"0", "false", "no", "off"}:
+        return
+    telegram_delivery.prewarm()
+    await prewarm_async_clients(("xai", "perplexity"))
+
+
 def setup_bot() -> Application:
     environment = os.getenv("ENVIRONMENT", "development")
     runtime = detect_runtime()
@@ -984,28 +1050,36 @@ def setup_bot() -> Application:
         raise ValueError("No Telegram token found; check environment variables.")
     
     global application, message_router # Add message_router to global declaration
+    register_bot_token(token)
     builder = Application.builder().token(token)
-    if _is_general_edit_streaming_enabled():
-        # Before example: updates were handled one-by-one, delaying /stop during streaming.
-        # After example:  concurrent updates allow /stop while a stream is in progress.
-        builder = builder.concurrent_updates(8)
+    # Before example: concurrent_updates(8) only with edit streaming, and same-user turns could interleave.
+    # After example:  concurrency is always on; turn_scheduler keeps per-user order and bounds LLM turns.
+    builder = builder.concurrent_updates(int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "64")))
+    builder = builder.post_init(_prewarm_http_clients)
     application = builder.build()
+
+    # Control commands take the scheduler fast lane so they never wait behind a long turn.
+    cook_command = _control_lane(bot_mode_switch_cook)
+    log_command = _control_lane(bot_mode_switch_log)
+    general_command = _control_lane(bot_mode_switch_general)
+    restart_command = _control_lane(restart)
+    stop_command = _control_lane(stop_stream)
     
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("cook", bot_mode_switch_cook))
-    application.add_handler(CommandHandler("log", bot_mode_switch_log))
-    application.add_handler(CommandHandler("general", bot_mode_switch_general))
+    application.add_handler(CommandHandler("cook", cook_command))
+    application.add_handler(CommandHandler("log", log_command))
+    application.add_handler(CommandHandler("general", general_command))
     application.add_handler(CommandHandler("web", web_link))
-    application.add_handler(CommandHandler("1", bot_mode_switch_log))
-    application.add_handler(CommandHandler("restart", restart))
-    application.add_handler(CommandHandler("stop", stop_stream))
+    application.add_handler(CommandHandler("1", log_command))
+    application.add_handler(CommandHandler("restart", restart_command))
+    application.add_handler(CommandHandler("stop", stop_command))
     # Before example: "/restart@chefbot" or " /restart" skipped; After example: those match too.
-    application.add_handler(MessageHandler(filters.Regex(r"^\s*/restart(?:@\w+)?(\s|$)"), restart))
-    application.add_handler(MessageHandler(filters.Regex(r"^\s*/cook(?:@\w+)?(\s|$)"), bot_mode_switch_cook))
-    application.add_handler(MessageHandler(filters.Regex(r"^\s*/(log|1)(?:@\w+)?(\s|$)"), bot_mode_switch_log))
-    application.add_handler(MessageHandler(filters.Regex(r"^\s*/general(?:@\w+)?(\s|$)"), bot_mode_switch_general))
+    application.add_handler(MessageHandler(filters.Regex(r"^\s*/restart(?:@\w+)?(\s|$)"), restart_command))
+    application.add_handler(MessageHandler(filters.Regex(r"^\s*/cook(?:@\w+)?(\s|$)"), cook_command))
+    application.add_handler(MessageHandler(filters.Regex(r"^\s*/(log|1)(?:@\w+)?(\s|$)"), log_command))
+    application.add_handler(MessageHandler(filters.Regex(r"^\s*/general(?:@\w+)?(\s|$)"), general_command))
     application.add_handler(MessageHandler(filters.Regex(r"^\s*/web(?:@\w+)?(\s|$)"), web_link))
-    application.add_handler(MessageHandler(filters.Regex(r"^\s*/stop(?:@\w+)?(\s|$)"), stop_stream))
+    application.add_handler(MessageHandler(filters.Regex(r"^\s*/stop(?:@\w+)?(\s|$)"), stop_command))
     application.add_handler(CommandHandler("openai_ping", openai_ping))
     application.add_handler(CommandHandler("openai_version", openai_version))
     application.add_handler(CommandHandler("build_version", build_version))
@@ -1088,7 +1162,9 @@ async def send_message_job(context: ContextTypes.DEFAULT_TYPE):
     
     if user_id in handlers_per_user:
         handler = handlers_per_user[user_id]
-        await context.bot.send_message(chat_id=user_id, text=message)
+        result = await telegram_delivery.send_message_async(user_id, message, context.bot.token)
+        if not result.get("ok"):
+            logging.warning(f"Scheduled message to {user_id} failed: {result}")
     else:
         logging.warning(f"No AIHandler instance found for user_id: {user_id}")
 
@@ -0,0 +1,340 @@
+"""Rate-limit-aware outbound Telegram delivery queue.
+
+Before example: send_telegram_message posted chunks back-to-back, bursts hit
+Telegram's ~1 msg/sec per chat and ~30 msg/sec global limits, and 429s dropped chunks.
+After example:  every sendMessage/editMessageText goes through one queue that
+- waits on a per-chat and a global token bucket before each call,
+- honors ``parameters.retry_after`` from 429 responses and retries the same item,
+- merges short pending sends for one chat into one message and keeps only the
+  newest pending edit per message (sends whose message_id is edited later pass
+  ``mergeable=False``),
+- records queue depth and enqueue->send delay (see ``get_delivery_metrics``).
+
+The queue runs on its own event loop thread so sync callers (``future.result()``)
+and async callers (``await send_message_async(...)``) share the same limits.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    from utilities.http_clients import get_async_client, prewarm_async_clients
+except ModuleNotFoundError:
+    from http_clients import get_async_client, prewarm_async_clients  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MAX_MESSAGE_CHARS = 4000
+# 429 history per chat is kept this long (the stream coalescer looks back 60s by default).
+RATE_LIMIT_MEMORY_SEC = float(os.getenv("TELEGRAM_RATE_LIMIT_MEMORY_SEC", "300"))
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of blocking.
+
+    Example: rate=1, capacity=1 -> reserve() returns 0.0, then ~1.0, then ~2.0 if
+    called three times in the same instant.
+    """
+
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = float(rate_per_sec)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def reserve(self, now: float | None = None) -> float:
+        """Take one token and return how many seconds to wait before using it."""
+        now = time.monotonic() if now is None else now
+        elapsed = max(0.0, now - self.updated_at)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+        self.tokens -= 1.0
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class _ChatLane:
+    def __init__(self, rate_per_sec: float, burst: float):
+        self.pending = deque()
+        self.bucket = TokenBucket(rate_per_sec, burst)
+        self.blocked_until = 0.0
+        self.worker = None
+
+
+class TelegramDeliveryQueue:
+    def __init__(
+        self,
+        per_chat_rate: float = 1.0,
+        per_chat_burst: float = 3.0,
+        global_rate: float = 30.0,
+        max_retries: int = 5,
+    ):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._lanes: dict = {}
+        # chat_id -> monotonic timestamps of recent 429s (read by the stream edit coalescer).
+        self._rate_limit_events: dict = {}
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self.metrics = {
+            "enqueued": 0,
+            "sent": 0,
+            "failed": 0,
+            "merged_sends": 0,
+            "superseded_edits": 0,
+            "rate_limited": 0,
+            "total_delay_ms": 0,
+            "max_delay_ms": 0,
+        }
+
+    # --- loop management -------------------------------------------------
+
+    def _ensure_loop(self):
+        with self._loop_lock:
+            if self._loop is not None and self._loop.is_running():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def _run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.run_forever()
+
+            threading.Thread(target=_run, name="telegram-delivery", daemon=True).start()
+            ready.wait()
+            self._loop = loop
+            return loop
+
+    def prewarm(self):
+        """Open the pooled Telegram connection on the delivery loop; returns a Future."""
+        loop = self._ensure_loop()
+        return asyncio.run_coroutine_threadsafe(prewarm_async_clients(("telegram",)), loop)
+
+    def submit(self, method: str, chat_id, payload: dict, token: str, mergeable: bool = True):
+        """Queue one Bot API call; returns a concurrent.futures.Future with Telegram's JSON reply.
+
+        ``mergeable=False`` keeps a sendMessage in its own message, so the message_id in the reply
+        belongs to this text alone (e.g. a status line that streaming edits will overwrite).
+        """
+        future = concurrent.futures.Future()
+        loop = self._ensure_loop()
+        loop.call_soon_threadsafe(self._enqueue, method, chat_id, dict(payload), token, future, mergeable)
+        return future
+
+    # --- queue internals (run on the delivery loop) ------------------------
+
+    def _enqueue(self, method: str, chat_id, payload: dict, token: str, future, mergeable: bool = True) -> None:
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = _ChatLane(self.per_chat_rate, self.per_chat_burst)
+            self._lanes[chat_id] = lane
+        self.metrics["enqueued"] += 1
+        now = time.monotonic()
+
+        if not self._merge_into_pending(lane, method, payload, token, future, mergeable):
+            lane.pending.append(
+                {
+                    "method": method,
+                    "chat_id": chat_id,
+                    "payload": payload,
+                    "token": token,
+                    "futures": [future],
+                    "enqueued_at": now,
+                    "attempts": 0,
+                    "mergeable": mergeable,
+                }
+            )
+        if lane.worker is None or lane.worker.done():
+            lane.worker = asyncio.ensure_future(self._drain_lane(chat_id, lane))
+
+    def _merge_into_pending(self, lane: _ChatLane, method, payload, token, future, mergeable: bool = True) -> bool:
+        if method == "editMessageText":
+            # Before example: every streamed token queued its own edit.
+            # After example:  a newer edit for the same message replaces the unsent one.
+            for item in lane.pending:
+                if (
+                    item["method"] == "editMessageText"
+                    and item["token"] == token
+                    and item["payload"].get("message_id") == payload.get("message_id")
+                ):
+                    item["payload"]["text"] = payload.get("text", "")
+                    item["futures"].append(future)
+                    self.metrics["superseded_edits"] += 1
+                    return True
+            return False
+        if method != "sendMessage" or not mergeable or not lane.pending:
+            return False
+        last = lane.pending[-1]
+        # Before example: "Thinking..." merged behind a queued reminder, both got one message_id,
+        #                 and the stream edits overwrote the reminder.
+        # After example:  a send whose message_id is edited later never shares a message.
+        if last["method"] != "sendMessage" or last["token"] != token or not last["mergeable"]:
+            return False
+        if set(last["payload"].keys()) != {"chat_id", "text"} or set(payload.keys()) != {"chat_id", "text"}:
+            return False
+        combined = f"{last['payload']['text']}\n\n{payload.get('text', '')}"
+        if len(combined) > TELEGRAM_MAX_MESSAGE_CHARS:
+            return False
+        last["payload"]["text"] = combined
+        last["futures"].append(future)
+        self.metrics["merged_sends"] += 1
+        return True
+
+    async def _drain_lane(self, chat_id, lane: _ChatLane) -> None:
+        while lane.pending:
+            item = lane.pending[0]
+            now = time.monotonic()
+            wait = max(0.0, lane.blocked_until - now)
+            if wait:
+                await asyncio.sleep(wait)
+            wait = lane.bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+            wait = self._global_bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+
+            # The item may have absorbed merges while we waited; send its latest payload.
+            lane.pending.popleft()
+            result, retry_after = await self._post(item)
+            if retry_after is not None and item["attempts"] < self.max_retries:
+                item["attempts"] += 1
+                self.metrics["rate_limited"] += 1
+                self._rate_limit_events.setdefault(chat_id, deque(maxlen=16)).append(time.monotonic())
+                lane.blocked_until = time.monotonic() + retry_after
+                logger.warning(
+                    "tg_delivery_rate_limited chat_id=%s method=%s retry_after=%s attempt=%s",
+                    chat_id,
+                    item["method"],
+                    retry_after,
+                    item["attempts"],
+                )
+                lane.pending.appendleft(item)
+                continue
+
+            delay_ms = int((time.monotonic() - item["enqueued_at"]) * 1000)
+            self.metrics["total_delay_ms"] += delay_ms
+            self.metrics["max_delay_ms"] = max(self.metrics["max_delay_ms"], delay_ms)
+            if result.get("ok"):
+                self.metrics["sent"] += 1
+            else:
+                self.metrics["failed"] += 1
+            logger.info(
+                "tg_delivery_done chat_id=%s method=%s ok=%s delay_ms=%s queue_depth=%s",
+                chat_id,
+                item["method"],
+                bool(result.get("ok")),
+                delay_ms,
+                self.queue_depth(),
+            )
+            for future in item["futures"]:
+                if not future.done():
+                    future.set_result(result)
+
+        lane.worker = None
+        if not lane.pending and self._lanes.get(chat_id) is lane:
+            self._lanes.pop(chat_id, None)
+        self._prune_rate_limits(time.monotonic())
+
+    async def _post(self, item: dict):
+        """Send one item. Returns (result_dict, retry_after_seconds_or_None)."""
+        client = get_async_client("telegram")
+        try:
+            response = await client.post(f"/bot{item['token']}/{item['method']}", data=item["payload"])
+        except Exception as exc:
+            logger.error("tg_delivery_error chat_id=%s method=%s error=%s", item["chat_id"], item["method"], exc)
+            return {"ok": False, "error_code": "request_exception", "description": str(exc)}, None
+        try:
+            body = response.json()
+        except Exception:
+            body = {"ok": False, "description": response.text}
+        if response.status_code == 429:
+            retry_after = (body.get("parameters") or {}).get("retry_after", 1)
+            return body, float(retry_after)
+        if response.is_error:
+            body.setdefault("ok", False)
+            body["telegram_status_code"] = response.status_code
+        return body, None
+
+    # --- metrics -----------------------------------------------------------
+
+    def recent_rate_limits(self, chat_id, window_sec: float = 60.0) -> int:
+        events = self._rate_limit_events.get(chat_id)
+        if not events:
+            return 0
+        cutoff = time.monotonic() - window_sec
+        return sum(1 for stamp in list(events) if stamp >= cutoff)
+
+    def _prune_rate_limits(self, now: float) -> None:
+        # Drop chats whose last 429 is older than RATE_LIMIT_MEMORY_SEC; runs as lanes empty.
+        cutoff = now - RATE_LIMIT_MEMORY_SEC
+        for chat_id, events in list(self._rate_limit_events.items()):
+            if not events or events[-1] < cutoff:
+                self._rate_limit_events.pop(chat_id, None)
+
+    def queue_depth(self) -> int:
+        return sum(len(lane.pending) for lane in list(self._lanes.values()))
+
+    def snapshot(self) -> dict:
+        completed = self.metrics["sent"] + self.metrics["failed"]
+        return {
+            **self.metrics,
+            "queue_depth": self.queue_depth(),
+            "active_chats": len(self._lanes),
+            "avg_delay_ms": int(self.metrics["total_delay_ms"] / completed) if completed else 0,
+        }
+
+
+delivery_queue = TelegramDeliveryQueue(
+    per_chat_rate=float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1")),
+    per_chat_burst=float(os.getenv("TELEGRAM_PER_CHAT_BURST", "3")),
+    global_rate=float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")),
+)
+
+
+def prewarm():
+    return delivery_queue.prewarm()
+
+
+def send_message(chat_id, text: str, token: str, mergeable: bool = True):
+    """Queue a sendMessage call; returns a concurrent.futures.Future.
+
+    Pass ``mergeable=False`` when the returned message_id will be edited later.
+    """
+    payload = {"chat_id": chat_id, "text": str(text)}
+    return delivery_queue.submit("sendMessage", chat_id, payload, token, mergeable=mergeable)
+
+
+def edit_message_text(chat_id, message_id, text: str, token: str):
+    """Queue an editMessageText call; returns a concurrent.futures.Future."""
+    payload = {"chat_id": chat_id, "message_id": message_id, "text": str(text)}
+    return delivery_queue.submit("editMessageText", chat_id, payload, token)
+
+
+async def send_message_async(chat_id, text: str, token: str, mergeable: bool = True) -> dict:
+    return await asyncio.wrap_future(send_message(chat_id, text, token, mergeable=mergeable))
+
+
+async def edit_message_text_async(chat_id, message_id, text: str, token: str) -> dict:
+    return await asyncio.wrap_future(edit_message_text(chat_id, message_id, text, token))
+
+
+def recent_rate_limits(chat_id, window_sec: float = 60.0) -> int:
+    """How many 429s ``chat_id`` hit in the last ``window_sec`` seconds."""
+    return delivery_queue.recent_rate_limits(chat_id, window_sec)
+
+
+def get_delivery_metrics() -> dict:
+    """Queue depth + delay counters, e.g. {"queue_depth": 2, "avg_delay_ms": 850, ...}."""
+    return delivery_queue.snapshot()
@@ -0,0 +1,150 @@
+"""Per-user ordered turn scheduler for the Telegram bot.
+
+Before example: with ``concurrent_updates(8)`` two messages from one user could run
+through ``message_history_process`` at the same time and land out of order, while
+``/stop`` waited behind a long LLM turn.
+After example:  each user gets one FIFO lane (turns run one at a time, in arrival
+order), different users run in parallel up to ``max_concurrent_turns``, and control
+commands (``/stop``, ``/restart``, mode switches) take a fast lane that starts
+immediately and runs ahead of any turns still queued for that user.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class _UserLane:
+    """Queued turns + control bookkeeping for one user."""
+
+    def __init__(self):
+        self.turns = deque()
+        self.worker = None
+        self.controls_running = 0
+        self.controls_idle = asyncio.Event()
+        self.controls_idle.set()
+
+
+class TurnScheduler:
+    def __init__(self, max_concurrent_turns: int = 16):
+        self.max_concurrent_turns = max(1, int(max_concurrent_turns))
+        self._turn_slots = asyncio.Semaphore(self.max_concurrent_turns)
+        self._lanes: dict = {}
+        self.stats = {
+            "turns_submitted": 0,
+            "turns_completed": 0,
+            "turns_failed": 0,
+            "controls_run": 0,
+            "max_queue_wait_ms": 0,
+        }
+
+    def queue_depth(self, user_id=None) -> int:
+        """Queued (not yet started) turns for one user, or for everyone when user_id is None."""
+        if user_id is not None:
+            lane = self._lanes.get(user_id)
+            return len(lane.turns) if lane else 0
+        return sum(len(lane.turns) for lane in self._lanes.values())
+
+    async def submit_turn(self, user_id, turn_factory):
+        """Queue ``turn_factory()`` behind earlier turns for ``user_id`` and await its result."""
+        return await self._enqueue(user_id, turn_factory)
+
+    def enqueue_turn(self, user_id, turn_factory) -> asyncio.Future:
+        """Queue ``turn_factory()`` and return its future without waiting for it.
+
+        Before example: the Telegram handler awaited submit_turn, so 64 queued messages from
+        one user held all 64 ``concurrent_updates`` slots and /stop could not even be dispatched.
+        After example:  the handler enqueues and returns; the lane worker owns the turn and a
+        failure nobody awaits is logged instead of raising "exception was never retrieved".
+        """
+        future = self._enqueue(user_id, turn_factory)
+        future.add_done_callback(lambda done: self._log_unobserved_failure(user_id, done))
+        return future
+
+    def _enqueue(self, user_id, turn_factory) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        lane = self._lanes.setdefault(user_id, _UserLane())
+        lane.turns.append((turn_factory, future, time.monotonic()))
+        self.stats["turns_submitted"] += 1
+        if len(lane.turns) > 1 or lane.worker is not None:
+            logger.info("turn_queued user_id=%s queue_depth=%s", user_id, len(lane.turns))
+        if lane.worker is None or lane.worker.done():
+            lane.worker = asyncio.create_task(self._drain_lane(user_id, lane))
+        return future
+
+    @staticmethod
+    def _log_unobserved_failure(user_id, future: asyncio.Future) -> None:
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            logger.error("turn_failed user_id=%s error=%s", user_id, exc, exc_info=exc)
+
+    async def submit_control(self, user_id, control_factory):
+        """Run a control command now, ahead of any turns still queued for ``user_id``.
+
+        Controls do not wait for the user's running turn or for a global turn slot,
+        so ``/stop`` can interrupt a stream that is still generating.
+        """
+        lane = self._lanes.setdefault(user_id, _UserLane())
+        lane.controls_running += 1
+        lane.controls_idle.clear()
+        self.stats["controls_run"] += 1
+        try:
+            return await control_factory()
+        finally:
+            lane.controls_running -= 1
+            if lane.controls_running == 0:
+                lane.controls_idle.set()
+            self._discard_lane_if_idle(user_id, lane)
+
+    async def _drain_lane(self, user_id, lane: _UserLane) -> None:
+        try:
+            while lane.turns:
+                # Queued turns start only after in-flight control commands finish.
+                await lane.controls_idle.wait()
+                turn_factory, future, enqueued_at = lane.turns.popleft()
+                if future.done():
+                    continue
+                async with self._turn_slots:
+                    wait_ms = int((time.monotonic() - enqueued_at) * 1000)
+                    self.stats["max_queue_wait_ms"] = max(self.stats["max_queue_wait_ms"], wait_ms)
+                    logger.info(
+                        "turn_start user_id=%s queue_wait_ms=%s remaining_in_lane=%s",
+                        user_id,
+                        wait_ms,
+                        len(lane.turns),
+                    )
+                    try:
+                        result = await turn_factory()
+                    except asyncio.CancelledError:
+                        future.cancel()
+                        raise
+                    except Exception as exc:
+                        self.stats["turns_failed"] += 1
+                        if not future.done():
+                            future.set_exception(exc)
+                    else:
+                        self.stats["turns_completed"] += 1
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            # A cancelled worker must not strand callers awaiting later turns.
+            while lane.turns:
+                _, future, _ = lane.turns.popleft()
+                if not future.done():
+                    future.cancel()
+            lane.worker = None
+            self._discard_lane_if_idle(user_id, lane)
+
+    def _discard_lane_if_idle(self, user_id, lane: _UserLane) -> None:
+        if lane.turns or lane.worker is not None or lane.controls_running:
+            return
+        if self._lanes.get(user_id) is lane:
+            self._lanes.pop(user_id, None)
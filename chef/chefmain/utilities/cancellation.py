@@ -0,0 +1,169 @@
+"""Cancellation tokens that abort in-flight upstream requests when the user sends /stop.
+
+Before example: /stop set a flag; ``_call_model_stream`` noticed it only when the next SSE line
+arrived, so a stalled xAI or Perplexity stream kept its pooled connection until the read timeout.
+After example:  ``token.cancel("stop")`` cancels every task currently inside ``async with guard():``.
+The ``async with client.stream(...)`` block inside unwinds at once, which closes the response and
+frees its pool slot. The guard swallows that cancellation, so the caller goes on with the partial
+output, exactly like the old "stop at the next line" path, and the turn still finishes and saves.
+
+The token rides a contextvar (``with cancel_scope(token):``), so tool tasks, hedged attempts and
+``asyncio.to_thread`` helpers started inside the turn all see it without extra parameters.
+``cancellation_stats()`` reports how long each /stop took to release its upstream resources.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_current_token = contextvars.ContextVar("cancel_token", default=None)
+_stats_lock = threading.Lock()
+_stats = {
+    "stop_requests": 0,
+    "guards_cancelled": 0,
+    "release_ms_total": 0,
+    "release_ms_max": 0,
+    "last_release_ms": None,
+}
+
+
+class CancelToken:
+    """One per turn; ``cancel()`` is safe from any thread and calling it twice is harmless."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._guards = set()
+        self.reason = None
+        self.requested_at = None
+        self.release_ms = None
+
+    def is_cancelled(self) -> bool:
+        return self.requested_at is not None
+
+    def cancel(self, reason: str = "stop") -> bool:
+        """Abort every guarded request; returns False when the token was already cancelled."""
+        with self._lock:
+            if self.requested_at is not None:
+                return False
+            self.reason = reason
+            self.requested_at = time.monotonic()
+            guards = list(self._guards)
+        with _stats_lock:
+            _stats["stop_requests"] += 1
+        for guard in guards:
+            guard.fire()
+        logger.info("cancel_requested reason=%s in_flight=%s", reason, len(guards))
+        return True
+
+    def _add(self, guard) -> bool:
+        with self._lock:
+            self._guards.add(guard)
+            return self.requested_at is not None
+
+    def _discard(self, guard) -> None:
+        with self._lock:
+            self._guards.discard(guard)
+
+    def _released(self) -> int:
+        release_ms = int((time.monotonic() - self.requested_at) * 1000)
+        with self._lock:
+            self.release_ms = max(self.release_ms or 0, release_ms)
+        with _stats_lock:
+            _stats["guards_cancelled"] += 1
+            _stats["release_ms_total"] += release_ms
+            _stats["release_ms_max"] = max(_stats["release_ms_max"], release_ms)
+            _stats["last_release_ms"] = release_ms
+        return release_ms
+
+
+class _Guard:
+    def __init__(self, token: CancelToken):
+        self._token = token
+        self._task = None
+        self._loop = None
+        self._active = False
+        self._fired = False
+
+    def fire(self) -> None:
+        self._loop.call_soon_threadsafe(self._cancel_task)
+
+    def _cancel_task(self) -> None:
+        # Runs on the guard's loop, so it cannot interleave with __aexit__.
+        if self._active and not self._fired:
+            self._fired = True
+            self._task.cancel()
+
+    async def __aenter__(self):
+        self._task = asyncio.current_task()
+        self._loop = asyncio.get_running_loop()
+        self._active = True
+        if self._token._add(self):
+            # Already stopped: the first await inside the block raises and nothing goes upstream.
+            self._cancel_task()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._active = False
+        self._token._discard(self)
+        if not self._fired:
+            return False
+        if exc_type is not asyncio.CancelledError:
+            # The block finished before our cancel landed; consume it so it cannot hit the caller.
+            try:
+                await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                pass
+        # A second, unrelated cancel (deadline, hedge loser) must still propagate.
+        outstanding = self._task.uncancel() if hasattr(self._task, "uncancel") else 0
+        release_ms = self._token._released()
+        logger.info("cancel_released reason=%s release_ms=%s", self._token.reason, release_ms)
+        return exc_type is asyncio.CancelledError and outstanding == 0
+
+
+class _NoopGuard:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
+def current_token() -> CancelToken | None:
+    return _current_token.get()
+
+
+@contextlib.contextmanager
+def cancel_scope(token: CancelToken | None):
+    """Make ``token`` the current token for everything awaited inside."""
+    context_token = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(context_token)
+
+
+def guard(token: CancelToken | None = None):
+    """``async with guard():`` around one upstream request; a no-op when there is no token."""
+    token = token or _current_token.get()
+    return _Guard(token) if token is not None else _NoopGuard()
+
+
+def is_cancelled() -> bool:
+    token = _current_token.get()
+    return token is not None and token.is_cancelled()
+
+
+def cancellation_stats() -> dict:
+    # Example: {"stop_requests": 9, "guards_cancelled": 11, "release_ms_avg": 3, "release_ms_max": 14, ...}
+    with _stats_lock:
+        stats = dict(_stats)
+    released = stats["guards_cancelled"]
+    stats["release_ms_avg"] = round(stats["release_ms_total"] / released, 1) if released else None
+    return stats
@@ -0,0 +1,299 @@
+"""Token-budgeted provider context with rolling summaries of older turns.
+
+Before example: route_message sent every stored message to xAI, so a week-long cooking session
+made each call slower and costlier until it overflowed the model context.
+After example:  ``build_context(system_instruction, history, ...)`` returns
+``[system, summary of older turns, ...newest turns]`` within CONTEXT_TOKEN_BUDGET estimated
+tokens. When turns fall out of the window without being summarized, the router calls
+``schedule_summary_refresh(...)``; a background thread folds them into the session's
+``context_summary`` ({"text", "covers", "tokens", "updated_at"}) so the request path never waits
+on a summarization call.
+
+Estimates are chars/4 plus a small per-message overhead: cheap, stable, and good enough to keep
+a budget. Sessions keep a running ``token_estimate`` that appends ``$inc``; it lets short
+sessions skip the per-message pass entirely.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    from utilities.http_clients import get_sync_client
+except ModuleNotFoundError:
+    # Fallback for direct script runs: import from sibling module in this folder.
+    from http_clients import get_sync_client  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "24000"))
+# Never trim below this many recent messages, even if one of them alone is over budget.
+CONTEXT_MIN_RECENT_MESSAGES = int(os.getenv("CONTEXT_MIN_RECENT_MESSAGES", "4"))
+# A trimmed window starts on a multiple of this many messages (absolute index), so the start moves
+# every few turns instead of every turn and the provider's prompt cache keeps matching the prefix.
+CONTEXT_WINDOW_ALIGN = max(1, int(os.getenv("CONTEXT_WINDOW_ALIGN", "8")))
+# A refresh summarizes enough turns to bring the recent window down to this share of the budget,
+# so summaries run once per ~40% of a budget of new conversation instead of every turn.
+CONTEXT_SUMMARY_TARGET_RATIO = float(os.getenv("CONTEXT_SUMMARY_TARGET_RATIO", "0.6"))
+CONTEXT_SUMMARY_MODEL = os.getenv("CONTEXT_SUMMARY_MODEL", "grok-4-1-fast-non-reasoning-latest")
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "400"))
+# Long pasted recipes are clipped in the summarizer input, not in the stored history.
+CONTEXT_SUMMARY_MESSAGE_CHARS = int(os.getenv("CONTEXT_SUMMARY_MESSAGE_CHARS", "2000"))
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a cooking assistant conversation. "
+    "Merge the previous summary with the new turns. Keep dishes, ingredients, quantities, "
+    "equipment, dietary constraints, decisions and open questions. Drop greetings and filler. "
+    "Reply with the updated summary only, at most 250 words."
+)
+
+_jobs: queue.Queue = queue.Queue()
+_pending: set = set()
+_pending_lock = threading.Lock()
+_worker = None
+_stats = {"windows": 0, "trimmed": 0, "scheduled": 0, "refreshes": 0, "failures": 0}
+
+
+def estimate_tokens(message) -> int:
+    """Rough token count for one chat message, e.g. {"role": "user", "content": "hi"} -> 4."""
+    if not isinstance(message, dict):
+        return MESSAGE_OVERHEAD_TOKENS + len(str(message or "")) // CHARS_PER_TOKEN
+    content = message.get("content")
+    if not isinstance(content, str):
+        content = str(content or "")
+    size = len(content)
+    if message.get("tool_calls"):
+        size += len(str(message["tool_calls"]))
+    return MESSAGE_OVERHEAD_TOKENS + size // CHARS_PER_TOKEN
+
+
+def summary_message(summary) -> dict | None:
+    text = (summary or {}).get("text") if isinstance(summary, dict) else None
+    if not text:
+        return None
+    return {"role": "system", "content": f"Summary of the earlier conversation (older turns are not shown):\n{text}"}
+
+
+def build_context(
+    system_message: dict,
+    history: list,
+    message_count: int | None = None,
+    summary: dict | None = None,
+    session_tokens: int | None = None,
+    budget: int | None = None,
+) -> dict:
+    """Pick the provider messages for one turn.
+
+    ``history`` is the session tail without a system head; ``message_count`` is the session's
+    total message count (the tail may start mid-session). ``session_tokens`` is the running
+    estimate, trusted only when the caller knows it covers the whole session.
+
+    Returns {"messages", "estimated_tokens", "window_start", "needs_summary"}; ``window_start``
+    is the absolute index of the first history message sent.
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    total_count = max(int(message_count or 0), len(history))
+    tail_start = total_count - len(history)
+    covers = int((summary or {}).get("covers") or 0) if isinstance(summary, dict) else 0
+    summary_entry = summary_message(summary) if covers else None
+    fixed = estimate_tokens(system_message) + (estimate_tokens(summary_entry) if summary_entry else 0)
+    _stats["windows"] += 1
+
+    if not summary_entry and session_tokens is not None and fixed + session_tokens <= budget:
+        # Example: a 12-message session at ~900 tokens -> no per-message pass at all.
+        return {
+            "messages": [system_message] + history,
+            "estimated_tokens": fixed + session_tokens,
+            "window_start": tail_start,
+            "needs_summary": False,
+        }
+
+    # Turns the summary already covers are never sent twice. An undercounted legacy message_count
+    # can't push the newest turns (the current question) out of the window.
+    first = min(max(0, covers - tail_start), max(0, len(history) - CONTEXT_MIN_RECENT_MESSAGES))
+    keep_from = len(history)
+    used = fixed
+    for index in range(len(history) - 1, first - 1, -1):
+        cost = estimate_tokens(history[index])
+        if used + cost > budget and len(history) - index > CONTEXT_MIN_RECENT_MESSAGES:
+            break
+        used += cost
+        keep_from = index
+    if keep_from > first:
+        _stats["trimmed"] += 1
+        # Example: budget fits messages 203.. -> send 208.. (align 8) until the fit passes 208.
+        aligned = -(-(tail_start + keep_from) // CONTEXT_WINDOW_ALIGN) * CONTEXT_WINDOW_ALIGN - tail_start
+        floor = max(keep_from, len(history) - CONTEXT_MIN_RECENT_MESSAGES)
+        if aligned > keep_from:
+            keep_from = min(aligned, floor)
+            used = fixed + sum(estimate_tokens(message) for message in history[keep_from:])
+    window_start = tail_start + keep_from
+    messages = [system_message] + ([summary_entry] if summary_entry else []) + history[keep_from:]
+    return {
+        "messages": messages,
+        "estimated_tokens": used,
+        "window_start": window_start,
+        # Turns between the summary and the window were dropped unsummarized.
+        "needs_summary": window_start > covers,
+    }
+
+
+def _summary_cutoff(messages: list, budget: int) -> int:
+    # Index where the newest turns that fit CONTEXT_SUMMARY_TARGET_RATIO of the budget begin.
+    target = int(budget * CONTEXT_SUMMARY_TARGET_RATIO)
+    used = 0
+    cutoff = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        cost = estimate_tokens(messages[index])
+        if used + cost > target and len(messages) - index > CONTEXT_MIN_RECENT_MESSAGES:
+            break
+        used += cost
+        cutoff = index
+    return cutoff
+
+
+def _transcript(messages: list) -> str:
+    lines = []
+    for message in messages:
+        content = str(message.get("content") or "")
+        if len(content) > CONTEXT_SUMMARY_MESSAGE_CHARS:
+            content = content[:CONTEXT_SUMMARY_MESSAGE_CHARS] + " [...]"
+        lines.append(f"{message.get('role', 'user')}: {content}")
+    return "\n".join(lines)
+
+
+def summarize_with_xai(previous_summary: str | None, messages: list) -> str | None:
+    """Default summarizer: one small blocking xAI call on the pooled sync client."""
+    api_key = os.getenv("XAI_API_KEY")
+    if not api_key:
+        return None
+    payload = {
+        "model": CONTEXT_SUMMARY_MODEL,
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {
+                "role": "user",
+                "content": f"Previous summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{_transcript(messages)}",
+            },
+        ],
+        "max_tokens": CONTEXT_SUMMARY_MAX_TOKENS,
+        "temperature": 0.2,
+    }
+    response = get_sync_client("xai").post(
+        "/v1/chat/completions",
+        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+        json=payload,
+    )
+    response.raise_for_status()
+    choices = response.json().get("choices") or []
+    content = ((choices[0].get("message") or {}).get("content") if choices else None) or ""
+    return content.strip() or None
+
+
+def refresh_summary(load_fn, save_fn, summarize_fn=None, budget: int | None = None) -> bool:
+    """Fold turns that no longer fit the window into the session summary; True when one was saved.
+
+    ``load_fn()`` -> {"messages": [...], "context_summary": {...}, "history_version": 7} (full
+    session, may include a system head). ``save_fn(summary, message_count, token_estimate, history_version)``
+    persists the new summary and the exact counts measured here.
+    """
+    data = load_fn()
+    if not data:
+        return False
+    messages = [
+        message
+        for message in data.get("messages") or []
+        if isinstance(message, dict) and message.get("role") != "system"
+    ]
+    previous = data.get("context_summary") if isinstance(data.get("context_summary"), dict) else {}
+    covers = int(previous.get("covers") or 0)
+    cutoff = _summary_cutoff(messages, CONTEXT_TOKEN_BUDGET if budget is None else budget)
+    token_estimate = sum(estimate_tokens(message) for message in messages)
+    if cutoff <= covers:
+        return False
+    text = (summarize_fn or summarize_with_xai)(previous.get("text"), messages[covers:cutoff])
+    if not text:
+        return False
+    summary = {
+        "text": text,
+        "covers": cutoff,
+        "tokens": estimate_tokens({"content": text}),
+        "updated_at": datetime.now(timezone.utc).isoformat(),
+    }
+    save_fn(summary, len(messages), token_estimate, data.get("history_version"))
+    _stats["refreshes"] += 1
+    logger.info(
+        "context_summary_refreshed covers=%s previous=%s messages=%s summary_tokens=%s",
+        cutoff,
+        covers,
+        len(messages),
+        summary["tokens"],
+    )
+    return True
+
+
+def schedule_summary_refresh(session_key: str, load_fn, save_fn, summarize_fn=None) -> bool:
+    """Queue one background refresh per session; returns False if one is already pending."""
+    with _pending_lock:
+        if session_key in _pending:
+            return False
+        _pending.add(session_key)
+    _stats["scheduled"] += 1
+    _jobs.put((session_key, load_fn, save_fn, summarize_fn))
+    _ensure_worker()
+    return True
+
+
+def _worker_loop() -> None:
+    while True:
+        session_key, load_fn, save_fn, summarize_fn = _jobs.get()
+        started = time.monotonic()
+        try:
+            refresh_summary(load_fn, save_fn, summarize_fn)
+        except Exception as exc:
+            _stats["failures"] += 1
+            logger.warning("context_summary_failed session=%s error=%s", session_key, exc)
+        finally:
+            with _pending_lock:
+                _pending.discard(session_key)
+            _jobs.task_done()
+            logger.info(
+                "context_summary_job session=%s duration_ms=%s",
+                session_key,
+                int((time.monotonic() - started) * 1000),
+            )
+
+
+def _ensure_worker() -> None:
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _pending_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, name="context-summary", daemon=True)
+            _worker.start()
+
+
+def wait_for_summaries(timeout: float | None = None) -> bool:
+    """Block until queued refreshes finish (tests and shutdown hooks); False on timeout."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        with _pending_lock:
+            if not _pending:
+                return True
+        if deadline is not None and time.monotonic() >= deadline:
+            return False
+        time.sleep(0.01)
+
+
+def context_window_stats() -> dict:
+    with _pending_lock:
+        pending = len(_pending)
+    return {**_stats, "pending": pending}
@@ -0,0 +1,476 @@
+"""Append-only JSONL history for the file mode (no MONGODB_URI).
+
+Before example: every turn re-read chat_history_logs/42_history.json, appended one message and
+rewrote the whole file with ``json.dump(..., indent=2)`` (O(session) per turn, torn file on crash).
+After example:  each turn appends one line to chat_history_logs/42_history.jsonl::
+
+    {"t":"session","doc":{"user_id":"42","chat_session_id":"42_0101...","bot_mode":"general",...}}
+    {"t":"msg","m":{"role":"user","content":"hi"},"f":{"user_message":"hi"}}
+    {"t":"set","f":{"system_message":{"role":"system","content":"..."},"system_prompt_hash":"3f2a..."}}
+
+A per-file offset index (kept in memory and in ``42_history.jsonl.idx``) holds the merged session
+fields and the byte offset of every message, so mode lookups read no messages and tail reads seek
+straight to the last N lines. A background thread fsyncs dirty logs (HISTORY_FSYNC=interval) and
+compacts logs whose ``set`` records pile up (HISTORY_COMPACT_SET_RECORDS), whose dead bytes pass
+HISTORY_COMPACT_DEAD_BYTES, or that have carried any dead bytes for HISTORY_COMPACT_INTERVAL_SEC.
+A torn last line from a crash is skipped on read and dropped at the next compaction.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# "always" = fsync every append, "interval" = background fsync every HISTORY_FSYNC_INTERVAL_SEC, "never".
+HISTORY_FSYNC = os.getenv("HISTORY_FSYNC", "interval").strip().lower()
+HISTORY_FSYNC_INTERVAL_SEC = float(os.getenv("HISTORY_FSYNC_INTERVAL_SEC", "1"))
+# Compact once this many "set" records (mode switches, prompt refreshes) accumulate.
+HISTORY_COMPACT_SET_RECORDS = int(os.getenv("HISTORY_COMPACT_SET_RECORDS", "64"))
+# ...or once superseded "set" records and torn lines take this many bytes (a few large prompt refreshes).
+HISTORY_COMPACT_DEAD_BYTES = int(os.getenv("HISTORY_COMPACT_DEAD_BYTES", str(256 * 1024)))
+# ...or when a log has carried any dead bytes this long without being compacted (0 disables).
+HISTORY_COMPACT_INTERVAL_SEC = float(os.getenv("HISTORY_COMPACT_INTERVAL_SEC", "3600"))
+# Persist the offset index sidecar after this many appends (always on compaction).
+HISTORY_INDEX_PERSIST_EVERY = int(os.getenv("HISTORY_INDEX_PERSIST_EVERY", "32"))
+
+
+class _LogIndex:
+    __slots__ = (
+        "path", "inode", "size", "state", "offsets", "set_records", "torn_lines", "dead_bytes", "unsaved", "since"
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self.inode = None
+        self.size = 0
+        self.state = None
+        self.offsets = []
+        self.set_records = 0
+        self.torn_lines = 0
+        self.dead_bytes = 0
+        self.unsaved = 0
+        # Monotonic time this file version was first seen (a compaction writes a new inode).
+        self.since = time.monotonic()
+
+    def to_dict(self):
+        return {
+            "inode": self.inode,
+            "size": self.size,
+            "state": self.state,
+            "offsets": self.offsets,
+            "set_records": self.set_records,
+            "torn_lines": self.torn_lines,
+            "dead_bytes": self.dead_bytes,
+        }
+
+
+_indexes: dict = {}
+_path_locks: dict = {}
+_path_locks_guard = threading.Lock()
+_dirty_paths: set = set()
+_compaction_queue: "queue.Queue[str]" = queue.Queue()
+_pending_compactions: set = set()
+_maintenance_thread = None
+_maintenance_guard = threading.Lock()
+_stats = {"appends": 0, "fsyncs": 0, "compactions": 0, "index_rebuilds": 0, "legacy_imports": 0}
+
+
+def log_path(logs_dir: str, user_id) -> str:
+    return os.path.join(logs_dir, f"{user_id}_history.jsonl")
+
+
+def legacy_path(logs_dir: str, user_id) -> str:
+    return os.path.join(logs_dir, f"{user_id}_history.json")
+
+
+def _lock_for(path: str) -> threading.RLock:
+    with _path_locks_guard:
+        lock = _path_locks.get(path)
+        if lock is None:
+            lock = _path_locks[path] = threading.RLock()
+        return lock
+
+
+def _encode(record: dict) -> bytes:
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+
+# --- index ---------------------------------------------------------------------
+
+def _apply_record(index: _LogIndex, record: dict, offset: int) -> None:
+    kind = record.get("t")
+    if kind == "session":
+        # A session record starts the log over (fresh session or compacted snapshot).
+        index.state = dict(record.get("doc") or {})
+        index.offsets = []
+        index.set_records = 0
+        index.dead_bytes = 0
+    elif kind == "msg":
+        index.offsets.append(offset)
+        if record.get("f"):
+            index.state = {**(index.state or {}), **record["f"]}
+    elif kind == "set":
+        index.state = {**(index.state or {}), **(record.get("f") or {})}
+        index.set_records += 1
+
+
+def _scan(index: _LogIndex, start: int) -> None:
+    """Apply every complete line from ``start`` to the end of the file."""
+    with open(index.path, "rb") as handle:
+        handle.seek(start)
+        offset = start
+        for line in handle:
+            if not line.endswith(b"\n"):
+                # Torn or in-flight write: stop before it and retry on the next refresh.
+                break
+            if not line.strip():
+                offset += len(line)
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                index.torn_lines += 1
+                index.dead_bytes += len(line)
+                logger.warning("history_log_bad_line path=%s offset=%s", index.path, offset)
+            else:
+                if isinstance(record, dict):
+                    _apply_record(index, record, offset)
+                    if record.get("t") == "set":
+                        # Its fields live on in the merged state; the line itself is compaction fodder.
+                        index.dead_bytes += len(line)
+            offset += len(line)
+    index.size = offset
+
+
+def _load_sidecar(path: str, inode) -> _LogIndex | None:
+    try:
+        with open(path + ".idx", "r") as handle:
+            data = json.load(handle)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("inode") != inode:
+        return None
+    index = _LogIndex(path)
+    index.inode = inode
+    index.size = int(data.get("size") or 0)
+    index.state = data.get("state")
+    index.offsets = list(data.get("offsets") or [])
+    index.set_records = int(data.get("set_records") or 0)
+    index.torn_lines = int(data.get("torn_lines") or 0)
+    index.dead_bytes = int(data.get("dead_bytes") or 0)
+    return index
+
+
+def _save_sidecar(index: _LogIndex) -> None:
+    tmp_path = index.path + ".idx.tmp"
+    try:
+        with open(tmp_path, "w") as handle:
+            json.dump(index.to_dict(), handle, separators=(",", ":"))
+        os.replace(tmp_path, index.path + ".idx")
+        index.unsaved = 0
+    except OSError as exc:
+        logger.warning("history_log_index_save_failed path=%s error=%s", index.path, exc)
+
+
+def _refreshed_index(path: str) -> _LogIndex | None:
+    """Index for ``path`` brought up to date by scanning only bytes it has not seen yet."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        _indexes.pop(path, None)
+        return None
+    index = _indexes.get(path)
+    if index is None or index.inode != stat.st_ino or stat.st_size < index.size:
+        index = _load_sidecar(path, stat.st_ino)
+        if index is None or stat.st_size < index.size:
+            index = _LogIndex(path)
+            index.inode = stat.st_ino
+            _stats["index_rebuilds"] += 1
+        _indexes[path] = index
+    if stat.st_size > index.size:
+        _scan(index, index.size)
+    return index
+
+
+# --- writes --------------------------------------------------------------------
+
+def _fsync_path(path: str) -> None:
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+        _stats["fsyncs"] += 1
+    finally:
+        os.close(fd)
+
+
+def _append_record(path: str, record: dict) -> _LogIndex:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    known = _indexes.get(path)
+    # One O_APPEND write per record, so concurrent writers never interleave inside a line.
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        data = _encode(record)
+        if known is not None and os.fstat(fd).st_size > known.size:
+            # A crash left an unterminated line; close it so this record starts on its own line.
+            data = b"\n" + data
+        os.write(fd, data)
+        if HISTORY_FSYNC == "always":
+            os.fsync(fd)
+            _stats["fsyncs"] += 1
+    finally:
+        os.close(fd)
+    _stats["appends"] += 1
+    index = _refreshed_index(path)
+    index.unsaved += 1
+    if HISTORY_FSYNC == "interval":
+        _dirty_paths.add(path)
+        _ensure_maintenance_thread()
+    if index.unsaved >= HISTORY_INDEX_PERSIST_EVERY:
+        _save_sidecar(index)
+    if (
+        index.set_records >= HISTORY_COMPACT_SET_RECORDS
+        or index.dead_bytes >= HISTORY_COMPACT_DEAD_BYTES
+        or index.torn_lines
+    ):
+        schedule_compaction(path)
+    return index
+
+
+def _write_snapshot(path: str, state: dict, messages: list) -> None:
+    """Atomically replace ``path`` with one session record followed by ``messages``."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as handle:
+        handle.write(_encode({"t": "session", "doc": state}))
+        for message in messages:
+            handle.write(_encode({"t": "msg", "m": message}))
+        handle.flush()
+        if HISTORY_FSYNC != "never":
+            os.fsync(handle.fileno())
+    os.replace(tmp_path, path)
+    index = _refreshed_index(path)
+    if index is not None:
+        _save_sidecar(index)
+
+
+def _split_session_doc(session_doc: dict) -> tuple:
+    # Example: {"messages": [{"role": "system", ...}, {"role": "user", ...}]} ->
+    #          state["system_message"] = the system entry, messages = [the user entry].
+    state = {key: value for key, value in (session_doc or {}).items() if key not in {"messages", "_id"}}
+    messages = list((session_doc or {}).get("messages") or [])
+    if messages and isinstance(messages[0], dict) and messages[0].get("role") == "system":
+        state["system_message"] = messages.pop(0)
+    return state, messages
+
+
+def _import_legacy(logs_dir: str, user_id) -> None:
+    source = legacy_path(logs_dir, user_id)
+    if not os.path.exists(source):
+        return
+    try:
+        with open(source, "r") as handle:
+            content = handle.read().strip()
+        data = json.loads(content) if content else None
+    except (OSError, ValueError) as exc:
+        logger.warning("history_log_legacy_unreadable path=%s error=%s", source, exc)
+        data = None
+    if isinstance(data, dict):
+        state, messages = _split_session_doc(data)
+        _write_snapshot(log_path(logs_dir, user_id), state, messages)
+        _stats["legacy_imports"] += 1
+    # The .json is left untouched (it may be a tracked fixture); the .jsonl existing from now on
+    # is what stops it from being imported again.
+
+
+def _prepared_index(logs_dir: str, user_id) -> _LogIndex | None:
+    path = log_path(logs_dir, user_id)
+    if not os.path.exists(path):
+        _import_legacy(logs_dir, user_id)
+    return _refreshed_index(path)
+
+
+def start_session(logs_dir: str, user_id, session_doc: dict) -> None:
+    """Begin a fresh log for ``user_id`` (the old session is replaced)."""
+    path = log_path(logs_dir, user_id)
+    with _lock_for(path):
+        state, messages = _split_session_doc(session_doc)
+        _write_snapshot(path, state, messages)
+
+
+def replace_session(logs_dir: str, user_id, session_doc: dict) -> None:
+    """Whole-object rewrite used by archive_message_history."""
+    start_session(logs_dir, user_id, session_doc)
+
+
+def append_message(logs_dir: str, user_id, message: dict, fields: dict | None = None) -> None:
+    path = log_path(logs_dir, user_id)
+    with _lock_for(path):
+        _prepared_index(logs_dir, user_id)
+        record = {"t": "msg", "m": message}
+        if fields:
+            record["f"] = fields
+        _append_record(path, record)
+
+
+def update_state(logs_dir: str, user_id, fields: dict) -> None:
+    path = log_path(logs_dir, user_id)
+    with _lock_for(path):
+        _prepared_index(logs_dir, user_id)
+        _append_record(path, {"t": "set", "f": fields})
+
+
+# --- reads ---------------------------------------------------------------------
+
+def read_state(logs_dir: str, user_id) -> dict | None:
+    """Merged session fields (bot_mode, chat_session_id, ...) without reading any message."""
+    path = log_path(logs_dir, user_id)
+    with _lock_for(path):
+        index = _prepared_index(logs_dir, user_id)
+        if index is None or (index.state is None and not index.offsets):
+            return None
+        return dict(index.state or {})
+
+
+def _read_messages_from(index: _LogIndex, first: int) -> list:
+    if first >= len(index.offsets):
+        return []
+    messages = []
+    with open(index.path, "rb") as handle:
+        handle.seek(index.offsets[first])
+        end = index.size
+        while handle.tell() < end:
+            line = handle.readline()
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("t") == "msg":
+                messages.append(record.get("m"))
+    return messages
+
+
+def load_session(logs_dir: str, user_id, last_n: int | None = None) -> dict | None:
+    """Session fields plus messages; ``last_n`` seeks to the last N message lines only.
+
+    The stored system message leads the list when the slice covers the whole session,
+    matching the shape of the old ``{"messages": [system, ...]}`` file.
+    """
+    path = log_path(logs_dir, user_id)
+    with _lock_for(path):
+        index = _prepared_index(logs_dir, user_id)
+        if index is None or (index.state is None and not index.offsets):
+            return None
+        total = len(index.offsets)
+        first = max(0, total - last_n) if last_n else 0
+        messages = _read_messages_from(index, first)
+        data = dict(index.state or {})
+    system_message = data.pop("system_message", None)
+    if isinstance(system_message, dict) and first == 0:
+        messages.insert(0, system_message)
+    data["messages"] = messages
+    data["message_count"] = total
+    return data
+
+
+def read_messages_since(logs_dir: str, user_id, start: int) -> tuple:
+    """(session fields, messages[start:], total message count) without reading earlier lines."""
+    path = log_path(logs_dir, user_id)
+    with _lock_for(path):
+        index = _prepared_index(logs_dir, user_id)
+        if index is None or (index.state is None and not index.offsets):
+            return None, [], 0
+        return dict(index.state or {}), _read_messages_from(index, max(0, start)), len(index.offsets)
+
+
+# --- maintenance ---------------------------------------------------------------
+
+def compact(path: str) -> bool:
+    """Rewrite ``path`` as one session record + its messages; drops set records and torn lines."""
+    with _lock_for(path):
+        index = _refreshed_index(path)
+        if index is None:
+            return False
+        messages = _read_messages_from(index, 0)
+        _write_snapshot(path, dict(index.state or {}), messages)
+    _stats["compactions"] += 1
+    logger.info("history_log_compacted path=%s messages=%s", path, len(messages))
+    return True
+
+
+def schedule_compaction(path: str) -> None:
+    if path in _pending_compactions:
+        return
+    _pending_compactions.add(path)
+    _compaction_queue.put(path)
+    _ensure_maintenance_thread()
+
+
+def flush_dirty() -> None:
+    while _dirty_paths:
+        path = _dirty_paths.pop()
+        _fsync_path(path)
+        index = _indexes.get(path)
+        if index is not None and index.unsaved:
+            with _lock_for(path):
+                _save_sidecar(index)
+
+
+def sweep_stale_logs(now: float | None = None) -> int:
+    """Schedule compaction for logs that carried dead bytes for HISTORY_COMPACT_INTERVAL_SEC.
+
+    Example: a user switched modes twice an hour ago and went quiet -> their log is rewritten
+    without the two ``set`` records even though HISTORY_COMPACT_SET_RECORDS was never reached.
+    """
+    if HISTORY_COMPACT_INTERVAL_SEC <= 0:
+        return 0
+    now = time.monotonic() if now is None else now
+    scheduled = 0
+    for path, index in list(_indexes.items()):
+        if index.dead_bytes and now - index.since >= HISTORY_COMPACT_INTERVAL_SEC:
+            schedule_compaction(path)
+            scheduled += 1
+    return scheduled
+
+
+def _maintenance_loop() -> None:
+    last_sweep = time.monotonic()
+    while True:
+        try:
+            path = _compaction_queue.get(timeout=max(0.05, HISTORY_FSYNC_INTERVAL_SEC))
+        except queue.Empty:
+            path = None
+        try:
+            flush_dirty()
+            if HISTORY_COMPACT_INTERVAL_SEC > 0 and time.monotonic() - last_sweep >= HISTORY_COMPACT_INTERVAL_SEC / 4:
+                last_sweep = time.monotonic()
+                sweep_stale_logs(last_sweep)
+            if path is not None:
+                _pending_compactions.discard(path)
+                compact(path)
+        except Exception as exc:
+            logger.warning("history_log_maintenance_failed path=%s error=%s", path, exc)
+
+
+def _ensure_maintenance_thread() -> None:
+    global _maintenance_thread
+    if _maintenance_thread is not None and _maintenance_thread.is_alive():
+        return
+    with _maintenance_guard:
+        if _maintenance_thread is None or not _maintenance_thread.is_alive():
+            _maintenance_thread = threading.Thread(
+                target=_maintenance_loop, name="history-log-maintenance", daemon=True
+            )
+            _maintenance_thread.start()
+
+
+def history_log_stats() -> dict:
+    return {**_stats, "indexed_logs": len(_indexes), "dirty_logs": len(_dirty_paths)}
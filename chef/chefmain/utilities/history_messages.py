@@ -1,11 +1,32 @@
 import os
 import json
 import importlib.util
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
 
-LOGS_DIR = os.path.join(os.path.dirname(__file__), "chat_history_logs") # Directory relative to utilities folder
+# Example: HISTORY_LOGS_DIR=/tmp/chef_logs keeps file-mode history out of the checkout (testscripts/conftest.py).
+LOGS_DIR = os.environ.get("HISTORY_LOGS_DIR") or os.path.join(os.path.dirname(__file__), "chat_history_logs")
 
 from datetime import datetime, timezone
 
+try:
+    from utilities import history_log, history_mirror
+    from utilities.context_window import estimate_tokens, schedule_summary_refresh
+    from utilities.mongo_clients import get_mongo_client, register_close_hook
+    from utilities.prompt_registry import resolve_prompt_text
+except ModuleNotFoundError:
+    # Fallback for direct script runs: import from sibling module in this folder.
+    import history_log  # type: ignore
+    import history_mirror  # type: ignore
+    from context_window import estimate_tokens, schedule_summary_refresh  # type: ignore
+    from mongo_clients import get_mongo_client, register_close_hook  # type: ignore
+    from prompt_registry import resolve_prompt_text  # type: ignore
+
+logger = logging.getLogger(__name__)
+
 DEFAULT_DB_NAME = "chef_chatbot"
 DEFAULT_COLLECTION_NAME = "chat_sessions"
 DEFAULT_MODE_DB_NAME = "chef_chatbot"
@@ -14,6 +35,71 @@ _mongo_collections = {}
 _mode_store_collection = None
 _bot_config_module = None
 
+# Before example: one turn re-read the mode store for bot_mode, again for active_session_id, and
+# find_one_and_update shipped the whole messages array back. After example: a per-user handle
+# answers both lookups and the append returns only the last HISTORY_TAIL_MESSAGES messages.
+SESSION_HANDLE_TTL_SEC = float(os.environ.get("SESSION_HANDLE_TTL_SEC", "10"))
+HISTORY_TAIL_MESSAGES = int(os.environ.get("HISTORY_TAIL_MESSAGES", "80"))
+_TAIL_PROJECTION_FIELDS = (
+    "user_id",
+    "bot_mode",
+    "chat_session_id",
+    "chat_session_created_at",
+    "session_info",
+    "system_prompt_hash",
+    "last_updated_at",
+    "storage",
+    "message_count",
+    "system_message",
+    "history_version",
+    "system_prompt_version",
+    "context_summary",
+    "token_estimate",
+    "token_estimate_complete",
+)
+
+# Bucketed layout (HISTORY_STORAGE=bucketed) keeps session documents small:
+#   chat_sessions          header {"_id": "42_0101...", "storage": "bucketed", "message_count": 130,
+#                                  "system_message": {"role": "system", ...}, ...}
+#   chat_sessions_buckets  {"_id": "42_0101...:000002", "session_id": "42_0101...", "index": 2,
+#                           "count": 30, "messages": [...]}
+# Before example: a 2,000-turn session was one ~10MB document rewritten/re-read per turn.
+# After example:  appends touch the header counter + one bucket; tail reads load 1-2 buckets.
+HISTORY_STORAGE = os.environ.get("HISTORY_STORAGE", "inline").strip().lower()
+HISTORY_BUCKET_SIZE = max(1, int(os.environ.get("HISTORY_BUCKET_SIZE", "50")))
+_BUCKET_INDEX_WIDTH = 6
+_session_handles = {}
+_session_handles_lock = threading.Lock()
+# Mode-store cache: handles are refreshed write-through by set_user_bot_mode/set_user_active_session
+# and, across instances, by a change stream on the mode store. While that stream is live the TTL
+# stretches to MODE_CACHE_MAX_AGE_SEC; without it (standalone mongod) SESSION_HANDLE_TTL_SEC applies.
+MODE_CACHE_MAX_AGE_SEC = float(os.environ.get("MODE_CACHE_MAX_AGE_SEC", "300"))
+MODE_CACHE_CHANGE_STREAM = os.environ.get("MODE_CACHE_CHANGE_STREAM", "1").strip().lower() not in {"0", "false", "no", "off"}
+_mode_watcher_thread = None
+_mode_watcher_stop = threading.Event()
+_mode_watcher_state = {"running": False, "available": None, "events": 0, "errors": 0}
+_mode_cache_stats = {"hits": 0, "misses": 0, "write_through": 0, "invalidations": 0}
+
+# Hot-session LRU keyed by chat_session_id. Every inline write to chat_sessions does
+# $inc history_version, so a cached entry is only trusted while its version still matches.
+# Before example: each turn ran find_one_and_update and pulled messages[-80:] back from Mongo,
+#                 although this instance answered the same session seconds earlier.
+# After example:  update_one({"_id": sid, "history_version": 7}, {"$push": ..., "$inc": {"history_version": 1}})
+#                 and the tail comes from memory; matched_count == 0 drops the entry and refetches.
+HISTORY_CACHE_MAX_SESSIONS = int(os.environ.get("HISTORY_CACHE_MAX_SESSIONS", "256"))
+_history_cache = OrderedDict()
+_history_cache_lock = threading.Lock()
+_history_cache_stats = {"hits": 0, "misses": 0, "conflicts": 0, "evictions": 0}
+
+# history_version doubles as the revision for compare-and-set rewrites (archive_message_history):
+# a rewrite only lands on the revision it was read at, otherwise it is rebased and retried.
+HISTORY_CAS_MAX_RETRIES = int(os.environ.get("HISTORY_CAS_MAX_RETRIES", "10"))
+_cas_stats = {"writes": 0, "conflicts": 0, "exhausted": 0}
+
+# "auto": Mongo is the history store whenever MONGODB_URI is set.
+# "file": the JSONL log stays the store and Mongo only receives incremental mirror pushes.
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "auto").strip().lower()
+
 
 def _get_bot_config_module():
     # Before example: no shared config; After: load central bot_config.py once.
@@ -88,16 +174,22 @@ def _get_mongo_collection(bot_mode: str | None):
     cache_key = f"{database_name}:{collection_name}"
     if cache_key in _mongo_collections:
         return _mongo_collections[cache_key]
-    try:
-        from pymongo import MongoClient
-    except Exception:
+    # Before example: MongoClient(uri) per db:collection. After example: one shared pooled client per URI.
+    client = get_mongo_client(uri)
+    if client is None:
         return None
-    client = MongoClient(uri)
     collection = client[database_name][collection_name]
     _mongo_collections[cache_key] = collection
     return collection
 
 
+def _get_primary_collection(bot_mode: str | None):
+    # Example: HISTORY_BACKEND=file + MONGODB_URI set -> None here; reads/writes use the JSONL log.
+    if HISTORY_BACKEND == "file":
+        return None
+    return _get_mongo_collection(bot_mode)
+
+
 def _get_mode_store_collection():
     global _mode_store_collection
     if _mode_store_collection is not None:
@@ -108,17 +200,16 @@ def _get_mode_store_collection():
     config = _get_mode_store_config()
     database_name = config.get("mongo_db", DEFAULT_MODE_DB_NAME)
     collection_name = config.get("mongo_collection", DEFAULT_MODE_COLLECTION_NAME)
-    try:
-        from pymongo import MongoClient
-    except Exception:
+    client = get_mongo_client(uri)
+    if client is None:
         return None
-    client = MongoClient(uri)
     _mode_store_collection = client[database_name][collection_name]
+    _ensure_mode_store_watcher(_mode_store_collection)
     return _mode_store_collection
 
 
 def _get_mongo_history(user_id: str, bot_mode: str | None):
-    collection = _get_mongo_collection(bot_mode)
+    collection = _get_primary_collection(bot_mode)
     if collection is None:
         return None
     return collection.find_one(
@@ -128,22 +219,18 @@ def _get_mongo_history(user_id: str, bot_mode: str | None):
 
 
 def get_user_bot_mode(user_id: str) -> str:
-    # Before example: inferred from history doc; After: use central mode store when present.
-    collection = _get_mode_store_collection()
-    if collection is not None:
-        doc = collection.find_one({"user_id": str(user_id)})
-        if isinstance(doc, dict) and doc.get("bot_mode"):
-            return _normalize_bot_mode(doc.get("bot_mode"))
-        return _get_default_bot_mode()
-    filepath = os.path.join(LOGS_DIR, f"{user_id}_history.json")
-    if os.path.exists(filepath):
-        try:
-            with open(filepath, "r") as handle:
-                data = json.load(handle)
-            if isinstance(data, dict) and data.get("bot_mode"):
-                return _normalize_bot_mode(data["bot_mode"])
-        except Exception:
-            pass
+    # Before example: get_user_handler + message_history_process each ran find_one per message.
+    # After example:  answered from the cached mode-store handle; only a cold/expired user costs a read.
+    handle = _resolve_session_handle(user_id)
+    if handle is not None:
+        return handle.get("bot_mode") or _get_default_bot_mode()
+    # Before example: parsed the whole history file for one field. After example: read from the log index.
+    try:
+        state = history_log.read_state(LOGS_DIR, user_id)
+    except Exception:
+        state = None
+    if isinstance(state, dict) and state.get("bot_mode"):
+        return _normalize_bot_mode(state["bot_mode"])
     return _get_default_bot_mode()
 
 
@@ -159,6 +246,8 @@ def set_user_bot_mode(user_id: str, bot_mode: str, session_info: dict | None = N
                 "bot_mode": normalized_mode,
                 "last_updated_at": now,
             },
+            # Other instances compare this to drop out-of-order change events.
+            "$inc": {"mode_version": 1},
         }
         if isinstance(session_info, dict):
             update_doc["$setOnInsert"] = {"session_info": session_info}
@@ -174,42 +263,34 @@ def set_user_bot_mode(user_id: str, bot_mode: str, session_info: dict | None = N
                 return_document=ReturnDocument.AFTER,
             )
             if updated:
+                _remember_mode_store_doc(user_id, updated, write_through=True)
                 return updated
         collection.update_one(
             {"user_id": str(user_id)},
             update_doc,
             upsert=True,
         )
+        invalidate_user_mode_cache(user_id)
         return {"user_id": str(user_id), "bot_mode": normalized_mode}
-    filepath = os.path.join(LOGS_DIR, f"{user_id}_history.json")
-    data = None
-    if os.path.exists(filepath):
-        try:
-            with open(filepath, "r") as handle:
-                data = json.load(handle)
-        except Exception:
-            data = None
+    data = history_log.read_state(LOGS_DIR, user_id)
     if not data:
         data = add_chat_session_keys({"user_id": str(user_id)})
-    data["bot_mode"] = normalized_mode
-    with open(filepath, "w") as handle:
-        json.dump(data, handle, indent=2)
+        data["bot_mode"] = normalized_mode
+        history_log.start_session(LOGS_DIR, user_id, data)
+        return data
+    if data.get("bot_mode") != normalized_mode:
+        history_log.update_state(LOGS_DIR, user_id, {"bot_mode": normalized_mode})
+        data["bot_mode"] = normalized_mode
     return data
 
 
 def get_user_active_session(user_id: str) -> dict | None:
-    collection = _get_mode_store_collection()
-    if collection is None:
-        return None
-    doc = collection.find_one({"user_id": str(user_id)})
-    if not isinstance(doc, dict):
-        return None
-    session_id = doc.get("active_session_id")
-    if not session_id:
+    handle = _resolve_session_handle(user_id)
+    if handle is None or not handle.get("chat_session_id"):
         return None
     return {
-        "chat_session_id": session_id,
-        "chat_session_created_at": doc.get("active_session_created_at"),
+        "chat_session_id": handle["chat_session_id"],
+        "chat_session_created_at": handle.get("chat_session_created_at"),
     }
 
 
@@ -233,14 +314,33 @@ def set_user_active_session(user_id: str, session_info: dict | None = None) -> d
             "active_session_created_at": session_created_at,
             "last_updated_at": now,
         },
+        "$inc": {"mode_version": 1},
     }
     if isinstance(session_info, dict):
         update_doc["$set"]["last_session_info"] = session_info
-    collection.update_one(
-        {"user_id": str(user_id)},
-        update_doc,
-        upsert=True,
-    )
+    try:
+        from pymongo import ReturnDocument
+    except Exception:
+        ReturnDocument = None
+    updated = None
+    if ReturnDocument:
+        # Before example: update_one, then the next turn re-read the doc for active_session_id.
+        # After example:  the post-image refreshes the cached handle (bot_mode included) in the same trip.
+        updated = collection.find_one_and_update(
+            {"user_id": str(user_id)},
+            update_doc,
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    if updated:
+        _remember_mode_store_doc(user_id, updated, write_through=True)
+    else:
+        collection.update_one(
+            {"user_id": str(user_id)},
+            update_doc,
+            upsert=True,
+        )
+        invalidate_user_mode_cache(user_id)
     return {
         "user_id": str(user_id),
         "chat_session_id": session_id,
@@ -248,13 +348,401 @@ def set_user_active_session(user_id: str, session_info: dict | None = None) -> d
     }
 
 
+def _remember_mode_store_doc(user_id, doc, write_through: bool = False) -> dict:
+    # Example: {"bot_mode": "general", "active_session_id": "42_01012026_...", "mode_version": 3}
+    #          -> cached handle for user "42".
+    doc = doc if isinstance(doc, dict) else {}
+    handle = {
+        "bot_mode": _normalize_bot_mode(doc["bot_mode"]) if doc.get("bot_mode") else None,
+        "chat_session_id": doc.get("active_session_id"),
+        "chat_session_created_at": doc.get("active_session_created_at"),
+        "mode_version": int(doc.get("mode_version") or 0),
+        "loaded_at": time.monotonic(),
+    }
+    with _session_handles_lock:
+        current = _session_handles.get(str(user_id))
+        if current is not None and current["mode_version"] > handle["mode_version"]:
+            # A slower read or a late change event must not undo a newer write-through.
+            return current
+        _session_handles[str(user_id)] = handle
+    if write_through:
+        _mode_cache_stats["write_through"] += 1
+    return handle
+
+
+def invalidate_user_mode_cache(user_id=None) -> None:
+    """Drop the cached mode-store handle for ``user_id`` (or every user) so the next lookup re-reads Mongo.
+
+    Called by the change-stream watcher on stream errors; deployments without change streams can
+    call it from their own fan-out (e.g. an admin endpoint) after switching a user's mode elsewhere.
+    """
+    with _session_handles_lock:
+        if user_id is None:
+            _session_handles.clear()
+        else:
+            _session_handles.pop(str(user_id), None)
+    _mode_cache_stats["invalidations"] += 1
+
+
+def _mode_cache_ttl() -> float:
+    # With a live change stream other instances' writes arrive as events, so the TTL is only a safety net.
+    return MODE_CACHE_MAX_AGE_SEC if _mode_watcher_state["running"] else SESSION_HANDLE_TTL_SEC
+
+
+def _resolve_session_handle(user_id) -> dict | None:
+    """Mode-store fields for ``user_id`` from one find_one, reused until the cache TTL expires."""
+    handle = _session_handles.get(str(user_id))
+    if handle is not None and time.monotonic() - handle["loaded_at"] < _mode_cache_ttl():
+        _mode_cache_stats["hits"] += 1
+        return handle
+    collection = _get_mode_store_collection()
+    if collection is None:
+        return None
+    _mode_cache_stats["misses"] += 1
+    return _remember_mode_store_doc(user_id, collection.find_one({"user_id": str(user_id)}))
+
+
+def _watch_mode_store_changes(collection, stop_event) -> None:
+    # Before example: /general on the web backend left the Telegram instance on "cheflog" until restart.
+    # After example:  the update event's post-image replaces that user's handle on every instance.
+    try:
+        from pymongo.errors import InvalidOperation
+    except Exception:  # pragma: no cover - watch() below needs pymongo anyway
+        InvalidOperation = RuntimeError
+    resume_token = None
+    backoff = 1.0
+    while not stop_event.is_set():
+        try:
+            pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+            with collection.watch(
+                pipeline, full_document="updateLookup", resume_after=resume_token, max_await_time_ms=1000
+            ) as stream:
+                _mode_watcher_state["running"] = True
+                _mode_watcher_state["available"] = True
+                backoff = 1.0
+                logger.info("mode_store_change_stream started")
+                # try_next returns None after max_await_time_ms, so the stop flag is seen within ~1s.
+                while not stop_event.is_set():
+                    change = stream.try_next()
+                    resume_token = stream.resume_token
+                    if change is None:
+                        continue
+                    _mode_watcher_state["events"] += 1
+                    doc = change.get("fullDocument")
+                    if isinstance(doc, dict) and doc.get("user_id") is not None:
+                        _remember_mode_store_doc(doc["user_id"], doc)
+                    else:
+                        # Deletes carry no user_id; drop everything rather than guess.
+                        invalidate_user_mode_cache()
+        except InvalidOperation as exc:
+            # Before example: after close_mongo_clients() this loop retried forever, logging
+            #                 "Cannot use MongoClient after close" every 30s.
+            # After example:  a closed client ends the watcher; the next _get_mode_store_collection starts a new one.
+            logger.info("mode_store_change_stream stopped, client closed error=%s", exc)
+            break
+        except Exception as exc:
+            _mode_watcher_state["running"] = False
+            _mode_watcher_state["errors"] += 1
+            if "replica set" in str(exc).lower() or isinstance(exc, NotImplementedError):
+                # Example: standalone mongod -> fall back to SESSION_HANDLE_TTL_SEC expiry only.
+                _mode_watcher_state["available"] = False
+                logger.warning("mode_store_change_stream unavailable ttl=%ss error=%s", SESSION_HANDLE_TTL_SEC, exc)
+                return
+            logger.warning("mode_store_change_stream error=%s retry_in=%ss", exc, backoff)
+            invalidate_user_mode_cache()
+            if stop_event.wait(backoff):
+                break
+            backoff = min(backoff * 2, 30.0)
+    _mode_watcher_state["running"] = False
+
+
+def _ensure_mode_store_watcher(collection) -> None:
+    global _mode_watcher_thread, _mode_watcher_stop
+    if not MODE_CACHE_CHANGE_STREAM or _mode_watcher_state["available"] is False:
+        return
+    with _session_handles_lock:
+        if _mode_watcher_thread is None or not _mode_watcher_thread.is_alive():
+            _mode_watcher_stop = threading.Event()
+            _mode_watcher_thread = threading.Thread(
+                target=_watch_mode_store_changes,
+                args=(collection, _mode_watcher_stop),
+                name="mode-store-change-stream",
+                daemon=True,
+            )
+            _mode_watcher_thread.start()
+
+
+def stop_mode_store_watcher(timeout: float = 0.0) -> bool:
+    """Ask the mode-store change stream thread to exit; returns True once it is gone.
+
+    Also drops the cached mode-store collection so the next lookup binds to a live client.
+    Called by ``close_mongo_clients()``; tests pass ``timeout`` to wait for the thread.
+    """
+    global _mode_store_collection
+    with _session_handles_lock:
+        thread = _mode_watcher_thread
+        _mode_watcher_stop.set()
+        _mode_store_collection = None
+    if thread is None:
+        return True
+    if timeout > 0 and thread is not threading.current_thread():
+        thread.join(timeout)
+    return not thread.is_alive()
+
+
+register_close_hook(stop_mode_store_watcher)
+
+
+def mode_cache_stats() -> dict:
+    # Example: {"hits": 812, "misses": 9, "write_through": 4, "entries": 7, "change_stream": {"running": True, ...}}
+    return {**_mode_cache_stats, "entries": len(_session_handles), "change_stream": dict(_mode_watcher_state)}
+
+
+def _history_tail_projection() -> dict | None:
+    if HISTORY_TAIL_MESSAGES <= 0:
+        return None
+    projection = {field: 1 for field in _TAIL_PROJECTION_FIELDS}
+    projection["messages"] = {"$slice": -HISTORY_TAIL_MESSAGES}
+    return projection
+
+
+def _trim_to_tail(messages: list) -> None:
+    # Keeps the cached list identical to what a $slice: -HISTORY_TAIL_MESSAGES read would return.
+    if HISTORY_TAIL_MESSAGES > 0 and len(messages) > HISTORY_TAIL_MESSAGES:
+        del messages[:-HISTORY_TAIL_MESSAGES]
+
+
+def _cache_session_doc(doc) -> None:
+    if HISTORY_CACHE_MAX_SESSIONS <= 0 or not isinstance(doc, dict) or _is_bucketed(doc):
+        return
+    session_id = doc.get("_id") or doc.get("chat_session_id")
+    if not session_id or doc.get("history_version") is None:
+        return
+    entry = {
+        "doc": {key: value for key, value in doc.items() if key != "messages"},
+        "messages": [dict(message) for message in doc.get("messages") or [] if isinstance(message, dict)],
+    }
+    _trim_to_tail(entry["messages"])
+    with _history_cache_lock:
+        _history_cache[session_id] = entry
+        _history_cache.move_to_end(session_id)
+        while len(_history_cache) > HISTORY_CACHE_MAX_SESSIONS:
+            _history_cache.popitem(last=False)
+            _history_cache_stats["evictions"] += 1
+
+
+def _cached_session(session_id):
+    with _history_cache_lock:
+        entry = _history_cache.get(session_id)
+        if entry is not None:
+            _history_cache.move_to_end(session_id)
+        return entry
+
+
+def _session_doc_from_cache(entry: dict) -> dict:
+    # Callers (the router) edit messages[0] in place, so hand out copies, never the cached dicts.
+    doc = dict(entry["doc"])
+    doc["messages"] = [dict(message) for message in entry["messages"]]
+    return doc
+
+
+def invalidate_history_cache(session_id=None) -> None:
+    """Forget one cached session (or all); the next turn re-reads it from Mongo."""
+    with _history_cache_lock:
+        if session_id is None:
+            _history_cache.clear()
+        else:
+            _history_cache.pop(session_id, None)
+
+
+def _append_cached_history(collection, session_id: str, update_doc: dict, safe_message, return_history: bool):
+    """Conditional append against a warm cache entry; returns None when the entry is missing or stale."""
+    entry = _cached_session(session_id)
+    if entry is None:
+        _history_cache_stats["misses"] += 1
+        return None
+    version = entry["doc"]["history_version"]
+    conditional_update = {key: value for key, value in update_doc.items() if key != "$setOnInsert"}
+    result = collection.update_one({"_id": session_id, "history_version": version}, conditional_update)
+    if result.matched_count == 0:
+        # Another instance (or a concurrent turn here) wrote first; the refetch below picks it up.
+        _history_cache_stats["conflicts"] += 1
+        invalidate_history_cache(session_id)
+        return None
+    _history_cache_stats["hits"] += 1
+    with _history_cache_lock:
+        current = entry["doc"].get("history_version") == version
+        if current:
+            entry["doc"].update(update_doc["$set"])
+            for key, delta in update_doc.get("$inc", {}).items():
+                entry["doc"][key] = (entry["doc"].get(key) or 0) + delta
+            entry["doc"]["history_version"] = version + 1
+            if safe_message:
+                entry["messages"].append(dict(safe_message))
+                _trim_to_tail(entry["messages"])
+            doc = _session_doc_from_cache(entry)
+        else:
+            _history_cache.pop(session_id, None)
+    if not current and return_history:
+        # Our append landed, but the entry moved under us; read the tail rather than trust it.
+        return collection.find_one({"_id": session_id}, projection=_history_tail_projection())
+    if return_history:
+        return doc
+    return {
+        key: entry["doc"].get(key)
+        for key in ("user_id", "bot_mode", "chat_session_id", "chat_session_created_at")
+    }
+
+
+def history_cache_stats() -> dict:
+    # Example: {"hits": 640, "misses": 12, "conflicts": 1, "evictions": 0, "entries": 11,
+    #           "cas": {"writes": 3, "conflicts": 1, "exhausted": 0}}
+    with _history_cache_lock:
+        entries = len(_history_cache)
+    return {**_history_cache_stats, "entries": entries, "cas": dict(_cas_stats)}
+
+
+def _get_bucket_collection(collection):
+    # Example: chef_chatbot.chat_sessions -> chef_chatbot.chat_sessions_buckets.
+    return collection.database[f"{collection.name}_buckets"]
+
+
+def _bucket_id(session_id: str, index: int) -> str:
+    # Zero-padded so an _id range scan returns buckets in order without a secondary index.
+    return f"{session_id}:{index:0{_BUCKET_INDEX_WIDTH}d}"
+
+
+def _is_bucketed(doc) -> bool:
+    return isinstance(doc, dict) and doc.get("storage") == "bucketed"
+
+
+def _load_bucketed_messages(collection, header: dict, last_n: int | None = None) -> list:
+    """Messages of a bucketed session; ``last_n`` reads only the buckets that hold the tail."""
+    session_id = header.get("_id") or header.get("chat_session_id")
+    message_count = int(header.get("message_count") or 0)
+    first_index = 0
+    if last_n is not None and last_n > 0:
+        first_index = max(0, message_count - last_n) // HISTORY_BUCKET_SIZE
+    cursor = _get_bucket_collection(collection).find(
+        {
+            "_id": {
+                "$gte": _bucket_id(session_id, first_index),
+                "$lte": _bucket_id(session_id, 10**_BUCKET_INDEX_WIDTH - 1),
+            }
+        },
+        sort=[("_id", 1)],
+    )
+    messages = [message for bucket in cursor for message in bucket.get("messages", [])]
+    if last_n is not None and last_n > 0 and len(messages) > last_n:
+        messages = messages[-last_n:]
+    system_message = header.get("system_message")
+    covers_session = last_n is None or last_n <= 0 or message_count <= last_n
+    if isinstance(system_message, dict) and covers_session:
+        messages.insert(0, system_message)
+    return messages
+
+
+def _upsert_bucketed_history(
+    collection,
+    session_id: str,
+    update_doc: dict,
+    safe_message: dict | None,
+    return_history: bool,
+):
+    update_doc["$setOnInsert"].pop("messages", None)
+    update_doc["$setOnInsert"]["storage"] = "bucketed"
+    update_doc.pop("$push", None)
+    if safe_message:
+        update_doc["$inc"]["message_count"] = 1
+    else:
+        # Mongo rejects an empty $inc.
+        update_doc.pop("$inc", None)
+    try:
+        from pymongo import ReturnDocument
+        return_after = ReturnDocument.AFTER
+    except Exception:
+        return_after = True
+    # One small write: header fields + the new message position, never the messages themselves.
+    header = collection.find_one_and_update(
+        {"_id": session_id},
+        update_doc,
+        upsert=True,
+        projection={field: 1 for field in _TAIL_PROJECTION_FIELDS},
+        return_document=return_after,
+    )
+    if not _is_bucketed(header):
+        # Sessions created before the switch stay inline until migrate_history_buckets.py runs.
+        if safe_message:
+            collection.update_one({"_id": session_id}, {"$push": {"messages": safe_message}})
+        if not return_history:
+            return header
+        return collection.find_one({"_id": session_id}, projection=_history_tail_projection())
+    if safe_message:
+        index = (int(header["message_count"]) - 1) // HISTORY_BUCKET_SIZE
+        _get_bucket_collection(collection).update_one(
+            {"_id": _bucket_id(session_id, index)},
+            {
+                "$push": {"messages": safe_message},
+                "$inc": {"count": 1},
+                "$setOnInsert": {"session_id": session_id, "index": index},
+            },
+            upsert=True,
+        )
+    if return_history:
+        header["messages"] = _load_bucketed_messages(
+            collection, header, HISTORY_TAIL_MESSAGES if HISTORY_TAIL_MESSAGES > 0 else None
+        )
+    return header
+
+
+def migrate_session_to_buckets(collection, doc: dict, dry_run: bool = False) -> int:
+    """Move an inline ``messages`` array into buckets; returns the number of messages moved.
+
+    Returns -1 when the session changed while migrating (a turn appended); rerun to pick it up.
+    """
+    if _is_bucketed(doc) or not isinstance(doc.get("messages"), list):
+        return 0
+    messages = doc["messages"]
+    system_message = None
+    body = messages
+    if messages and isinstance(messages[0], dict) and messages[0].get("role") == "system":
+        system_message, body = messages[0], messages[1:]
+    if dry_run:
+        return len(body)
+    session_id = doc["_id"]
+    buckets = _get_bucket_collection(collection)
+    for index, start in enumerate(range(0, len(body), HISTORY_BUCKET_SIZE)):
+        chunk = body[start:start + HISTORY_BUCKET_SIZE]
+        buckets.replace_one(
+            {"_id": _bucket_id(session_id, index)},
+            {"session_id": session_id, "index": index, "count": len(chunk), "messages": chunk},
+            upsert=True,
+        )
+    header_update = {
+        "$set": {"storage": "bucketed", "message_count": len(body)},
+        "$unset": {"messages": ""},
+        # Makes any instance's cached inline copy of this session stale.
+        "$inc": {"history_version": 1},
+    }
+    if system_message is not None:
+        header_update["$set"]["system_message"] = system_message
+    # Guard on the array size so a concurrent inline append is never dropped.
+    result = collection.update_one(
+        {"_id": session_id, "messages": {"$size": len(messages)}},
+        header_update,
+    )
+    return len(body) if result.modified_count else -1
+
+
 def _upsert_mongo_history(
     user_id: str,
     message_object: dict,
     safe_message: dict | None,
     bot_mode: str | None,
+    handle: dict | None = None,
+    return_history: bool = True,
 ):
-    collection = _get_mongo_collection(bot_mode)
+    collection = _get_primary_collection(bot_mode)
     if collection is None:
         return None
     normalized_mode = _normalize_bot_mode(bot_mode)
@@ -269,7 +757,10 @@ def _upsert_mongo_history(
     )
     active_session = None
     if not explicit_session_id:
-        active_session = get_user_active_session(user_id)
+        if handle is not None and handle.get("chat_session_id"):
+            active_session = handle
+        elif handle is None:
+            active_session = get_user_active_session(user_id)
         if not active_session:
             active_session = set_user_active_session(user_id, session_info=session_info)
     session_id = (
@@ -309,9 +800,39 @@ def _upsert_mongo_history(
         # Before: $setOnInsert + $push on "messages" conflicted; After: only seed when no push.
         update_doc["$setOnInsert"]["messages"] = session_seed["messages"]
 
+    # Running size for context windowing. Only sessions created with this counter
+    # (token_estimate_complete) trust it; older ones get exact numbers from the summary job.
+    # Example: a 40-char user message -> $inc {"token_estimate": 14, "message_count": 1}.
+    update_doc["$setOnInsert"]["token_estimate_complete"] = True
+    update_doc["$inc"] = {}
     if safe_message:
         update_doc["$push"] = {"messages": safe_message}
         update_doc["$set"]["user_message"] = safe_message.get("content", "")
+        update_doc["$inc"]["token_estimate"] = estimate_tokens(safe_message)
+
+    if HISTORY_STORAGE == "bucketed":
+        return _upsert_bucketed_history(
+            collection, session_seed["chat_session_id"], update_doc, safe_message, return_history
+        )
+
+    update_doc["$inc"]["history_version"] = 1
+    if safe_message:
+        update_doc["$inc"]["message_count"] = 1
+    cached_doc = _append_cached_history(
+        collection, session_seed["chat_session_id"], update_doc, safe_message, return_history
+    )
+    if cached_doc is not None:
+        return cached_doc
+
+    if not return_history:
+        # Example: the assistant append only needs the write acknowledged, not the document back.
+        collection.update_one({"_id": session_seed["chat_session_id"]}, update_doc, upsert=True)
+        return {
+            "user_id": user_id,
+            "bot_mode": normalized_mode,
+            "chat_session_id": session_seed["chat_session_id"],
+            "chat_session_created_at": session_seed["chat_session_created_at"],
+        }
 
     try:
         from pymongo import ReturnDocument
@@ -319,12 +840,17 @@ def _upsert_mongo_history(
         ReturnDocument = None
 
     if ReturnDocument:
-        return collection.find_one_and_update(
+        # Example: a 900-message session returns messages[-80:] plus the session fields listed above.
+        doc = collection.find_one_and_update(
             {"_id": session_seed["chat_session_id"]},
             update_doc,
             upsert=True,
+            projection=_history_tail_projection(),
             return_document=ReturnDocument.AFTER,
         )
+        # The cache keeps its own copies, so the router may edit this doc freely.
+        _cache_session_doc(doc)
+        return doc
 
     collection.update_one(
         {"_id": session_seed["chat_session_id"]},
@@ -334,30 +860,6 @@ def _upsert_mongo_history(
     return _get_mongo_history(user_id, bot_mode)
 
 
-def _load_mongo_helper():
-    try:
-        # Before example: imports pointed at chef/testscripts/simple_mongo_dump.py.
-        # After example: import resolves to chefmain/utilities/simple_mongo_dump.py.
-        from utilities.simple_mongo_dump import save_chat_session_to_mongo as helper
-        return helper
-    except Exception:
-        try:
-            from simple_mongo_dump import save_chat_session_to_mongo as helper
-            return helper
-        except Exception:
-            return None
-    return None
-
-
-save_chat_session_to_mongo = None
-
-
-def _ensure_mongo_helper():
-    global save_chat_session_to_mongo
-    if save_chat_session_to_mongo is None:
-        save_chat_session_to_mongo = _load_mongo_helper()
-    return save_chat_session_to_mongo
-
 def add_chat_session_keys(session_info: dict) -> dict:
     """Adds session_id, session_created_at, and messages keys to a copy of session_info."""
 
@@ -385,7 +887,7 @@ def create_session_log_file(user_id: str) -> str | None:
     Returns:
         The full filepath of the created text file, or None if an error occurred.
     """
-    if os.environ.get("MONGODB_URI"):
+    if os.environ.get("MONGODB_URI") and HISTORY_BACKEND != "file":
         # Before example: wrote chat_history_logs/<user>.json; After: Mongo mode skips local files.
         return None
     # 1. Ensure the directory exists
@@ -397,10 +899,8 @@ def create_session_log_file(user_id: str) -> str | None:
 
     # 2. Create the unique filename
     
-    filename = f"{user_id}_history.json" # Simple .txt file
-
-    # 3. Get the full path
-    filepath = os.path.join(LOGS_DIR, filename)
+    # 3. Get the full path (e.g. chat_history_logs/42_history.jsonl)
+    filepath = history_log.log_path(LOGS_DIR, user_id)
 
     # 4. Create the empty file
     try:
@@ -415,18 +915,17 @@ def create_session_log_file(user_id: str) -> str | None:
         return None
 
 
-def _sync_history_to_mongo(user_id: str):
-    helper = _ensure_mongo_helper()
-    if not user_id or not os.environ.get("MONGODB_URI") or not callable(helper):
-        return
-    # Before: history writes stopped at chat_history_logs/<user>.json.
-    # After: with os.environ["MONGODB_URI"] = "mongodb+srv://example/chef", the same write mirrors to MongoDB.
-    try:
-        helper(str(user_id))
-    except Exception as exc:
-        print(f"WARNING: Mongo sync skipped for user {user_id}: {exc}")
-
-def message_history_process(message_object: dict, message_to_append_history=None) -> dict:
+def message_history_process(
+    message_object: dict,
+    message_to_append_history=None,
+    return_history: bool = True,
+) -> dict:
+    """Append one message to the user's active session.
+
+    With Mongo the returned ``messages`` are the last HISTORY_TAIL_MESSAGES entries, not the
+    whole session; ``return_history=False`` skips reading the document back entirely. A session
+    this instance already holds in its LRU is appended with one conditional write and no read.
+    """
     import json
     user_id = str(message_object.get('user_id', 'unknown'))
 
@@ -443,65 +942,152 @@ def message_history_process(message_object: dict, message_to_append_history=None
         safe_message = {k: make_json_safe(v) for k, v in message_to_append_history.items()}
 
     explicit_mode = message_object.get("bot_mode") if isinstance(message_object, dict) else None
-    effective_mode = _normalize_bot_mode(explicit_mode) if explicit_mode else get_user_bot_mode(user_id)
+    handle = _resolve_session_handle(user_id)
+    if explicit_mode:
+        effective_mode = _normalize_bot_mode(explicit_mode)
+    elif handle is not None:
+        effective_mode = handle.get("bot_mode") or _get_default_bot_mode()
+    else:
+        effective_mode = get_user_bot_mode(user_id)
     if isinstance(message_object, dict):
         message_object["bot_mode"] = effective_mode
-        if explicit_mode:
+        if explicit_mode and (handle is None or handle.get("bot_mode") != effective_mode):
             # Keep each turn's explicit mode persisted with session metadata for continuity.
+            # Before example: written on every append. After example: only when the stored mode differs.
             set_user_bot_mode(user_id, effective_mode, session_info=message_object.get("session_info"))
     # Example: effective_mode="cheflog" -> writes to chef_chatbot.chat_sessions.
-    mongo_doc = _upsert_mongo_history(user_id, message_object, safe_message, effective_mode)
+    mongo_doc = _upsert_mongo_history(
+        user_id,
+        message_object,
+        safe_message,
+        effective_mode,
+        handle=handle,
+        return_history=return_history,
+    )
     if mongo_doc:
         return mongo_doc
 
-    filepath = os.path.join(LOGS_DIR, f"{user_id}_history.json")
-
-    # Try to load existing file, handle empty/corrupt gracefully
-    data = None
-    if os.path.exists(filepath):
-        try:
-            with open(filepath, 'r') as f:
-                content = f.read().strip()
-                if content:
-                    data = json.loads(content)
-        except (json.JSONDecodeError, IOError):
-            data = None
-    if not data:
-        # If file doesn't exist, is empty, or is corrupt, initialize with the incoming object
+    # Before example: read + json.dump(indent=2) of the whole file per turn.
+    # After example:  one appended JSONL line; the offset index answers the tail read.
+    state = history_log.read_state(LOGS_DIR, user_id)
+    if not state:
+        # If the log doesn't exist or is empty, initialize with the incoming object
         if 'chat_session_id' not in message_object:
             message_object = add_chat_session_keys(message_object)
-        data = message_object
-
-    # Ensure messages list exists
-    if "messages" not in data or not isinstance(data["messages"], list):
-        data["messages"] = []
+        history_log.start_session(
+            LOGS_DIR, user_id, {**message_object, "token_estimate": 0, "token_estimate_complete": True}
+        )
+        state = history_log.read_state(LOGS_DIR, user_id) or {}
 
     # Before example: bot_mode always default; After: explicit or stored mode wins.
     mode_override = message_object.get("bot_mode") if isinstance(message_object, dict) else None
-    existing_mode = data.get("bot_mode") if isinstance(data, dict) else None
-    data["bot_mode"] = mode_override or existing_mode or _get_default_bot_mode()
+    resolved_mode = mode_override or state.get("bot_mode") or _get_default_bot_mode()
 
+    fields = {}
+    if resolved_mode != state.get("bot_mode"):
+        fields["bot_mode"] = resolved_mode
     if safe_message:
-        data["messages"].append(safe_message)
-        data["user_message"] = safe_message.get("content", "")
+        fields["user_message"] = safe_message.get("content", "")
+        fields["token_estimate"] = int(state.get("token_estimate") or 0) + estimate_tokens(safe_message)
+        history_log.append_message(LOGS_DIR, user_id, safe_message, fields=fields)
+    elif fields:
+        history_log.update_state(LOGS_DIR, user_id, fields)
+
+    data = history_log.load_session(
+        LOGS_DIR,
+        user_id,
+        last_n=HISTORY_TAIL_MESSAGES if return_history else 1,
+    ) or {}
+
+    if message_to_append_history and os.environ.get("MONGODB_URI"):
+        # Before: append -> file + full Mongo snapshot ($set of every message, new MongoClient per call).
+        # After: append -> file; a debounced background $push ships only the new messages.
+        history_mirror.notify_append(LOGS_DIR, user_id, _get_mongo_collection)
 
-    # Save the updated object back to the file
-    with open(filepath, 'w') as f:
-        json.dump(data, f, indent=2)
+    return data
 
-    if message_to_append_history:
-        # Before: append -> file only. After: append -> file + Mongo snapshot (when MONGODB_URI is set).
-        _sync_history_to_mongo(user_id)
+def _rebase_session_fields(fields: dict, current: dict | None) -> dict:
+    # Example: caller read 4 messages, a concurrent turn pushed a 5th -> write caller's 4 + stored 5th.
+    if not isinstance(current, dict):
+        return fields
+    if _is_bucketed(current):
+        # Messages of bucketed sessions live in the buckets; never write an inline array onto the header.
+        return {key: value for key, value in fields.items() if key != "messages"}
+    caller_messages = fields.get("messages")
+    stored_messages = current.get("messages")
+    if not isinstance(caller_messages, list) or not isinstance(stored_messages, list):
+        return fields
+    # Align on the conversation body: a system prompt may have been inserted at position 0 meanwhile.
+    caller_head, caller_body = _split_system_head(caller_messages)
+    stored_head, stored_body = _split_system_head(stored_messages)
+    head = caller_head or stored_head
+    body = caller_body + stored_body[len(caller_body):]
+    return {**fields, "messages": ([head] if head else []) + body}
+
+
+def _split_system_head(messages: list) -> tuple:
+    if messages and isinstance(messages[0], dict) and messages[0].get("role") == "system":
+        return messages[0], messages[1:]
+    return None, messages
+
+
+def compare_and_set_session(collection, session_id: str, fields: dict, revision: int | None = None) -> tuple:
+    """``$set`` ``fields`` on a session only if it is still at ``revision``.
+
+    Returns ``(new_revision, written_fields)``; ``written_fields`` differs from ``fields`` when the
+    write had to be rebased.
+
+    ``revision=None`` means "the caller never read this session": the write creates it, or lands on
+    a legacy document without history_version. On conflict the current document is re-read, the
+    fields are rebased onto it (messages appended meanwhile are kept) and the write is retried up
+    to HISTORY_CAS_MAX_RETRIES times; the revision is None when retries run out.
+    """
+    try:
+        from pymongo.errors import DuplicateKeyError
+    except Exception:  # pragma: no cover - pymongo always ships errors when a collection exists
+        DuplicateKeyError = ()
+    fields = {key: value for key, value in fields.items() if key not in {"history_version", "_id"}}
+    for attempt in range(HISTORY_CAS_MAX_RETRIES + 1):
+        if revision is None:
+            guard = {"_id": session_id, "history_version": {"$exists": False}}
+        else:
+            guard = {"_id": session_id, "history_version": revision}
+        try:
+            result = collection.update_one(
+                guard,
+                {"$set": fields, "$inc": {"history_version": 1}},
+                upsert=revision is None,
+            )
+            applied = bool(result.matched_count or result.upserted_id is not None)
+        except DuplicateKeyError:
+            # Upsert raced an existing versioned document with the same _id.
+            applied = False
+        if applied:
+            _cas_stats["writes"] += 1
+            invalidate_history_cache(session_id)
+            return (revision or 0) + 1, fields
+        _cas_stats["conflicts"] += 1
+        current = collection.find_one({"_id": session_id})
+        revision = current.get("history_version") if isinstance(current, dict) else None
+        fields = _rebase_session_fields(fields, current)
+        # Jittered exponential pause so rebasing writers don't collide again on the next revision.
+        time.sleep(random.uniform(0, min(0.1, 0.002 * 2 ** attempt)))
+    _cas_stats["exhausted"] += 1
+    invalidate_history_cache(session_id)
+    print(f"WARNING: session {session_id} rewrite gave up after {HISTORY_CAS_MAX_RETRIES} conflicts")
+    return None, fields
 
-    return data
 
 def archive_message_history(message_object: dict, user_id: str) -> None:
     """
     Archives the full message object to a file.
+
+    With Mongo this is a compare-and-set on ``history_version`` (see compare_and_set_session):
+    ``message_object`` should carry the full ``messages`` list it was read with.
     """
     bot_mode = message_object.get("bot_mode") if isinstance(message_object, dict) else None
     effective_mode = _normalize_bot_mode(bot_mode) if bot_mode else get_user_bot_mode(user_id)
-    collection = _get_mongo_collection(effective_mode)
+    collection = _get_primary_collection(effective_mode)
     if collection is not None:
         now = datetime.now(timezone.utc).isoformat()
         session_id = message_object.get("chat_session_id")
@@ -516,37 +1102,259 @@ def archive_message_history(message_object: dict, user_id: str) -> None:
         message_object["bot_mode"] = effective_mode
         message_object["_id"] = session_id
         message_object["last_updated_at"] = now
-        collection.update_one({"_id": session_id}, {"$set": message_object}, upsert=True)
+        # Before example: update_one({"_id": sid}, {"$set": message_object}) erased a concurrent turn's $push.
+        # After example:  the $set lands only on the revision this object was read at; otherwise it is
+        #                 rebased onto the stored messages and retried.
+        fields = message_object
+        if _is_bucketed(message_object):
+            fields = {key: value for key, value in message_object.items() if key != "messages"}
+        elif message_object.get("system_prompt_hash") and isinstance(message_object.get("messages"), list):
+            # get_full_history_message_object expands the prompt reference; don't write the text back.
+            fields = {**message_object, "messages": _split_system_head(message_object["messages"])[1]}
+        revision, written = compare_and_set_session(
+            collection, session_id, fields, message_object.get("history_version")
+        )
+        if revision is not None:
+            # Keep the caller's object in step with what was stored so a second archive stays safe.
+            message_object["history_version"] = revision
+            if "messages" in written:
+                message_object["messages"] = written["messages"]
         return
 
-    filepath = os.path.join(LOGS_DIR, f"{user_id}_history.json")
+    # Whole-object archive: rewrite the user's JSONL log as one snapshot (atomic rename).
+    filepath = history_log.log_path(LOGS_DIR, user_id)
     try:
-        with open(filepath, 'w') as f:
-            json.dump(message_object, f, indent=2)
-        print(f"Archived message history to {filepath} (JSON)")
+        history_log.replace_session(LOGS_DIR, user_id, message_object)
+        print(f"Archived message history to {filepath} (JSONL)")
     except Exception as e:
-        with open(filepath, 'w') as f:
-            f.write(str(message_object))
-        print(f"WARNING: Could not archive as JSON, wrote as string instead. Error: {e}")
+        print(f"WARNING: Could not archive message history to {filepath}. Error: {e}")
+
+def update_session_system_prompt(
+    session_doc: dict,
+    user_id: str,
+    system_prompt_hash: str,
+    system_prompt_version: int | None = None,
+) -> None:
+    """Point a session at a registered system prompt instead of storing its text.
+
+    Before example: messages[0] held the full prompt (kilobytes per session) and was rewritten with
+                    ``$set messages.0`` whenever the prompt or the frontend note changed.
+    After example:  the session stores ``system_prompt_hash`` + ``system_prompt_version`` only (the
+                    text lives once in prompt_registry); a legacy inline head is popped on the same write.
+    """
+    bot_mode = session_doc.get("bot_mode") if isinstance(session_doc, dict) else None
+    effective_mode = _normalize_bot_mode(bot_mode) if bot_mode else get_user_bot_mode(user_id)
+    collection = _get_primary_collection(effective_mode)
+    session_id = session_doc.get("chat_session_id") if isinstance(session_doc, dict) else None
+    reference = {"system_prompt_hash": system_prompt_hash, "system_prompt_version": system_prompt_version}
+    if collection is None:
+        # File mode: one appended "set" record; clearing system_message drops the inline copy.
+        history_log.update_state(LOGS_DIR, user_id, {"system_message": None, **reference})
+        session_doc.update(reference)
+        return
+    if not session_id:
+        if isinstance(session_doc.get("messages"), list):
+            session_doc["messages"] = _split_system_head(session_doc["messages"])[1]
+        session_doc.update(reference)
+        archive_message_history(session_doc, user_id)
+        return
+    fields = {**reference, "last_updated_at": datetime.now(timezone.utc).isoformat()}
+    if _is_bucketed(session_doc):
+        collection.update_one({"_id": session_id}, {"$set": fields, "$unset": {"system_message": ""}})
+        session_doc.update(reference)
+        return
+    entry = _cached_session(session_id)
+    version = entry["doc"].get("history_version") if entry is not None else None
+    outcome = _write_prompt_reference(collection, session_id, fields, version)
+    if outcome is None and version is not None:
+        # The cached copy is stale (another writer bumped history_version); write unconditionally.
+        invalidate_history_cache(session_id)
+        _write_prompt_reference(collection, session_id, fields, None)
+    elif outcome is not None and version is not None:
+        with _history_cache_lock:
+            if entry["doc"].get("history_version") == version:
+                messages = entry["messages"]
+                if outcome == "popped" and messages and messages[0].get("role") == "system":
+                    messages.pop(0)
+                entry["doc"].update(fields)
+                entry["doc"]["history_version"] = version + 1
+            else:
+                _history_cache.pop(session_id, None)
+    session_doc.update(reference)
+
+
+def _write_prompt_reference(collection, session_id: str, fields: dict, version) -> str | None:
+    """Store the prompt reference; returns "popped" (inline head removed), "set", or None when nothing matched."""
+    guard = {"_id": session_id}
+    if version is not None:
+        guard["history_version"] = version
+    for _ in range(2):
+        result = collection.update_one(
+            {**guard, "messages.0.role": "system"},
+            {"$pop": {"messages": -1}, "$set": fields, "$inc": {"history_version": 1}},
+        )
+        if result.matched_count:
+            return "popped"
+        result = collection.update_one(
+            {**guard, "messages.0.role": {"$ne": "system"}},
+            {"$set": fields, "$inc": {"history_version": 1}},
+        )
+        if result.matched_count:
+            return "set"
+        if version is not None:
+            break
+        # Unguarded: a seeded system head appeared between our two writes; pop it on the next pass.
+    return None
+
+
+def _expand_prompt_reference(doc: dict) -> dict:
+    # Example: {"system_prompt_hash": "3f2a...", "messages": [user, ...]} -> messages = [system, user, ...].
+    messages = doc.get("messages")
+    if not isinstance(messages, list) or _split_system_head(messages)[0] is not None:
+        return doc
+    text = resolve_prompt_text(doc.get("system_prompt_hash"))
+    if text is not None:
+        messages.insert(0, {"role": "system", "content": text})
+    return doc
 
-    print(f"Archived message history to {filepath}")
 
 def get_full_history_message_object(user_id: str, bot_mode: str | None = None) -> dict:
-    """Retrieve the entire message object (including all metadata and messages) for a user from their persistent history file."""
+    """Retrieve the entire message object (including all metadata and messages) for a user from their persistent history file.
+
+    Sessions that store their system prompt by reference get it resolved back into messages[0].
+    """
     effective_mode = _normalize_bot_mode(bot_mode) if bot_mode else get_user_bot_mode(user_id)
     mongo_doc = _get_mongo_history(str(user_id), effective_mode)
     if mongo_doc:
-        return mongo_doc
-    filepath = os.path.join(LOGS_DIR, f"{user_id}_history.json")
-    if os.path.exists(filepath):
-        try:
-            with open(filepath, "r") as f:
-                data = json.load(f)
-                return data
-        except Exception as e:
-            print(f"ERROR: Could not load persistent message object for user {user_id}: {e}")
+        if _is_bucketed(mongo_doc):
+            mongo_doc["messages"] = _load_bucketed_messages(_get_mongo_collection(effective_mode), mongo_doc)
+        return _expand_prompt_reference(mongo_doc)
+    try:
+        data = history_log.load_session(LOGS_DIR, user_id)
+        if data:
+            return _expand_prompt_reference(data)
+    except Exception as e:
+        print(f"ERROR: Could not load persistent message object for user {user_id}: {e}")
     return {}
 
+def get_session_messages(chat_session_id: str, bot_mode: str | None = None, last_n: int | None = None) -> list:
+    """Messages of one Mongo session, optionally only the last ``last_n`` (inline or bucketed)."""
+    collection = _get_mongo_collection(_normalize_bot_mode(bot_mode) if bot_mode else _get_default_bot_mode())
+    if collection is None:
+        return []
+    projection = {field: 1 for field in _TAIL_PROJECTION_FIELDS}
+    projection["messages"] = {"$slice": -last_n} if last_n else 1
+    header = collection.find_one({"_id": chat_session_id}, projection=projection)
+    if not header:
+        return []
+    if _is_bucketed(header):
+        return _load_bucketed_messages(collection, header, last_n)
+    return header.get("messages", [])
+
+
+def get_recent_history_message_object(
+    user_id: str,
+    last_n: int = HISTORY_TAIL_MESSAGES,
+    bot_mode: str | None = None,
+) -> dict:
+    """Latest session for ``user_id`` with only its last ``last_n`` messages.
+
+    Example: get_recent_history_message_object("42", last_n=20) -> {"chat_session_id": ..., "messages": [...20]}.
+    """
+    effective_mode = _normalize_bot_mode(bot_mode) if bot_mode else get_user_bot_mode(user_id)
+    collection = _get_primary_collection(effective_mode)
+    if collection is not None:
+        projection = {field: 1 for field in _TAIL_PROJECTION_FIELDS}
+        projection["messages"] = {"$slice": -last_n} if last_n else 1
+        header = collection.find_one(
+            {"user_id": str(user_id)},
+            sort=[("last_updated_at", -1)],
+            projection=projection,
+        )
+        if header:
+            if _is_bucketed(header):
+                header["messages"] = _load_bucketed_messages(collection, header, last_n)
+            return header
+    # File mode: seek to the last N message lines via the log's offset index.
+    return history_log.load_session(LOGS_DIR, user_id, last_n=last_n or None) or {}
+
+
+def schedule_context_summary(user_id: str, session_doc: dict) -> bool:
+    """Queue a background refresh of ``context_summary`` for the session in ``session_doc``.
+
+    Called by the router when its token window dropped turns the summary does not cover yet;
+    the read, the summarizer call and the write all happen on the context_window worker.
+    """
+    session_id = session_doc.get("chat_session_id") if isinstance(session_doc, dict) else None
+    if not session_id:
+        return False
+    user_id = str(user_id)
+    bot_mode = session_doc.get("bot_mode")
+    return schedule_summary_refresh(
+        session_id,
+        lambda: _load_session_for_summary(user_id, session_id, bot_mode),
+        lambda summary, message_count, token_estimate, revision: _save_context_summary(
+            user_id, session_id, bot_mode, summary, message_count, token_estimate, revision
+        ),
+    )
+
+
+def _load_session_for_summary(user_id: str, session_id: str, bot_mode: str | None) -> dict | None:
+    collection = _get_primary_collection(_normalize_bot_mode(bot_mode) if bot_mode else _get_default_bot_mode())
+    if collection is None:
+        data = history_log.load_session(LOGS_DIR, user_id)
+        return data if data and data.get("chat_session_id") == session_id else None
+    projection = {field: 1 for field in _TAIL_PROJECTION_FIELDS}
+    projection["messages"] = 1
+    doc = collection.find_one({"_id": session_id}, projection=projection)
+    if doc and _is_bucketed(doc):
+        doc["messages"] = _load_bucketed_messages(collection, doc)
+        # Bucket appends don't bump history_version, so it can't guard the exact-count write.
+        doc.pop("history_version", None)
+    return doc
+
+
+def _save_context_summary(
+    user_id: str,
+    session_id: str,
+    bot_mode: str | None,
+    summary: dict,
+    message_count: int,
+    token_estimate: int,
+    revision: int | None,
+) -> None:
+    # Before example: a legacy session said message_count=3 (the counter started after it was created).
+    # After example:  the summary write also stores the exact count and size measured by the job,
+    #                 but only if no turn landed since the job read the session.
+    exact = {"token_estimate": token_estimate, "token_estimate_complete": True}
+    collection = _get_primary_collection(_normalize_bot_mode(bot_mode) if bot_mode else _get_default_bot_mode())
+    if collection is None:
+        current = history_log.load_session(LOGS_DIR, user_id, last_n=1) or {}
+        if current.get("chat_session_id") != session_id:
+            return
+        fields = {"context_summary": summary}
+        if current.get("message_count") == message_count:
+            fields.update(exact)
+        history_log.update_state(LOGS_DIR, user_id, fields)
+        return
+    matched = 0
+    if revision is not None:
+        result = collection.update_one(
+            {"_id": session_id, "history_version": revision},
+            {
+                "$set": {"context_summary": summary, "message_count": message_count, **exact},
+                "$inc": {"history_version": 1},
+            },
+        )
+        matched = result.matched_count
+    if not matched:
+        collection.update_one(
+            {"_id": session_id},
+            {"$set": {"context_summary": summary}, "$inc": {"history_version": 1}},
+        )
+    invalidate_history_cache(session_id)
+
+
 def append_message_to_history(user_id: dict) -> dict:
     """
     Appends a new message to the 'messages' list in the user's history JSON file.
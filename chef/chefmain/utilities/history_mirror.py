@@ -0,0 +1,204 @@
+"""Incremental Mongo mirror for the file-mode JSONL history.
+
+Before example: every appended message called simple_mongo_dump.save_chat_session_to_mongo, which
+opened a new MongoClient, re-read the whole history file and ``$set`` the full session snapshot.
+After example:  ``notify_append(logs_dir, "42", resolver)`` marks user 42 dirty; a background
+thread waits HISTORY_MIRROR_DEBOUNCE_SEC for the turn to settle (user + assistant messages) and
+ships only the lines past the local high-water mark as one
+``{"$push": {"messages": {"$each": [...]}}, "$inc": {"mirror_count": 2}}`` over the pooled client.
+
+The high-water mark lives next to the log (``42_history.mirror.json``). Pushes are guarded by
+``mirror_count`` on the Mongo document, so a retried or diverged mirror falls back to a single
+snapshot rewrite and the two stores converge instead of duplicating messages.
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    from utilities import history_log
+except ModuleNotFoundError:
+    # Fallback for direct script runs: import from sibling module in this folder.
+    import history_log  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+HISTORY_MIRROR_DEBOUNCE_SEC = float(os.getenv("HISTORY_MIRROR_DEBOUNCE_SEC", "0.5"))
+HISTORY_MIRROR_MAX_DELAY_SEC = float(os.getenv("HISTORY_MIRROR_MAX_DELAY_SEC", "5"))
+HISTORY_MIRROR_MAX_BATCH = int(os.getenv("HISTORY_MIRROR_MAX_BATCH", "100"))
+
+_pending: dict = {}
+_pending_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_wakeup = threading.Event()
+_worker = None
+_stats = {"flushes": 0, "pushed_messages": 0, "snapshots": 0, "failures": 0}
+
+
+def _mark_path(logs_dir: str, user_id) -> str:
+    return os.path.join(logs_dir, f"{user_id}_history.mirror.json")
+
+
+def _read_mark(logs_dir: str, user_id) -> dict:
+    try:
+        with open(_mark_path(logs_dir, user_id), "r") as handle:
+            data = json.load(handle)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_mark(logs_dir: str, user_id, mark: dict) -> None:
+    path = _mark_path(logs_dir, user_id)
+    with open(path + ".tmp", "w") as handle:
+        json.dump(mark, handle)
+    os.replace(path + ".tmp", path)
+
+
+def _header_fields(state: dict, user_id) -> dict:
+    fields = {key: value for key, value in state.items() if key not in {"system_message", "messages", "_id"}}
+    fields["user_id"] = str(user_id)
+    fields["last_updated_at"] = datetime.now(timezone.utc).isoformat()
+    return fields
+
+
+def _write_snapshot(collection, logs_dir: str, user_id, session_id: str) -> tuple:
+    # Used for a session's first mirror, or once when the remote copy diverged (e.g. old full snapshots).
+    state, messages, total = history_log.read_messages_since(logs_dir, user_id, 0)
+    system_message = (state or {}).get("system_message")
+    snapshot = _header_fields(state or {}, user_id)
+    snapshot["messages"] = ([system_message] if isinstance(system_message, dict) else []) + messages
+    snapshot["mirror_count"] = total
+    collection.update_one({"_id": session_id}, {"$set": snapshot}, upsert=True)
+    _stats["snapshots"] += 1
+    return total, (state or {}).get("system_prompt_hash")
+
+
+def flush_user(logs_dir: str, user_id, collection_resolver) -> int:
+    """Ship messages past the high-water mark for ``user_id``; returns how many were sent."""
+    with _flush_lock:
+        state = history_log.read_state(logs_dir, user_id)
+        session_id = (state or {}).get("chat_session_id")
+        if not session_id:
+            return 0
+        collection = collection_resolver(state.get("bot_mode"))
+        if collection is None:
+            return 0
+        mark = _read_mark(logs_dir, user_id)
+        start = int(mark.get("mirrored") or 0) if mark.get("chat_session_id") == session_id else 0
+        state, messages, total = history_log.read_messages_since(logs_dir, user_id, start)
+        if start == 0 or start > total:
+            mirrored, prompt_hash = _write_snapshot(collection, logs_dir, user_id, session_id)
+            sent = mirrored
+        else:
+            mirrored, prompt_hash, sent = start, mark.get("system_prompt_hash"), 0
+            header = _header_fields(state, user_id)
+            for begin in range(0, len(messages), max(1, HISTORY_MIRROR_MAX_BATCH)):
+                batch = messages[begin:begin + max(1, HISTORY_MIRROR_MAX_BATCH)]
+                result = collection.update_one(
+                    {"_id": session_id, "mirror_count": mirrored},
+                    {
+                        "$set": header,
+                        "$push": {"messages": {"$each": batch}},
+                        "$inc": {"mirror_count": len(batch)},
+                    },
+                )
+                if result.matched_count == 0:
+                    mirrored, prompt_hash = _write_snapshot(collection, logs_dir, user_id, session_id)
+                    sent = mirrored
+                    break
+                mirrored += len(batch)
+                sent += len(batch)
+            system_message = state.get("system_message")
+            if state.get("system_prompt_hash") != prompt_hash and isinstance(system_message, dict):
+                collection.update_one(
+                    {"_id": session_id},
+                    {"$set": {"messages.0": system_message, "system_prompt_hash": state.get("system_prompt_hash")}},
+                )
+                prompt_hash = state.get("system_prompt_hash")
+        _write_mark(
+            logs_dir,
+            user_id,
+            {"chat_session_id": session_id, "mirrored": mirrored, "system_prompt_hash": prompt_hash},
+        )
+    _stats["flushes"] += 1
+    _stats["pushed_messages"] += sent
+    logger.info("history_mirror_flush user_id=%s session=%s sent=%s mirrored=%s", user_id, session_id, sent, mirrored)
+    return sent
+
+
+def notify_append(logs_dir: str, user_id, collection_resolver) -> None:
+    """Schedule a debounced mirror of ``user_id``'s new messages."""
+    now = time.monotonic()
+    with _pending_lock:
+        entry = _pending.get(str(user_id))
+        if entry is None:
+            _pending[str(user_id)] = {
+                "logs_dir": logs_dir,
+                "resolver": collection_resolver,
+                "first_at": now,
+                "last_at": now,
+            }
+        else:
+            entry["last_at"] = now
+    _ensure_worker()
+    _wakeup.set()
+
+
+def _due_users(now: float, force: bool = False) -> list:
+    due = []
+    with _pending_lock:
+        for user_id, entry in list(_pending.items()):
+            settled = now - entry["last_at"] >= HISTORY_MIRROR_DEBOUNCE_SEC
+            overdue = now - entry["first_at"] >= HISTORY_MIRROR_MAX_DELAY_SEC
+            if force or settled or overdue:
+                due.append((user_id, _pending.pop(user_id)))
+    return due
+
+
+def _flush_due(force: bool = False) -> None:
+    for user_id, entry in _due_users(time.monotonic(), force=force):
+        try:
+            flush_user(entry["logs_dir"], user_id, entry["resolver"])
+        except Exception as exc:
+            _stats["failures"] += 1
+            logger.warning("history_mirror_flush_failed user_id=%s error=%s", user_id, exc)
+            if not force:
+                # Retry after another debounce window; the high-water mark keeps it idempotent.
+                notify_append(entry["logs_dir"], user_id, entry["resolver"])
+
+
+def flush_all() -> None:
+    """Mirror every pending user now (shutdown hooks and tests)."""
+    _flush_due(force=True)
+
+
+def _worker_loop() -> None:
+    while True:
+        _wakeup.wait(timeout=HISTORY_MIRROR_DEBOUNCE_SEC)
+        _wakeup.clear()
+        _flush_due()
+
+
+def _ensure_worker() -> None:
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _pending_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, name="history-mirror", daemon=True)
+            _worker.start()
+            atexit.register(flush_all)
+
+
+def mirror_stats() -> dict:
+    with _pending_lock:
+        pending = len(_pending)
+    return {**_stats, "pending_users": pending}
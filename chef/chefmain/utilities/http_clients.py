@@ -0,0 +1,292 @@
+"""Pooled HTTP clients shared by MessageRouter, Perplexity, media selection and Telegram sends.
+
+Before example: every xAI/Perplexity/Gemini call opened a fresh ``requests.post``
+connection (DNS + TCP + TLS per turn) and blocked the Telegram event loop while it waited.
+After example:  callers use ``get_async_client("xai")`` (coroutines) or
+``get_sync_client("gemini")`` (scripts/threads) and reuse one keep-alive pool per
+provider host, with HTTP/2 when ``h2`` is installed. ``get_client_stats()`` reports
+requests vs new connections/TLS handshakes so reuse can be checked in production logs.
+
+Per-client settings come from env, e.g. ``HTTP_POOL_XAI_MAX_CONNECTIONS=64`` or
+``HTTP_GEMINI_CONNECT_TIMEOUT_SEC=5``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import weakref
+
+try:  # pragma: no cover - defer httpx import errors until a client is needed
+    import httpx
+except Exception as exc:  # pragma: no cover
+    httpx = None  # type: ignore
+    logging.getLogger(__name__).warning("httpx is unavailable: %s", exc)
+
+try:  # HTTP/2 needs the optional h2 package (httpx[http2]).
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except Exception:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "32"))
+DEFAULT_MAX_KEEPALIVE = int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "16"))
+DEFAULT_KEEPALIVE_EXPIRY_SEC = float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY_SEC", "60"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1").strip().lower() not in {"0", "false", "no", "off"}
+
+# Example: "xai" -> https://api.x.ai with a 180s read timeout (same as the old requests.post call).
+HTTP_CLIENT_CONFIG = {
+    "xai": {
+        "base_url": "https://api.x.ai",
+        "read_timeout": float(os.getenv("XAI_READ_TIMEOUT_SEC", "180")),
+        "http2": True,
+    },
+    "perplexity": {
+        "base_url": "https://api.perplexity.ai",
+        "read_timeout": float(os.getenv("PERPLEXITY_READ_TIMEOUT_SEC", "120")),
+        "http2": True,
+    },
+    "gemini": {
+        "base_url": "https://generativelanguage.googleapis.com",
+        "read_timeout": float(os.getenv("GEMINI_READ_TIMEOUT_SEC", "60")),
+        "http2": True,
+    },
+    "telegram": {
+        "base_url": "https://api.telegram.org",
+        "read_timeout": 10.0,
+        "http2": True,
+    },
+}
+
+# httpx.AsyncClient pools are bound to the loop that opened them, so keep one set per loop.
+_async_clients_by_loop: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+# httpx.Client is thread-safe, so sync callers share one per process.
+_sync_clients: dict = {}
+_sync_clients_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_client_stats: dict = {}
+
+
+def _setting(name: str, key: str, default):
+    """Per-client env override, e.g. HTTP_POOL_XAI_MAX_CONNECTIONS / HTTP_XAI_CONNECT_TIMEOUT_SEC."""
+    prefix = "HTTP_POOL" if key in {"MAX_CONNECTIONS", "MAX_KEEPALIVE"} else "HTTP"
+    raw = os.getenv(f"{prefix}_{name.upper()}_{key}")
+    if raw is None or raw == "":
+        return default
+    try:
+        return type(default)(raw)
+    except (TypeError, ValueError):
+        logger.warning("http_client_bad_setting name=%s key=%s value=%s", name, key, raw)
+        return default
+
+
+def _client_settings(name: str) -> dict:
+    config = HTTP_CLIENT_CONFIG.get(name) or {}
+    http2 = bool(config.get("http2")) and HTTP2_ENABLED and HTTP2_AVAILABLE
+    return {
+        "base_url": config.get("base_url", ""),
+        "http2": http2,
+        "timeout": httpx.Timeout(
+            connect=_setting(name, "CONNECT_TIMEOUT_SEC", 10.0),
+            read=_setting(name, "READ_TIMEOUT_SEC", float(config.get("read_timeout", 120))),
+            write=_setting(name, "WRITE_TIMEOUT_SEC", 30.0),
+            pool=_setting(name, "POOL_TIMEOUT_SEC", 10.0),
+        ),
+        "limits": httpx.Limits(
+            max_connections=_setting(name, "MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS),
+            max_keepalive_connections=_setting(name, "MAX_KEEPALIVE", DEFAULT_MAX_KEEPALIVE),
+            keepalive_expiry=DEFAULT_KEEPALIVE_EXPIRY_SEC,
+        ),
+    }
+
+
+# --- reuse/handshake counters --------------------------------------------------
+
+def _record(name: str, key: str) -> None:
+    with _stats_lock:
+        stats = _client_stats.setdefault(
+            name,
+            {"requests": 0, "new_connections": 0, "tls_handshakes": 0, "prewarmed": 0},
+        )
+        stats[key] += 1
+
+
+def _record_trace_event(name: str, event_name: str) -> None:
+    # httpcore trace events, e.g. "connection.connect_tcp.complete" only fire for new connections.
+    if event_name == "connection.connect_tcp.complete":
+        _record(name, "new_connections")
+    elif event_name == "connection.start_tls.complete":
+        _record(name, "tls_handshakes")
+
+
+def get_client_stats() -> dict:
+    """Per-client counters, e.g. {"xai": {"requests": 40, "new_connections": 2, "reused": 38, ...}}."""
+    with _stats_lock:
+        snapshot = {name: dict(stats) for name, stats in _client_stats.items()}
+    for stats in snapshot.values():
+        stats["reused"] = max(0, stats["requests"] - stats["new_connections"])
+    return snapshot
+
+
+if httpx is not None:
+
+    class _TracedAsyncTransport(httpx.AsyncHTTPTransport):
+        def __init__(self, client_name: str, **kwargs):
+            super().__init__(**kwargs)
+            self._client_name = client_name
+
+        async def handle_async_request(self, request):
+            client_name = self._client_name
+
+            async def trace(event_name, info):
+                _record_trace_event(client_name, event_name)
+
+            _record(client_name, "requests")
+            request.extensions = {**request.extensions, "trace": trace}
+            return await super().handle_async_request(request)
+
+    class _TracedSyncTransport(httpx.HTTPTransport):
+        def __init__(self, client_name: str, **kwargs):
+            super().__init__(**kwargs)
+            self._client_name = client_name
+
+        def handle_request(self, request):
+            client_name = self._client_name
+
+            def trace(event_name, info):
+                _record_trace_event(client_name, event_name)
+
+            _record(client_name, "requests")
+            request.extensions = {**request.extensions, "trace": trace}
+            return super().handle_request(request)
+
+
+# --- client construction -------------------------------------------------------
+
+def _build_async_client(name: str):
+    if httpx is None:
+        raise RuntimeError("httpx is not installed; async provider calls are unavailable.")
+    settings = _client_settings(name)
+    transport = _TracedAsyncTransport(name, http2=settings["http2"], limits=settings["limits"])
+    logger.info(
+        "http_client_created name=%s kind=async base_url=%s http2=%s",
+        name,
+        settings["base_url"],
+        settings["http2"],
+    )
+    return httpx.AsyncClient(
+        base_url=settings["base_url"],
+        timeout=settings["timeout"],
+        transport=transport,
+    )
+
+
+def _build_sync_client(name: str):
+    if httpx is None:
+        raise RuntimeError("httpx is not installed; pooled provider calls are unavailable.")
+    settings = _client_settings(name)
+    transport = _TracedSyncTransport(name, http2=settings["http2"], limits=settings["limits"])
+    logger.info(
+        "http_client_created name=%s kind=sync base_url=%s http2=%s",
+        name,
+        settings["base_url"],
+        settings["http2"],
+    )
+    return httpx.Client(
+        base_url=settings["base_url"],
+        timeout=settings["timeout"],
+        transport=transport,
+    )
+
+
+def get_async_client(name: str):
+    """Return the pooled AsyncClient for ``name`` on the running event loop."""
+    loop = asyncio.get_running_loop()
+    clients = _async_clients_by_loop.setdefault(loop, {})
+    client = clients.get(name)
+    if client is None or client.is_closed:
+        client = _build_async_client(name)
+        clients[name] = client
+    return client
+
+
+def get_sync_client(name: str):
+    """Return the process-wide pooled httpx.Client for ``name`` (safe to share across threads)."""
+    client = _sync_clients.get(name)
+    if client is not None and not client.is_closed:
+        return client
+    with _sync_clients_lock:
+        client = _sync_clients.get(name)
+        if client is None or client.is_closed:
+            client = _build_sync_client(name)
+            _sync_clients[name] = client
+        return client
+
+
+# --- pre-warming ---------------------------------------------------------------
+
+async def prewarm_async_clients(names=("xai", "perplexity")) -> None:
+    """Open one pooled connection per provider so the first turn skips DNS/TCP/TLS.
+
+    Any HTTP status counts as warm; only connection errors are logged.
+    """
+
+    async def _warm(name):
+        try:
+            await get_async_client(name).head("/", timeout=5.0)
+            _record(name, "prewarmed")
+        except Exception as exc:
+            logger.warning("http_client_prewarm_failed name=%s error=%s", name, exc)
+
+    await asyncio.gather(*(_warm(name) for name in names))
+    logger.info("http_client_prewarm_done names=%s stats=%s", ",".join(names), get_client_stats())
+
+
+def prewarm_sync_clients(names=("xai", "gemini")) -> None:
+    for name in names:
+        try:
+            get_sync_client(name).head("/", timeout=5.0)
+            _record(name, "prewarmed")
+        except Exception as exc:
+            logger.warning("http_client_prewarm_failed name=%s error=%s", name, exc)
+
+
+# --- shutdown ------------------------------------------------------------------
+
+async def close_async_clients() -> None:
+    """Close every pooled client that belongs to the running event loop."""
+    loop = asyncio.get_running_loop()
+    clients = _async_clients_by_loop.pop(loop, {})
+    for name, client in clients.items():
+        try:
+            await client.aclose()
+        except Exception as exc:
+            logger.warning("http_client_close_failed name=%s error=%s", name, exc)
+
+
+def close_sync_clients() -> None:
+    with _sync_clients_lock:
+        clients = dict(_sync_clients)
+        _sync_clients.clear()
+    for name, client in clients.items():
+        try:
+            client.close()
+        except Exception as exc:
+            logger.warning("http_client_close_failed name=%s error=%s", name, exc)
+
+
+def run_sync(coroutine):
+    """Run ``coroutine`` from synchronous code and release its pooled clients afterwards."""
+
+    async def _runner():
+        try:
+            return await coroutine
+        finally:
+            await close_async_clients()
+
+    return asyncio.run(_runner())
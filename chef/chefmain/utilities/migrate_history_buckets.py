@@ -0,0 +1,83 @@
+"""Move inline ``messages`` arrays in the chat session collections into message buckets.
+
+Before example: chat_sessions/{_id: "42_0101..."} holds every turn in one ``messages`` array.
+After example:  the same document is a small header (storage="bucketed", message_count, system_message)
+and the turns live in chat_sessions_buckets/{_id: "42_0101...:000000"} ... in HISTORY_BUCKET_SIZE chunks.
+
+Run with ``MONGODB_URI`` set, before or after switching the app to ``HISTORY_STORAGE=bucketed``:
+
+    python utilities/migrate_history_buckets.py --mode general --dry-run
+    python utilities/migrate_history_buckets.py            # every mode in bot_config.BOT_CONFIG
+
+Re-running is safe: bucketed sessions are skipped and sessions that changed mid-migration are reported.
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sys
+
+try:
+    from utilities import history_messages
+except ModuleNotFoundError:
+    # Fallback for direct script runs: import from sibling module in this folder.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from utilities import history_messages
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Migrate inline chat session messages into buckets.")
+    parser.add_argument(
+        "--mode",
+        action="append",
+        help="Bot mode to migrate (repeatable). Defaults to every mode in bot_config.",
+    )
+    parser.add_argument("--limit", type=int, help="Optional cap on sessions migrated per mode.")
+    parser.add_argument("--dry-run", action="store_true", help="Count messages without writing.")
+    return parser.parse_args()
+
+
+def _all_modes() -> list:
+    module = history_messages._get_bot_config_module()
+    config = getattr(module, "BOT_CONFIG", None) if module else None
+    return list(config) if isinstance(config, dict) else [history_messages._get_default_bot_mode()]
+
+
+def migrate_mode(bot_mode: str, limit: int | None = None, dry_run: bool = False) -> dict:
+    collection = history_messages._get_mongo_collection(bot_mode)
+    if collection is None:
+        raise RuntimeError("MONGODB_URI is not set. Provide a mongodb+srv:// connection string.")
+    summary = {"sessions": 0, "messages": 0, "changed_during_migration": 0}
+    cursor = collection.find({"storage": {"$ne": "bucketed"}, "messages": {"$type": "array"}})
+    if limit:
+        cursor = cursor.limit(limit)
+    for doc in cursor:
+        moved = history_messages.migrate_session_to_buckets(collection, doc, dry_run=dry_run)
+        if moved < 0:
+            summary["changed_during_migration"] += 1
+            logging.warning("history_bucket_migration_retry mode=%s session=%s", bot_mode, doc.get("_id"))
+            continue
+        summary["sessions"] += 1
+        summary["messages"] += moved
+    logging.info(
+        "history_bucket_migration mode=%s dry_run=%s sessions=%s messages=%s changed=%s",
+        bot_mode,
+        dry_run,
+        summary["sessions"],
+        summary["messages"],
+        summary["changed_during_migration"],
+    )
+    return summary
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args()
+    for bot_mode in args.mode or _all_modes():
+        migrate_mode(bot_mode, limit=args.limit, dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""Process-wide MongoClient registry shared by history, media, status and dump helpers.
+
+Before example: history_messages opened one MongoClient per (db, collection) plus one for the
+mode store, mongo_media kept another, simple_mongo_dump built one per call and status_api opened
+and closed one per HTTP request -- each with its own pool and monitor threads.
+After example:  every module calls ``get_mongo_client()`` (or ``get_collection("chef_chatbot",
+"chat_sessions")``) and shares one pooled client per URI; ``get_mongo_pool_stats()`` reports
+connections created/in use/checked out so pool sizing can be checked in production logs.
+
+Pool settings come from env, e.g. ``MONGO_MAX_POOL_SIZE=20`` or ``MONGO_MAX_IDLE_TIME_MS=60000``.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from urllib.parse import urlsplit
+
+try:  # pragma: no cover - defer pymongo import errors until a client is needed
+    from pymongo import MongoClient
+    from pymongo import monitoring
+except Exception as exc:  # pragma: no cover
+    MongoClient = None  # type: ignore
+    monitoring = None  # type: ignore
+    logging.getLogger(__name__).warning("pymongo is unavailable: %s", exc)
+
+logger = logging.getLogger(__name__)
+
+
+def _int_env(name: str, default: int) -> int:
+    raw = os.getenv(name)
+    if raw is None or raw == "":
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        logger.warning("mongo_client_bad_setting name=%s value=%s", name, raw)
+        return default
+
+
+# Example: MONGO_MAX_POOL_SIZE=20 on a 1-vCPU Cloud Run instance instead of pymongo's default 100.
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": _int_env("MONGO_MAX_POOL_SIZE", 20),
+    "minPoolSize": _int_env("MONGO_MIN_POOL_SIZE", 0),
+    "maxIdleTimeMS": _int_env("MONGO_MAX_IDLE_TIME_MS", 120000),
+    "connectTimeoutMS": _int_env("MONGO_CONNECT_TIMEOUT_MS", 10000),
+    "serverSelectionTimeoutMS": _int_env("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000),
+    "appname": os.getenv("MONGO_APP_NAME", "chefmain"),
+}
+
+_clients: dict = {}
+_clients_lock = threading.Lock()
+_close_hooks: list = []
+_pool_stats: dict = {}
+_pool_stats_lock = threading.Lock()
+
+
+def _redact(uri: str) -> str:
+    # Example: "mongodb+srv://user:pw@cluster0.abc.mongodb.net/chef" -> "cluster0.abc.mongodb.net".
+    try:
+        return urlsplit(uri).netloc.rsplit("@", 1)[-1] or "default"
+    except ValueError:
+        return "default"
+
+
+def _record(label: str, key: str, delta: int = 1) -> None:
+    with _pool_stats_lock:
+        stats = _pool_stats.setdefault(
+            label,
+            {
+                "clients_created": 0,
+                "connections_created": 0,
+                "connections_closed": 0,
+                "checked_out": 0,
+                "checked_in": 0,
+                "checkout_failures": 0,
+                "pool_clears": 0,
+            },
+        )
+        stats[key] += delta
+
+
+if monitoring is not None:
+
+    class _PoolListener(monitoring.ConnectionPoolListener):
+        def __init__(self, label: str):
+            self._label = label
+
+        def pool_created(self, event):
+            pass
+
+        def pool_ready(self, event):
+            pass
+
+        def pool_cleared(self, event):
+            _record(self._label, "pool_clears")
+
+        def pool_closed(self, event):
+            pass
+
+        def connection_created(self, event):
+            _record(self._label, "connections_created")
+
+        def connection_ready(self, event):
+            pass
+
+        def connection_closed(self, event):
+            _record(self._label, "connections_closed")
+
+        def connection_check_out_started(self, event):
+            pass
+
+        def connection_check_out_failed(self, event):
+            _record(self._label, "checkout_failures")
+
+        def connection_checked_out(self, event):
+            _record(self._label, "checked_out")
+
+        def connection_checked_in(self, event):
+            _record(self._label, "checked_in")
+
+
+def get_mongo_client(uri: str | None = None):
+    """Return the shared MongoClient for ``uri`` (default ``MONGODB_URI``), or None when unavailable."""
+    uri = uri or os.environ.get("MONGODB_URI")
+    if not uri or MongoClient is None:
+        return None
+    # MongoClient is not fork-safe, so a forked worker gets its own client.
+    key = (uri, os.getpid())
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            label = _redact(uri)
+            options = dict(MONGO_CLIENT_OPTIONS)
+            if monitoring is not None:
+                options["event_listeners"] = [_PoolListener(label)]
+            client = MongoClient(uri, **options)
+            _clients[key] = client
+            _record(label, "clients_created")
+            logger.info(
+                "mongo_client_created host=%s max_pool=%s min_pool=%s",
+                label,
+                options["maxPoolSize"],
+                options["minPoolSize"],
+            )
+        return client
+
+
+def get_collection(database_name: str, collection_name: str, uri: str | None = None):
+    client = get_mongo_client(uri)
+    if client is None:
+        return None
+    return client[database_name][collection_name]
+
+
+def get_mongo_pool_stats() -> dict:
+    """Per-host counters, e.g. {"cluster0...": {"connections_created": 3, "in_use": 1, ...}}."""
+    with _pool_stats_lock:
+        snapshot = {label: dict(stats) for label, stats in _pool_stats.items()}
+    for stats in snapshot.values():
+        stats["open_connections"] = stats["connections_created"] - stats["connections_closed"]
+        stats["in_use"] = max(0, stats["checked_out"] - stats["checked_in"])
+    return snapshot
+
+
+def register_close_hook(hook) -> None:
+    """Run ``hook()`` at the start of ``close_mongo_clients()``, e.g. to stop a change stream thread."""
+    if hook not in _close_hooks:
+        _close_hooks.append(hook)
+
+
+def close_mongo_clients() -> None:
+    for hook in list(_close_hooks):
+        try:
+            hook()
+        except Exception as exc:
+            logger.warning("mongo_close_hook_failed hook=%s error=%s", getattr(hook, "__name__", hook), exc)
+    with _clients_lock:
+        clients = dict(_clients)
+        _clients.clear()
+    for (uri, _pid), client in clients.items():
+        try:
+            client.close()
+        except Exception as exc:
+            logger.warning("mongo_client_close_failed host=%s error=%s", _redact(uri), exc)
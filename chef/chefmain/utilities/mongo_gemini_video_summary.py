@@ -12,7 +12,12 @@ from typing import Optional
 from urllib.parse import urlparse
 
 import requests
-from pymongo import MongoClient
+
+try:
+    from utilities.mongo_clients import get_mongo_client
+except ModuleNotFoundError:
+    # Fallback for direct script runs: import from sibling module in this folder.
+    from mongo_clients import get_mongo_client  # type: ignore
 
 try:  # pragma: no cover - optional dependency
     from google import genai
@@ -36,7 +41,7 @@ def get_media_collection():
     # After example:  collection name read once and reused here.
     db_name = os.environ.get("MONGODB_DB_NAME", "chef_chatbot")
     collection_name = os.environ.get("MONGODB_MEDIA_COLLECTION", "media_metadata")
-    client = MongoClient(mongo_uri)
+    client = get_mongo_client(mongo_uri)
     return client[db_name][collection_name]
 
 
@@ -18,16 +18,23 @@ except Exception as exc:  # pragma: no cover
     gridfs = None  # type: ignore
     logging.getLogger(__name__).warning("pymongo is unavailable: %s", exc)
 
+try:
+    # Inside chefmain this is the same registry history_messages uses.
+    from utilities.mongo_clients import get_mongo_client
+except ModuleNotFoundError:
+    # Before example: chefdietlog's "utilities" package has no mongo_clients -> ImportError.
+    # After example:  fall back to the chef-root import path used by firebase.py.
+    from chefmain.utilities.mongo_clients import get_mongo_client  # type: ignore
+
 DEFAULT_DB_NAME = "chef_chatbot"
 DEFAULT_GRIDFS_COLLECTION = "chat_media"
 
-_client: Optional[MongoClient] = None
 _gridfs_bucket: Optional[gridfs.GridFS] = None  # type: ignore
 
 
 def _get_gridfs_bucket() -> Optional[gridfs.GridFS]:  # type: ignore
     """Return a cached GridFS bucket or None if requirements are missing."""
-    global _client, _gridfs_bucket
+    global _gridfs_bucket
 
     if gridfs is None or MongoClient is None:
         return None
@@ -40,14 +47,13 @@ def _get_gridfs_bucket() -> Optional[gridfs.GridFS]:  # type: ignore
         logging.warning("MONGODB_URI not set; skipping media upload to MongoDB")
         return None
 
-    client = MongoClient(uri)
+    client = get_mongo_client(uri)
     db_name = os.environ.get("MONGODB_DB_NAME", DEFAULT_DB_NAME)
     bucket_name = os.environ.get("MONGODB_GRIDFS_COLLECTION", DEFAULT_GRIDFS_COLLECTION)
 
     db = client[db_name]
     bucket = gridfs.GridFS(db, collection=bucket_name)
 
-    _client = client
     _gridfs_bucket = bucket
     return _gridfs_bucket
 
@@ -82,7 +88,6 @@ def store_media_file(local_path: str, session_info: Dict, media_type: str) -> Op
 
 def create_media_metadata(url: str, indexed_at: str) -> None:
     """Create metadata entry for media URL in MongoDB."""
-    global _client
     if MongoClient is None:
         logging.warning("MongoDB client unavailable; cannot create media metadata")
         return
@@ -94,10 +99,8 @@ def create_media_metadata(url: str, indexed_at: str) -> None:
 
     try:
         # Before example: new MongoClient() per call -> repeated TLS/DNS handshake.
-        # After example: reuse cached client -> faster inserts on Cloud Run.
-        if _client is None:
-            _client = MongoClient(uri)
-        client = _client
+        # After example: reuse the process-wide pooled client -> faster inserts on Cloud Run.
+        client = get_mongo_client(uri)
         db_name = os.environ.get("MONGODB_DB_NAME", DEFAULT_DB_NAME)
         db = client[db_name]
         collection = db["media_metadata"]
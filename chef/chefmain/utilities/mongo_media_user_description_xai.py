@@ -17,9 +17,16 @@ from datetime import datetime, timezone
 from typing import Dict, Iterable, List, Optional
 from urllib.parse import urlparse
 
-import requests
 from pymongo import MongoClient
 
+try:
+    from utilities.http_clients import get_sync_client
+    from utilities.mongo_clients import get_mongo_client as get_shared_mongo_client
+except ModuleNotFoundError:
+    # Fallback for direct script runs: import from sibling module in this folder.
+    from http_clients import get_sync_client  # type: ignore
+    from mongo_clients import get_mongo_client as get_shared_mongo_client  # type: ignore
+
 MEDIA_PREFIXES = ("[photo_url:", "[video_url:", "[audio_url:")
 IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
 VIDEO_EXTENSIONS = (".mp4", ".mov", ".webm", ".mkv", ".avi", ".m4v")
@@ -88,7 +95,7 @@ def get_mongo_client() -> MongoClient:
     uri = os.environ.get("MONGODB_URI")
     if not uri:
         raise SystemExit("Set MONGODB_URI before running this script.")
-    return MongoClient(uri)
+    return get_shared_mongo_client(uri)
 
 
 def get_media_collection(client: MongoClient):
@@ -357,7 +364,9 @@ def call_gemini_select(
             "maxOutputTokens": 120,
         },
     }
-    response = requests.post(
+    # Before example: requests.post -> new TLS handshake per selection call.
+    # After example:  the pooled "gemini" client reuses one keep-alive connection across the backfill.
+    response = get_sync_client("gemini").post(
         GEMINI_URL.format(model=model),
         params={"key": api_key},
         json=payload,
@@ -434,7 +443,7 @@ def call_xai_select(
         "max_tokens": 120,
         "temperature": 0,
     }
-    response = requests.post(
+    response = get_sync_client("xai").post(
         XAI_URL,
         headers={
             "Authorization": f"Bearer {api_key}",
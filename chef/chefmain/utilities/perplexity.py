@@ -1,7 +1,23 @@
 
+import inspect
 import json
+import logging
 import os
-import requests
+import time
+
+import httpx
+
+try:
+    from utilities import cancellation, perplexity_cache, resilience
+    from utilities.http_clients import get_async_client, get_sync_client
+except ModuleNotFoundError:
+    # Fallback for direct script runs: import from sibling module in this folder.
+    import cancellation  # type: ignore
+    import perplexity_cache  # type: ignore
+    import resilience  # type: ignore
+    from http_clients import get_async_client, get_sync_client  # type: ignore
+
+logger = logging.getLogger(__name__)
 
 try:
     YOUR_API_KEY = os.environ.get('PERPLEXITY_KEY')
@@ -10,16 +26,9 @@ try:
 except KeyError:
     raise ValueError("The 'PERPLEXITY_KEY' environment variable is not set.")
 
-def search_perplexity(query, stream_callback=None, should_stop=None):
-    """
-    Performs a search using the Perplexity API and returns the summarized result with citations.
-    Use this tool for general web searches, finding explanations, or getting summaries on topics.
-    Args:
-        query: Either a string for simple queries or a list of message dicts for conversation context
-    """
-    print(f'**DEBUG: search_perplexity triggered with query type: {type(query)}**')
-    print(f'**DEBUG: query content: {query}**')
 
+def _build_perplexity_request(query):
+    """Return (headers, data) for one Perplexity chat completion request."""
     # If query is a string, treat as single message. If list, use as conversation history
     if isinstance(query, str):
         query_messages = [{"role": "user", "content": query}]
@@ -54,112 +63,230 @@ def search_perplexity(query, stream_callback=None, should_stop=None):
              "search_domain_filter": ["reddit.com"] # Automatic classification
         }  # Get detailed reasoning tokens
     }
+    return headers, data
+
+
+def _parse_stream_line(line):
+    """Decode one SSE line into a JSON chunk (None for keep-alives and non-JSON lines)."""
+    if not line:
+        return None
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    # Remove 'data: ' prefix and parse JSON
+    try:
+        return json.loads(line.removeprefix('data: '))
+    except json.JSONDecodeError:
+        # Skip lines that aren't JSON
+        return None
+
+
+def _collect_citations(decoded_line, seen_citations, citations):
+    # Handle citations - only add new ones
+    for citation in decoded_line.get('citations') or []:
+        if citation not in seen_citations:
+            seen_citations.add(citation)
+            citations.append(citation)
+
+
+def _format_perplexity_result(full_content, citations, stopped_early):
+    """Format streamed content + citations into the single tool-output string."""
+    if stopped_early:
+        partial_text = full_content.strip()
+        if not partial_text:
+            return "Stopped by user before first token.\n\n[Stopped by user]"
+        return f"{partial_text}\n\n[Stopped by user]"
+
+    structured_citations = [{"index": i + 1, "url": url} for i, url in enumerate(citations)]
+
+    # Format the result with content and citations in a single string
+    formatted_result = full_content
+
+    # Add citations at the end if there are any
+    if structured_citations:
+        formatted_result += "\n\nCitations:\n"
+        for citation in structured_citations:
+            formatted_result += f"[{citation['index']}] {citation['url']}\n"
+
+    return formatted_result
+
+
+def _finish_search(probe, started, content_parts, citations, stopped_early):
+    """Format the tool output and cache it when the search completed with content."""
+    full_content = "".join(content_parts)
+    result = _format_perplexity_result(full_content, citations, stopped_early)
+    if not stopped_early and full_content.strip():
+        perplexity_cache.store(probe, full_content, result, (time.monotonic() - started) * 1000)
+    return result
+
+
+def search_perplexity(query, stream_callback=None, should_stop=None):
+    """
+    Performs a search using the Perplexity API and returns the summarized result with citations.
+    Use this tool for general web searches, finding explanations, or getting summaries on topics.
+    Args:
+        query: Either a string for simple queries or a list of message dicts for conversation context
+        stream_callback: Receives each new content delta (only the new tokens, not the text so far)
+    """
+    print(f'**DEBUG: search_perplexity triggered with query type: {type(query)}**')
+    print(f'**DEBUG: query content: {query}**')
+
+    # Before example: a repeated question paid a full pro search. After example: served from
+    # perplexity_cache and streamed back in chunks (see utilities/perplexity_cache.py).
+    cached, probe = perplexity_cache.lookup(query)
+    if cached is not None:
+        if callable(stream_callback):
+            for chunk in perplexity_cache.stream_chunks(cached["content"]):
+                stream_callback(chunk)
+        return cached["result"]
+
+    headers, data = _build_perplexity_request(query)
+    started = time.monotonic()
 
     try:
         print("\n=== Streaming reasoning tokens: ===\n")
-        response = requests.post(
-            "https://api.perplexity.ai/chat/completions",
-            headers=headers,
-            json=data,
-            stream=True,
-            timeout=120
-        )
-        response.raise_for_status()
-        
-        # Collect the complete response while streaming reasoning tokens
-        full_content = ""
-        seen_citations = set()  # Use a set to track unique citations
-        citations = []
-        stopped_early = False
-        
-        for line in response.iter_lines():
-            if callable(should_stop) and should_stop():
-                stopped_early = True
-                break
-            if line:
+        # Before example: requests.post opened a new TLS connection per search.
+        # After example:  the shared pooled "perplexity" client reuses a keep-alive connection.
+        client = get_sync_client("perplexity")
+        with client.stream("POST", "/chat/completions", headers=headers, json=data) as response:
+            if response.is_error:
+                response.read()
+                try:
+                    error_details = response.json()
+                    print(f"Error details: {json.dumps(error_details, indent=2)}")
+                    return f"Error accessing Perplexity: {error_details.get('error', {}).get('message', response.text[:200])}"
+                except json.JSONDecodeError:
+                    print(f"Could not decode JSON error response. Status code: {response.status_code}, Response text: {response.text}")
+                    return f"Error accessing Perplexity: Status {response.status_code} - {response.reason_phrase}"
+
+            # Collect the complete response while streaming reasoning tokens
+            content_parts = []
+            seen_citations = set()  # Use a set to track unique citations
+            citations = []
+            stopped_early = False
+
+            for line in response.iter_lines():
+                if callable(should_stop) and should_stop():
+                    stopped_early = True
+                    break
                 try:
-                    # Remove 'data: ' prefix and parse JSON
-                    decoded_line = json.loads(line.decode('utf-8').removeprefix('data: '))
-                    
+                    decoded_line = _parse_stream_line(line)
+                    if not decoded_line:
+                        continue
                     # Extract the delta content (new tokens) if present
                     if 'choices' in decoded_line and len(decoded_line['choices']) > 0:
                         delta = decoded_line['choices'][0].get('delta', {})
                         if 'content' in delta:
                             # Print just the new content tokens
                             print(delta['content'], end='', flush=True)
-                            full_content += delta['content']
+                            content_parts.append(delta['content'])
                             if callable(stream_callback):
-                                # Before example: streaming output lived only in local stdout.
-                                # After example:  streaming output can update a Telegram-edited message.
-                                stream_callback(full_content)
-                        # Handle citations - only add new ones
-                        if 'citations' in decoded_line:
-                            for citation in decoded_line['citations']:
-                                if citation not in seen_citations:
-                                    seen_citations.add(citation)
-                                    citations.append(citation)
-                except json.JSONDecodeError:
-                    # Skip lines that aren't JSON
-                    continue
+                                # Before example: the callback got full_content (O(n^2) over the answer).
+                                # After example:  the callback gets only the new tokens.
+                                stream_callback(delta['content'])
+                        _collect_citations(decoded_line, seen_citations, citations)
                 except Exception as e:
                     print(f"Error processing stream line: {e}")
                     continue
-        
-        print("\n=== End of reasoning tokens ===\n")
 
-        if stopped_early:
-            partial_text = full_content.strip()
-            if not partial_text:
-                return "Stopped by user before first token.\n\n[Stopped by user]"
-            return f"{partial_text}\n\n[Stopped by user]"
-        
-        # Create response_data structure matching the non-streaming format
-        response_data = {
-            'choices': [{
-                'message': {
-                    'content': full_content
-                }
-            }],
-            'citations': citations
-        }
+        print("\n=== End of reasoning tokens ===\n")
+        return _finish_search(probe, started, content_parts, citations, stopped_early)
 
-        # Extract content and citations
-        content = ""
-        citations = []
-
-        if 'choices' in response_data and len(response_data['choices']) > 0:
-            message = response_data['choices'][0].get('message', {})
-            content = message.get('content', '')
-            citations = response_data.get('citations', [])
-            structured_citations = [{"index": i + 1, "url": url} for i, url in enumerate(citations)]
-            
-            # Format the result with content and citations in a single string
-            formatted_result = content
-            
-            # Add citations at the end if there are any
-            if structured_citations:
-                formatted_result += "\n\nCitations:\n"
-                for citation in structured_citations:
-                    formatted_result += f"[{citation['index']}] {citation['url']}\n"
-            
-            return formatted_result
-
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error calling Perplexity API: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            try:
-                error_details = e.response.json()
-                print(f"Error details: {json.dumps(error_details, indent=2)}")
-                return f"Error accessing Perplexity: {error_details.get('error', {}).get('message', str(e))}"
-            except json.JSONDecodeError:
-                print(f"Could not decode JSON error response. Status code: {e.response.status_code}, Response text: {e.response.text}")
-                return f"Error accessing Perplexity: Status {e.response.status_code} - {e.response.reason}"
         return f"Error accessing Perplexity: {str(e)}"
     except Exception as e:
         print(f"An unexpected error occurred in search_perplexity: {e}")
         return f"An unexpected error occurred: {str(e)}"
 
 
+async def _stream_search_attempt(headers, data, stream_callback, should_stop, on_first_token):
+    """One streamed Perplexity request; returns (content_parts, citations, stopped_early).
+
+    Upstream errors raise ``httpx.HTTPStatusError`` carrying the API's message, so
+    utilities/resilience.py can tell a 503 (provider failure) from a 400.
+    """
+    if cancellation.is_cancelled():
+        # e.g. a parallel tool call that was still waiting for a TOOL_MAX_PARALLEL slot at /stop.
+        return [], [], True
+    # Before example: requests.post blocked the Telegram loop for the whole search.
+    # After example:  the search awaits a pooled keep-alive connection instead.
+    client = get_async_client("perplexity")
+    content_parts = []
+    seen_citations = set()
+    citations = []
+    stopped_early = False
+    # /stop cancels this block directly, so a stalled search releases its connection at once.
+    async with cancellation.guard():
+        async with client.stream("POST", "/chat/completions", headers=headers, json=data) as response:
+            if response.is_error:
+                body = (await response.aread()).decode("utf-8", errors="replace")
+                try:
+                    message = json.loads(body).get('error', {}).get('message', body[:200])
+                except (json.JSONDecodeError, AttributeError):
+                    message = f"Status {response.status_code} - {response.reason_phrase}"
+                raise httpx.HTTPStatusError(message, request=response.request, response=response)
+
+            async for line in response.aiter_lines():
+                if callable(should_stop) and should_stop():
+                    stopped_early = True
+                    break
+                try:
+                    decoded_line = _parse_stream_line(line)
+                    if not decoded_line:
+                        continue
+                    choices = decoded_line.get('choices') or []
+                    if choices:
+                        delta = choices[0].get('delta', {})
+                        if 'content' in delta:
+                            if not content_parts:
+                                await on_first_token()
+                            content_parts.append(delta['content'])
+                            if callable(stream_callback):
+                                result = stream_callback(delta['content'])
+                                if inspect.isawaitable(result):
+                                    await result
+                        _collect_citations(decoded_line, seen_citations, citations)
+                except Exception as e:
+                    logger.warning("perplexity_stream_line_error error=%s", e)
+                    continue
+    if cancellation.is_cancelled():
+        stopped_early = True
+    return content_parts, citations, stopped_early
+
+
+async def search_perplexity_async(query, stream_callback=None, should_stop=None):
+    """Async twin of :func:`search_perplexity` on the pooled ``perplexity`` client.
+
+    ``stream_callback`` may be a plain function or a coroutine function; it receives
+    each new content delta, not the text so far. The request goes through
+    utilities/resilience.py (hedged past the recent p95, circuit breaker, request deadline).
+    """
+    logger.debug("search_perplexity_async start query_type=%s", type(query).__name__)
+
+    cached, probe = await perplexity_cache.lookup_async(query)
+    if cached is not None:
+        if callable(stream_callback):
+            for chunk in perplexity_cache.stream_chunks(cached["content"]):
+                result = stream_callback(chunk)
+                if inspect.isawaitable(result):
+                    await result
+        return cached["result"]
+
+    headers, data = _build_perplexity_request(query)
+    started = time.monotonic()
+    try:
+        content_parts, citations, stopped_early = await resilience.call_provider(
+            "perplexity",
+            lambda on_first_token: _stream_search_attempt(
+                headers, data, stream_callback, should_stop, on_first_token
+            ),
+        )
+        return _finish_search(probe, started, content_parts, citations, stopped_early)
+    except Exception as e:
+        logger.warning("perplexity_call_error error=%s", e)
+        return f"Error accessing Perplexity: {str(e) or type(e).__name__}"
+
+
 if __name__ == "__main__":
     test_query = "Best cookie recipe's. only return personal experiences from reddit users"
     print(f"Testing Perplexity with query: '{test_query}'")
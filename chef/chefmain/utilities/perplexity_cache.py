@@ -0,0 +1,263 @@
+"""Result cache in front of utilities/perplexity.search_perplexity(_async).
+
+Before example: two users asked "Best way to reheat pizza?" and "best way to reheat pizza" five
+minutes apart; both paid a ``search_type: pro`` Perplexity call (~10s, per-request cost).
+After example:  both normalize to "best way to reheat pizza"; the second is answered from memory
+and its stored content still streams through ``stream_callback`` in small chunks.
+
+The key is the normalized question plus the PERPLEXITY_CACHE_CONTEXT_MESSAGES turns before it, so
+a follow-up like "what about pork?" only matches the same follow-up after the same exchange.
+Entries live PERPLEXITY_CACHE_TTL_SEC and at most PERPLEXITY_CACHE_MAX_ENTRIES are kept (LRU).
+
+Near-duplicates are opt-in: with PERPLEXITY_CACHE_SIMILARITY=0.93 an exact miss embeds the key
+text (Gemini ``text-embedding-004``) and reuses an entry whose cosine similarity is at least that.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import math
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+try:
+    from utilities import cancellation
+    from utilities.http_clients import get_async_client, get_sync_client
+except ModuleNotFoundError:
+    # Fallback for direct script runs: import from sibling module in this folder.
+    import cancellation  # type: ignore
+    from http_clients import get_async_client, get_sync_client  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+PERPLEXITY_CACHE_TTL_SEC = float(os.getenv("PERPLEXITY_CACHE_TTL_SEC", "900"))
+PERPLEXITY_CACHE_MAX_ENTRIES = int(os.getenv("PERPLEXITY_CACHE_MAX_ENTRIES", "512"))
+PERPLEXITY_CACHE_CONTEXT_MESSAGES = int(os.getenv("PERPLEXITY_CACHE_CONTEXT_MESSAGES", "2"))
+# 0 disables embedding lookups; 0.9-0.95 catches rephrasings without merging different dishes.
+PERPLEXITY_CACHE_SIMILARITY = float(os.getenv("PERPLEXITY_CACHE_SIMILARITY", "0"))
+PERPLEXITY_CACHE_EMBED_MODEL = os.getenv("PERPLEXITY_CACHE_EMBED_MODEL", "text-embedding-004")
+PERPLEXITY_CACHE_STREAM_CHUNK_CHARS = 80
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_stats = {
+    "hits": 0,
+    "near_hits": 0,
+    "misses": 0,
+    "stores": 0,
+    "evictions": 0,
+    "expired": 0,
+    "saved_ms": 0,
+    "embed_errors": 0,
+}
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text) -> str:
+    """Example: "  Best way to REHEAT pizza?? " -> "best way to reheat pizza"."""
+    text = unicodedata.normalize("NFKC", str(text or "")).lower()
+    return _WHITESPACE.sub(" ", _PUNCTUATION.sub(" ", text)).strip()
+
+
+def cache_text(query) -> str:
+    """Normalized question plus its context window, e.g. "reheat pizza || what about pasta"."""
+    if isinstance(query, str):
+        return normalize_text(query)
+    messages = [
+        message
+        for message in query or []
+        if isinstance(message, dict) and message.get("role") in {"user", "assistant"} and message.get("content")
+    ]
+    if not messages:
+        return ""
+    context = messages[:-1][-PERPLEXITY_CACHE_CONTEXT_MESSAGES:] if PERPLEXITY_CACHE_CONTEXT_MESSAGES > 0 else []
+    return " || ".join(normalize_text(message["content"]) for message in context + messages[-1:])
+
+
+def _probe(query) -> dict:
+    text = cache_text(query)
+    return {"text": text, "key": hashlib.sha1(text.encode("utf-8")).hexdigest() if text else None, "embedding": None}
+
+
+def _fresh(entry: dict, now: float) -> bool:
+    return now - entry["stored_at"] < PERPLEXITY_CACHE_TTL_SEC
+
+
+def _lookup_exact(probe: dict) -> dict | None:
+    if not probe["key"]:
+        return None
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(probe["key"])
+        if entry is None:
+            return None
+        if not _fresh(entry, now):
+            _entries.pop(probe["key"], None)
+            _stats["expired"] += 1
+            return None
+        _entries.move_to_end(probe["key"])
+        return entry
+
+
+def _cosine(left: list, right: list) -> float:
+    dot = sum(a * b for a, b in zip(left, right))
+    norm = math.sqrt(sum(a * a for a in left)) * math.sqrt(sum(b * b for b in right))
+    return dot / norm if norm else 0.0
+
+
+def _lookup_similar(probe: dict) -> dict | None:
+    if probe["embedding"] is None:
+        return None
+    now = time.monotonic()
+    best, best_score = None, PERPLEXITY_CACHE_SIMILARITY
+    with _lock:
+        for entry in _entries.values():
+            if entry.get("embedding") is None or not _fresh(entry, now):
+                continue
+            score = _cosine(probe["embedding"], entry["embedding"])
+            if score >= best_score:
+                best, best_score = entry, score
+    if best is not None:
+        logger.info("perplexity_cache_near_hit score=%.3f text='%s'", best_score, probe["text"][:120])
+    return best
+
+
+def _embedding_request(text: str):
+    api_key = os.environ.get("GEMINI_API_KEY") or os.environ.get("GOOGLE_API_KEY")
+    if not api_key:
+        return None
+    return (
+        f"/v1beta/models/{PERPLEXITY_CACHE_EMBED_MODEL}:embedContent",
+        {"key": api_key},
+        {"content": {"parts": [{"text": text}]}},
+    )
+
+
+def _count(name: str) -> None:
+    with _lock:
+        _stats[name] += 1
+
+
+def _embedding_values(response) -> list | None:
+    if response.status_code != 200:
+        _count("embed_errors")
+        logger.warning("perplexity_cache_embed http_error status=%s", response.status_code)
+        return None
+    return (response.json().get("embedding") or {}).get("values") or None
+
+
+def _hit(entry: dict, near: bool) -> dict:
+    with _lock:
+        _stats["near_hits" if near else "hits"] += 1
+        _stats["saved_ms"] += entry["latency_ms"]
+        entry["hits"] += 1
+    return entry
+
+
+def lookup(query) -> tuple:
+    """Blocking lookup; returns (entry or None, probe). Pass ``probe`` to :func:`store` on a miss."""
+    probe = _probe(query)
+    entry = _lookup_exact(probe)
+    if entry is not None:
+        return _hit(entry, near=False), probe
+    if PERPLEXITY_CACHE_SIMILARITY > 0 and probe["text"]:
+        request = _embedding_request(probe["text"])
+        if request is not None:
+            path, params, payload = request
+            try:
+                probe["embedding"] = _embedding_values(
+                    get_sync_client("gemini").post(path, params=params, json=payload, timeout=5)
+                )
+            except Exception as exc:
+                _count("embed_errors")
+                logger.warning("perplexity_cache_embed error=%s", exc)
+            entry = _lookup_similar(probe)
+            if entry is not None:
+                return _hit(entry, near=True), probe
+    _count("misses")
+    return None, probe
+
+
+async def lookup_async(query) -> tuple:
+    """Async twin of :func:`lookup` (embedding call on the pooled async gemini client)."""
+    probe = _probe(query)
+    entry = _lookup_exact(probe)
+    if entry is not None:
+        return _hit(entry, near=False), probe
+    if PERPLEXITY_CACHE_SIMILARITY > 0 and probe["text"]:
+        request = _embedding_request(probe["text"])
+        if request is not None:
+            path, params, payload = request
+            try:
+                response = None
+                async with cancellation.guard():
+                    response = await get_async_client("gemini").post(path, params=params, json=payload, timeout=5)
+                if response is not None:
+                    probe["embedding"] = _embedding_values(response)
+            except Exception as exc:
+                _count("embed_errors")
+                logger.warning("perplexity_cache_embed error=%s", exc)
+            entry = _lookup_similar(probe)
+            if entry is not None:
+                return _hit(entry, near=True), probe
+    _count("misses")
+    return None, probe
+
+
+def store(probe: dict, content: str, result: str, latency_ms: int) -> None:
+    """Remember a completed search; ``content`` is what streamed, ``result`` adds the citations."""
+    if PERPLEXITY_CACHE_MAX_ENTRIES <= 0 or not probe.get("key") or not content:
+        return
+    entry = {
+        "content": content,
+        "result": result,
+        "stored_at": time.monotonic(),
+        "latency_ms": int(latency_ms),
+        "embedding": probe.get("embedding"),
+        "hits": 0,
+    }
+    with _lock:
+        _entries[probe["key"]] = entry
+        _entries.move_to_end(probe["key"])
+        _stats["stores"] += 1
+        while len(_entries) > PERPLEXITY_CACHE_MAX_ENTRIES:
+            _entries.popitem(last=False)
+            _stats["evictions"] += 1
+
+
+def stream_chunks(content: str) -> list:
+    """Split cached content into word-aligned chunks for ``stream_callback``."""
+    chunks, current = [], ""
+    for word in re.split(r"(?<=\s)", content):
+        current += word
+        if len(current) >= PERPLEXITY_CACHE_STREAM_CHUNK_CHARS:
+            chunks.append(current)
+            current = ""
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def clear_perplexity_cache() -> None:
+    """Drop every entry and zero the counters, so each test starts from a clean slate."""
+    with _lock:
+        _entries.clear()
+        for key in _stats:
+            _stats[key] = 0
+
+
+def perplexity_cache_stats() -> dict:
+    # Example: {"hits": 31, "near_hits": 4, "misses": 120, "saved_ms": 402000, "hit_rate": 0.226, ...}
+    with _lock:
+        stats = dict(_stats)
+        stats["entries"] = len(_entries)
+    lookups = stats["hits"] + stats["near_hits"] + stats["misses"]
+    stats["hit_rate"] = round((stats["hits"] + stats["near_hits"]) / lookups, 3) if lookups else None
+    return stats
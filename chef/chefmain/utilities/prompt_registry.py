@@ -0,0 +1,231 @@
+"""Compiled system prompts per (bot_mode, source_interface).
+
+Before example: every turn re-opened instructions_general.txt, appended the frontend
+note, and compared the whole prompt string against messages[0].
+After example:  ``get_compiled_prompt("general", "telegram", compile_fn)`` compiles once,
+returns the same interned string plus a short content hash, and recompiles only when an
+instruction file's mtime changes or ``invalidate_prompts()`` is called (SIGHUP can be
+wired to it with ``install_reload_signal()``).
+
+Sessions reference prompts instead of embedding them: ``register_prompt(compiled)`` stores the
+text once in the ``system_prompts`` collection under its content hash and returns a per
+(bot_mode, source_interface) version; chat sessions keep only ``system_prompt_hash`` and
+``system_prompt_version``. ``resolve_prompt_text(hash)`` answers from memory first.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+try:
+    from utilities.mongo_clients import get_mongo_client
+except ModuleNotFoundError:
+    # Fallback for direct script runs: import from sibling module in this folder.
+    from mongo_clients import get_mongo_client  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# How often a cached prompt re-checks its source file mtimes (0 = every call).
+PROMPT_MTIME_CHECK_SEC = float(os.getenv("PROMPT_MTIME_CHECK_SEC", "2"))
+# Example: chef_chatbot.system_prompts {"_id": "3f2a9c0d1e4b5a67", "text": "...", "bot_mode": "general",
+#          "source_interface": "telegram", "version": 4}; versions count up in system_prompts_versions.
+PROMPT_STORE_DB_NAME = os.getenv("PROMPT_STORE_DB_NAME", os.getenv("MONGODB_DB_NAME", "chef_chatbot"))
+PROMPT_STORE_COLLECTION = os.getenv("PROMPT_STORE_COLLECTION", "system_prompts")
+
+
+class CompiledPrompt:
+    __slots__ = ("text", "content_hash", "bot_mode", "source_interface", "source_mtimes", "checked_at")
+
+    def __init__(self, text, content_hash, bot_mode, source_interface, source_mtimes):
+        self.text = text
+        self.content_hash = content_hash
+        self.bot_mode = bot_mode
+        self.source_interface = source_interface
+        self.source_mtimes = source_mtimes
+        self.checked_at = time.monotonic()
+
+
+_compiled_prompts: dict = {}
+_registry_lock = threading.Lock()
+_stats = {"hits": 0, "compiles": 0, "mtime_reloads": 0, "invalidations": 0, "registered": 0, "store_reads": 0}
+# content_hash -> text / version; prompt texts are few and small, so these are never evicted.
+_prompt_texts: dict = {}
+_prompt_versions: dict = {}
+
+
+def prompt_hash(text: str) -> str:
+    """Short stable hash, e.g. "3f2a9c0d1e4b5a67"."""
+    return hashlib.sha256(str(text or "").encode("utf-8")).hexdigest()[:16]
+
+
+def _mtime(path: str):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _sources_changed(entry: CompiledPrompt) -> bool:
+    return any(_mtime(path) != mtime for path, mtime in entry.source_mtimes.items())
+
+
+def get_compiled_prompt(bot_mode, source_interface, compile_fn) -> CompiledPrompt:
+    """Return the cached prompt for (bot_mode, source_interface).
+
+    ``compile_fn(bot_mode, source_interface)`` must return ``(text, source_paths)``.
+    """
+    key = ((bot_mode or "").strip().lower(), (source_interface or "").strip().lower())
+    entry = _compiled_prompts.get(key)
+    if entry is not None:
+        now = time.monotonic()
+        if now - entry.checked_at < PROMPT_MTIME_CHECK_SEC:
+            _stats["hits"] += 1
+            return entry
+        if not _sources_changed(entry):
+            entry.checked_at = now
+            _stats["hits"] += 1
+            return entry
+        _stats["mtime_reloads"] += 1
+
+    with _registry_lock:
+        current = _compiled_prompts.get(key)
+        if current is not None and current is not entry:
+            # Another thread recompiled while we waited for the lock.
+            return current
+        text, source_paths = compile_fn(key[0] or None, key[1] or None)
+        text = sys.intern(str(text or ""))
+        compiled = CompiledPrompt(
+            text=text,
+            content_hash=prompt_hash(text),
+            bot_mode=key[0],
+            source_interface=key[1],
+            source_mtimes={path: _mtime(path) for path in (source_paths or []) if path},
+        )
+        _compiled_prompts[key] = compiled
+        _prompt_texts[compiled.content_hash] = text
+        _stats["compiles"] += 1
+        logger.info(
+            "prompt_compiled bot_mode=%s source=%s hash=%s chars=%s",
+            key[0] or "default",
+            key[1] or "none",
+            compiled.content_hash,
+            len(text),
+        )
+        return compiled
+
+
+def _get_prompt_store():
+    client = get_mongo_client()
+    if client is None:
+        return None
+    return client[PROMPT_STORE_DB_NAME][PROMPT_STORE_COLLECTION]
+
+
+def register_prompt(compiled: CompiledPrompt) -> int | None:
+    """Store ``compiled.text`` once under its hash; returns its version (None without Mongo).
+
+    Before example: every session carried the full prompt text in messages[0].
+    After example:  the first session on a new prompt writes one registry document; every later
+    call is a dict lookup.
+    """
+    content_hash = compiled.content_hash
+    _prompt_texts.setdefault(content_hash, compiled.text)
+    if content_hash in _prompt_versions:
+        return _prompt_versions[content_hash]
+    store = _get_prompt_store()
+    if store is None:
+        return None
+    doc = store.find_one({"_id": content_hash}, projection={"version": 1})
+    if doc is None:
+        try:
+            from pymongo import ReturnDocument
+            from pymongo.errors import DuplicateKeyError
+        except Exception:  # pragma: no cover - a store implies pymongo is installed
+            return None
+        sequence = store.database[f"{store.name}_versions"].find_one_and_update(
+            {"_id": f"{compiled.bot_mode or 'default'}:{compiled.source_interface or 'none'}"},
+            {"$inc": {"seq": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        doc = {
+            "_id": content_hash,
+            "text": compiled.text,
+            "bot_mode": compiled.bot_mode,
+            "source_interface": compiled.source_interface,
+            "version": sequence["seq"],
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        try:
+            store.insert_one(doc)
+            _stats["registered"] += 1
+            logger.info(
+                "prompt_registered hash=%s bot_mode=%s source=%s version=%s chars=%s",
+                content_hash,
+                compiled.bot_mode or "default",
+                compiled.source_interface or "none",
+                doc["version"],
+                len(compiled.text),
+            )
+        except DuplicateKeyError:
+            # Another instance registered the same text first; adopt its version.
+            doc = store.find_one({"_id": content_hash}, projection={"version": 1}) or doc
+    _prompt_versions[content_hash] = doc.get("version")
+    return _prompt_versions[content_hash]
+
+
+def resolve_prompt_text(content_hash: str | None) -> str | None:
+    """Prompt text for a session's ``system_prompt_hash``: memory first, then the registry."""
+    if not content_hash:
+        return None
+    text = _prompt_texts.get(content_hash)
+    if text is not None:
+        return text
+    store = _get_prompt_store()
+    if store is None:
+        return None
+    _stats["store_reads"] += 1
+    doc = store.find_one({"_id": content_hash}, projection={"text": 1, "version": 1})
+    if not doc:
+        return None
+    _prompt_texts[content_hash] = sys.intern(str(doc.get("text") or ""))
+    _prompt_versions.setdefault(content_hash, doc.get("version"))
+    return _prompt_texts[content_hash]
+
+
+def invalidate_prompts(bot_mode: str | None = None) -> int:
+    """Drop cached prompts (all, or one bot_mode); returns how many were dropped."""
+    with _registry_lock:
+        if bot_mode is None:
+            keys = list(_compiled_prompts.keys())
+        else:
+            mode = bot_mode.strip().lower()
+            keys = [key for key in _compiled_prompts if key[0] == mode]
+        for key in keys:
+            _compiled_prompts.pop(key, None)
+    _stats["invalidations"] += 1
+    logger.info("prompt_invalidated bot_mode=%s dropped=%s", bot_mode or "all", len(keys))
+    return len(keys)
+
+
+def install_reload_signal(signum=getattr(signal, "SIGHUP", None)) -> bool:
+    """Reload prompts on ``kill -HUP <pid>``; must be called from the main thread."""
+    if signum is None:
+        return False
+    try:
+        signal.signal(signum, lambda *_: invalidate_prompts())
+        return True
+    except (ValueError, OSError) as exc:
+        logger.warning("prompt_reload_signal_unavailable error=%s", exc)
+        return False
+
+
+def prompt_registry_stats() -> dict:
+    return {**_stats, "cached": len(_compiled_prompts), "known_hashes": len(_prompt_texts)}
@@ -0,0 +1,294 @@
+"""Hedging, circuit breaking, failover and request deadlines around xAI / Perplexity calls.
+
+Before example: one xAI connection stalled after the headers; ``_call_model`` sat on the 180s read
+timeout and the user's turn (and its Telegram "typing...") hung for three minutes.
+After example:  ``await call_provider("xai:grok-4", attempt, fallback=("xai:grok-3-mini", other))``
+  - hedges: when no first token arrived within the provider's recent p95 (at least
+    RESILIENCE_HEDGE_MIN_DELAY_SEC), a second identical request starts; the first one to produce a
+    token (or finish) wins and the other is cancelled, which closes its upstream stream.
+  - breaks: RESILIENCE_BREAKER_FAILURES consecutive failures open the provider's breaker for
+    RESILIENCE_BREAKER_COOLDOWN_SEC; then one half-open probe decides whether it closes again.
+  - fails over: an open breaker or a failed attempt moves on to ``fallback`` (e.g. XAI_FALLBACK_MODEL).
+  - respects deadlines: ``with request_deadline():`` at the Telegram/web entry point bounds every
+    provider call awaited inside it (contextvars follow tasks and ``asyncio.to_thread``).
+
+``attempt(on_first_token)`` returns a coroutine; streaming attempts await ``on_first_token()`` right
+before their first delta so a hedge loser never writes to the user's message. Only timeouts,
+transport errors, 429 and 5xx count as provider failures; other errors propagate untouched.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+try:  # pragma: no cover - httpx is present wherever providers are called
+    import httpx
+except Exception:  # pragma: no cover
+    httpx = None  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+RESILIENCE_REQUEST_DEADLINE_SEC = float(os.getenv("RESILIENCE_REQUEST_DEADLINE_SEC", "180"))
+RESILIENCE_HEDGE_ENABLED = os.getenv("RESILIENCE_HEDGE_ENABLED", "1").strip().lower() not in {"0", "false", "no", "off"}
+RESILIENCE_HEDGE_PERCENTILE = float(os.getenv("RESILIENCE_HEDGE_PERCENTILE", "0.95"))
+# No hedging until the provider has this many latency samples to derive a threshold from.
+RESILIENCE_HEDGE_MIN_SAMPLES = int(os.getenv("RESILIENCE_HEDGE_MIN_SAMPLES", "20"))
+RESILIENCE_HEDGE_MIN_DELAY_SEC = float(os.getenv("RESILIENCE_HEDGE_MIN_DELAY_SEC", "1.0"))
+RESILIENCE_LATENCY_WINDOW = int(os.getenv("RESILIENCE_LATENCY_WINDOW", "200"))
+RESILIENCE_BREAKER_FAILURES = max(1, int(os.getenv("RESILIENCE_BREAKER_FAILURES", "5")))
+RESILIENCE_BREAKER_COOLDOWN_SEC = float(os.getenv("RESILIENCE_BREAKER_COOLDOWN_SEC", "30"))
+
+_request_deadline = contextvars.ContextVar("request_deadline", default=None)
+_lock = threading.Lock()
+_providers: dict = {}
+_stats = {
+    "calls": 0,
+    "hedges": 0,
+    "hedge_wins": 0,
+    "failovers": 0,
+    "rejected": 0,
+    "failures": 0,
+    "deadline_exceeded": 0,
+    "breaker_opened": 0,
+}
+
+
+class ProviderUnavailable(Exception):
+    """Every provider in the chain is behind an open breaker."""
+
+
+def deadline_after(seconds: float | None) -> float | None:
+    return None if not seconds or seconds <= 0 else time.monotonic() + seconds
+
+
+def remaining(deadline: float | None) -> float | None:
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+def earliest(*deadlines) -> float | None:
+    """Example: earliest(None, t+120, t+30) -> t+30."""
+    values = [deadline for deadline in deadlines if deadline is not None]
+    return min(values) if values else None
+
+
+def current_deadline() -> float | None:
+    return _request_deadline.get()
+
+
+@contextlib.contextmanager
+def request_deadline(seconds: float | None = None):
+    """Bound everything awaited inside to ``seconds`` (default RESILIENCE_REQUEST_DEADLINE_SEC).
+
+    Nested scopes can only shorten the deadline, never extend it.
+    """
+    seconds = RESILIENCE_REQUEST_DEADLINE_SEC if seconds is None else seconds
+    deadline = earliest(_request_deadline.get(), deadline_after(seconds))
+    token = _request_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _request_deadline.reset(token)
+
+
+def is_provider_failure(exc: BaseException) -> bool:
+    """Timeouts, transport errors, 429 and 5xx; a 400 for a bad payload is the caller's problem."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    if httpx is None:
+        return False
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def _provider(name: str) -> dict:
+    entry = _providers.get(name)
+    if entry is None:
+        entry = _providers[name] = {
+            "state": "closed",
+            "failures": 0,
+            "opened_at": 0.0,
+            "probing": False,
+            "latencies": deque(maxlen=max(1, RESILIENCE_LATENCY_WINDOW)),
+        }
+    return entry
+
+
+def _admit(name: str) -> str | None:
+    """Return "closed"/"half_open" when a call may go out, None while the breaker is open."""
+    with _lock:
+        entry = _provider(name)
+        if entry["state"] == "closed":
+            return "closed"
+        if entry["state"] == "open" and time.monotonic() - entry["opened_at"] >= RESILIENCE_BREAKER_COOLDOWN_SEC:
+            entry["state"] = "half_open"
+        if entry["state"] == "half_open" and not entry["probing"]:
+            entry["probing"] = True
+            return "half_open"
+        return None
+
+
+def _record_success(name: str, latency_sec: float | None) -> None:
+    with _lock:
+        entry = _provider(name)
+        if entry["state"] != "closed":
+            logger.info("resilience_breaker_closed provider=%s", name)
+        entry.update(state="closed", failures=0, probing=False)
+        if latency_sec is not None:
+            entry["latencies"].append(latency_sec)
+
+
+def _record_failure(name: str, exc: BaseException) -> None:
+    with _lock:
+        entry = _provider(name)
+        entry["failures"] += 1
+        entry["probing"] = False
+        _stats["failures"] += 1
+        if entry["state"] == "half_open" or entry["failures"] >= RESILIENCE_BREAKER_FAILURES:
+            if entry["state"] != "open":
+                _stats["breaker_opened"] += 1
+            entry.update(state="open", opened_at=time.monotonic())
+    logger.warning("resilience_failure provider=%s error=%s", name, type(exc).__name__)
+
+
+def _release_probe(name: str) -> None:
+    with _lock:
+        _provider(name)["probing"] = False
+
+
+def _percentile(values, fraction: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def hedge_delay(name: str) -> float | None:
+    """Seconds to wait for a first token before hedging; None when hedging is off for ``name``."""
+    if not RESILIENCE_HEDGE_ENABLED:
+        return None
+    with _lock:
+        entry = _provider(name)
+        if entry["state"] != "closed" or len(entry["latencies"]) < RESILIENCE_HEDGE_MIN_SAMPLES:
+            return None
+        threshold = _percentile(entry["latencies"], RESILIENCE_HEDGE_PERCENTILE)
+    return max(RESILIENCE_HEDGE_MIN_DELAY_SEC, threshold)
+
+
+async def _run_hedged(name: str, attempt, delay: float | None):
+    started = time.monotonic()
+    state = {"winner": None, "first_at": None}
+    tasks = []
+
+    async def on_first_token():
+        me = asyncio.current_task()
+        if state["winner"] is None:
+            state["winner"] = me
+            state["first_at"] = time.monotonic()
+            for other in tasks:
+                if other is not me:
+                    other.cancel()
+        elif state["winner"] is not me:
+            raise asyncio.CancelledError()
+
+    tasks.append(asyncio.ensure_future(attempt(on_first_token)))
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and state["winner"] is None:
+                _stats["hedges"] += 1
+                logger.info("resilience_hedge provider=%s after_ms=%s", name, int(delay * 1000))
+                tasks.append(asyncio.ensure_future(attempt(on_first_token)))
+
+        pending, error = set(tasks), None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                if task.exception() is not None:
+                    error = error or task.exception()
+                    continue
+                if len(tasks) > 1 and task is tasks[1]:
+                    _stats["hedge_wins"] += 1
+                _record_success(name, (state["first_at"] or time.monotonic()) - started)
+                return task.result()
+        raise error or asyncio.CancelledError()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def call_provider(name: str, attempt, fallback: tuple | None = None, deadline: float | None = None):
+    """Await ``attempt`` for provider ``name`` with hedging and breaking; ``fallback`` is (name, attempt).
+
+    The call is bounded by the earlier of ``deadline`` and the enclosing :func:`request_deadline`.
+    Raises the last provider error (or ProviderUnavailable) when the whole chain fails.
+    """
+    _stats["calls"] += 1
+    deadline = earliest(deadline, current_deadline())
+    chain = [(name, attempt)] + ([fallback] if fallback else [])
+    last_error = None
+    for index, (provider, provider_attempt) in enumerate(chain):
+        admitted = _admit(provider)
+        if admitted is None:
+            _stats["rejected"] += 1
+            last_error = ProviderUnavailable(f"circuit open for {provider}")
+            continue
+        if index:
+            _stats["failovers"] += 1
+            logger.warning("resilience_failover from=%s to=%s", name, provider)
+        delay = hedge_delay(provider) if admitted == "closed" else None
+        try:
+            return await asyncio.wait_for(_run_hedged(provider, provider_attempt, delay), timeout=remaining(deadline))
+        except asyncio.CancelledError:
+            _release_probe(provider)
+            raise
+        except Exception as exc:
+            if not is_provider_failure(exc):
+                # The provider answered (e.g. 400); that is not an outage.
+                _record_success(provider, None)
+                raise
+            _record_failure(provider, exc)
+            last_error = exc
+            if remaining(deadline) == 0:
+                _stats["deadline_exceeded"] += 1
+                break
+    raise last_error
+
+
+def reset_resilience() -> None:
+    with _lock:
+        _providers.clear()
+        for key in _stats:
+            _stats[key] = 0
+
+
+def resilience_stats() -> dict:
+    # Example: {"hedges": 12, "hedge_wins": 7, "providers": {"xai:grok-4": {"state": "closed", "p95_ms": 2100}}}
+    with _lock:
+        stats = dict(_stats)
+        stats["providers"] = {
+            name: {
+                "state": entry["state"],
+                "failures": entry["failures"],
+                "samples": len(entry["latencies"]),
+                "p95_ms": (
+                    int(_percentile(entry["latencies"], RESILIENCE_HEDGE_PERCENTILE) * 1000)
+                    if entry["latencies"]
+                    else None
+                ),
+            }
+            for name, entry in _providers.items()
+        }
+    return stats
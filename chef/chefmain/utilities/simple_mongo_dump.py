@@ -1,9 +1,12 @@
 """Save chat sessions to MongoDB in the simplest possible way.
 
 The module exposes a single helper, :func:`save_chat_session_to_mongo`, which
-MessageRouter (or any other caller) can run after each turn. The helper reads
-whatever the on-disk history currently looks like, makes sure it has the session
-keys we expect, and replaces the corresponding document in MongoDB.
+reads whatever the on-disk history currently looks like, makes sure it has the
+session keys we expect, and replaces the corresponding document in MongoDB.
+
+Before example: history_messages called it after every appended message.
+After example:  per-turn mirroring is incremental (utilities/history_mirror.py);
+this helper is kept for one-off full resyncs of a user's session.
 
 Example document written on each call::
 
@@ -27,8 +30,6 @@ import os
 from datetime import datetime, timezone
 from typing import Any, Dict
 
-from pymongo import MongoClient
-
 try:
     # Before example: imported from chef/utilities/history_messages.py.
     # After example: imported from chefmain/utilities/history_messages.py.
@@ -36,12 +37,14 @@ try:
         add_chat_session_keys,
         get_full_history_message_object,
     )
+    from utilities.mongo_clients import get_mongo_client
 except ModuleNotFoundError:
     # Fallback for direct script runs: import from sibling module in this folder.
     from history_messages import (  # type: ignore
         add_chat_session_keys,
         get_full_history_message_object,
     )
+    from mongo_clients import get_mongo_client  # type: ignore
 
 DEFAULT_DB_NAME = "chef_chatbot"
 DEFAULT_COLLECTION_NAME = "chat_sessions"
@@ -57,7 +60,10 @@ def _get_mongo_collection():
             "MONGODB_URI is not set. Provide a mongodb+srv:// connection string."
         )
 
-    client = MongoClient(uri)
+    # Before: MongoClient(uri) per call. After: the process-wide pooled client.
+    client = get_mongo_client(uri)
+    if client is None:
+        raise RuntimeError("pymongo is not installed; cannot save the chat session to MongoDB.")
     database_name = os.environ.get("MONGODB_DB_NAME", DEFAULT_DB_NAME)
     collection_name = os.environ.get("MONGODB_COLLECTION_NAME", DEFAULT_COLLECTION_NAME)
     return client[database_name][collection_name]
@@ -0,0 +1,130 @@
+"""Delta-based streaming protocol shared by MessageRouter, Perplexity and the stream consumers.
+
+Before example: every token called ``stream_callback(full_text_so_far)`` and the SSE
+backend re-derived the delta with ``startswith`` -> O(n^2) work per answer.
+After example:  producers emit ``StreamDelta(seq=7, text=" world")``; consumers append
+deltas and join the text only when they need it (e.g. the Telegram edit preview).
+
+Rules:
+- ``seq`` starts at 1 and increases by one per delta within a turn.
+- ``reset=True`` means "drop what you have, start again from ``text``" (e.g. the model
+  wrote a preamble, then a tool answer replaced it).
+"""
+
+from __future__ import annotations
+
+import inspect
+
+
+class StreamDelta:
+    __slots__ = ("seq", "text", "reset")
+
+    def __init__(self, seq: int, text: str, reset: bool = False):
+        self.seq = seq
+        self.text = text
+        self.reset = reset
+
+    def to_dict(self) -> dict:
+        return {"seq": self.seq, "text": self.text, "reset": self.reset}
+
+    def __repr__(self) -> str:
+        return f"StreamDelta(seq={self.seq}, text={self.text!r}, reset={self.reset})"
+
+
+class DeltaEmitter:
+    """Producer side: numbers deltas and forwards them to one ``stream_callback``.
+
+    The callback may be a plain function or a coroutine function.
+    """
+
+    def __init__(self, stream_callback=None):
+        self._callback = stream_callback
+        self.seq = 0
+        self._parts = []
+        self._replace_pending = False
+
+    @property
+    def enabled(self) -> bool:
+        return callable(self._callback)
+
+    async def emit(self, text: str) -> None:
+        text = str(text or "")
+        if not text:
+            return
+        if self._replace_pending:
+            await self.reset(text)
+            return
+        self._parts.append(text)
+        await self._send(StreamDelta(self.seq + 1, text))
+
+    async def reset(self, text: str = "") -> None:
+        """Tell consumers to discard what was streamed so far (only if anything was)."""
+        self._replace_pending = False
+        if not self._parts and not text:
+            return
+        self._parts = [str(text or "")] if text else []
+        await self._send(StreamDelta(self.seq + 1, str(text or ""), reset=True))
+
+    def replace_on_next_emit(self) -> None:
+        """Keep the current text on screen until the next delta, which then replaces it.
+
+        Example: streamed tool results stay visible while the follow-up model call starts; its first
+        token arrives as ``StreamDelta(reset=True, text="Rest")`` instead of a blank message first.
+        """
+        self._replace_pending = bool(self._parts)
+
+    async def finish(self, final_text: str) -> None:
+        """Emit whatever is needed so consumers end with exactly ``final_text``.
+
+        Example: streamed "Answer" + final "Answer\\n\\nCitations: ..." -> one tail delta.
+        """
+        final_text = str(final_text or "")
+        streamed = "".join(self._parts)
+        if final_text == streamed:
+            return
+        if final_text.startswith(streamed):
+            await self.emit(final_text[len(streamed):])
+        else:
+            await self.reset(final_text)
+
+    async def _send(self, delta: StreamDelta) -> None:
+        self.seq = delta.seq
+        if not callable(self._callback):
+            return
+        result = self._callback(delta)
+        if inspect.isawaitable(result):
+            await result
+
+
+class DeltaAccumulator:
+    """Consumer side: applies deltas in seq order; ``text`` joins lazily and caches."""
+
+    def __init__(self):
+        self._parts = []
+        self._joined = ""
+        self._dirty = False
+        self.last_seq = 0
+        self.length = 0
+
+    def apply(self, delta: StreamDelta) -> bool:
+        """Apply ``delta``; returns False for stale/duplicate sequence numbers."""
+        if delta.seq <= self.last_seq:
+            return False
+        self.last_seq = delta.seq
+        if delta.reset:
+            self._parts = []
+            self.length = 0
+        if delta.text:
+            self._parts.append(delta.text)
+            self.length += len(delta.text)
+        self._dirty = True
+        return True
+
+    @property
+    def text(self) -> str:
+        if self._dirty:
+            self._joined = "".join(self._parts)
+            # Keep one part so the next join only touches new deltas.
+            self._parts = [self._joined] if self._joined else []
+            self._dirty = False
+        return self._joined
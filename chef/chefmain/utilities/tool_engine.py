@@ -0,0 +1,131 @@
+"""Concurrent execution of the tool calls in one assistant message.
+
+Before example: the model asked for three searches ("rest steak", "rest pork", "rest chicken");
+route_message logged ``using_first_call_only`` and the user had to ask twice more.
+After example:  ``run_tool_calls(tool_calls, execute, emit=emitter.emit, deadline=...)`` runs all
+three at once (at most TOOL_MAX_PARALLEL in flight) and streams them in call order: call 1 streams
+live, later calls buffer until the ones before them finish, so the single edited message reads
+like one answer joined by TOOL_OUTPUT_SEPARATOR.
+
+The router drives up to TOOL_MAX_ROUNDS rounds (tools -> follow-up model call -> tools ...)
+inside one TOOL_LOOP_DEADLINE_SEC budget; calls still running at the deadline are cancelled,
+which closes their upstream streams.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+
+try:
+    # One copy of the deadline helpers; the router's turn deadline uses the same ones.
+    from utilities.resilience import deadline_after, remaining
+except ModuleNotFoundError:
+    from resilience import deadline_after, remaining  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# 1 keeps the "tool output verbatim" behaviour: no follow-up model call after the tools run.
+TOOL_MAX_ROUNDS = max(1, int(os.getenv("TOOL_MAX_ROUNDS", "1")))
+TOOL_LOOP_DEADLINE_SEC = float(os.getenv("TOOL_LOOP_DEADLINE_SEC", "120"))
+TOOL_MAX_PARALLEL = max(1, int(os.getenv("TOOL_MAX_PARALLEL", "4")))
+TOOL_OUTPUT_SEPARATOR = "\n\n"
+
+_stats = {"rounds": 0, "calls": 0, "parallel_rounds": 0, "timeouts": 0, "errors": 0}
+
+
+def combine_tool_outputs(outputs: list) -> str:
+    return TOOL_OUTPUT_SEPARATOR.join(str(output) for output in outputs if output)
+
+
+class _OrderedStream:
+    """Forward the deltas of N concurrent calls as if they ran one after another."""
+
+    def __init__(self, count: int, emit):
+        self._count = count
+        self._emit = emit
+        self._active = 0
+        self._buffers = [[] for _ in range(count)]
+        self._streamed = [""] * count
+        self._outputs = [None] * count
+        self._lock = asyncio.Lock()
+
+    def callback(self, index: int):
+        async def on_delta(text):
+            async with self._lock:
+                if index == self._active:
+                    await self._write(index, str(text))
+                else:
+                    self._buffers[index].append(str(text))
+
+        return on_delta
+
+    async def _write(self, index: int, text: str) -> None:
+        self._streamed[index] += text
+        await self._emit(text)
+
+    async def complete(self, index: int, output: str) -> None:
+        async with self._lock:
+            self._outputs[index] = output
+            while self._active < self._count and self._outputs[self._active] is not None:
+                current = self._active
+                final, streamed = self._outputs[current], self._streamed[current]
+                # Example: citations are appended to the result after the last content token.
+                if final.startswith(streamed) and len(final) > len(streamed):
+                    await self._write(current, final[len(streamed):])
+                self._active += 1
+                if self._active < self._count and final:
+                    await self._emit(TOOL_OUTPUT_SEPARATOR)
+                if self._active < self._count:
+                    pending, self._buffers[self._active] = self._buffers[self._active], []
+                    for text in pending:
+                        await self._write(self._active, text)
+
+
+async def run_tool_calls(tool_calls: list, execute, emit=None, deadline: float | None = None) -> list:
+    """Run every call concurrently; returns one output string per call, in call order.
+
+    ``execute(tool_call, stream_callback)`` is awaited per call; ``stream_callback`` is None when
+    ``emit`` is None. Failures and deadline overruns become "Tool error" outputs, never exceptions.
+    """
+    _stats["rounds"] += 1
+    _stats["calls"] += len(tool_calls)
+    if len(tool_calls) > 1:
+        _stats["parallel_rounds"] += 1
+    stream = _OrderedStream(len(tool_calls), emit) if emit is not None else None
+    gate = asyncio.Semaphore(TOOL_MAX_PARALLEL)
+
+    async def run_one(index: int, tool_call: dict) -> str:
+        name = (tool_call.get("function") or {}).get("name")
+        started = time.monotonic()
+        try:
+            async with gate:
+                output = await asyncio.wait_for(
+                    execute(tool_call, stream.callback(index) if stream else None),
+                    timeout=remaining(deadline),
+                )
+            output = output if isinstance(output, str) else str(output)
+        except asyncio.TimeoutError:
+            _stats["timeouts"] += 1
+            output = f"Tool error: '{name}' did not finish before the deadline."
+        except Exception as exc:
+            _stats["errors"] += 1
+            output = f"Tool execution error: {exc}"
+        logger.info(
+            "tool_call_done index=%s function=%s duration_ms=%s chars=%s",
+            index,
+            name,
+            int((time.monotonic() - started) * 1000),
+            len(output),
+        )
+        if stream is not None:
+            await stream.complete(index, output)
+        return output
+
+    return list(await asyncio.gather(*(run_one(index, call) for index, call in enumerate(tool_calls))))
+
+
+def tool_engine_stats() -> dict:
+    return dict(_stats)
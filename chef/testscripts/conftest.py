@@ -0,0 +1,28 @@
+"""Shared pytest setup for chef/testscripts.
+
+Before example: a file-mode run (no MONGODB_URI) of test_message_router_streaming.py left
+test_user_streaming_history.jsonl and its .idx in chefmain/utilities/chat_history_logs.
+After example:  every test gets its own history directory under tmp_path, and scripts that route
+a message at import time (test_chunking.py, test_real_streaming.py) write to a temp directory too.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Set before collection imports anything, so history_messages picks it up as LOGS_DIR.
+os.environ.setdefault("HISTORY_LOGS_DIR", tempfile.mkdtemp(prefix="chef_history_logs_"))
+
+
+@pytest.fixture(autouse=True)
+def _isolated_history_logs(tmp_path, monkeypatch):
+    # Only patch a history_messages some test already imported; importing it here could shadow
+    # the legacy chef/utilities package that older scripts in this folder expect.
+    history_messages = sys.modules.get("utilities.history_messages")
+    if history_messages is not None and hasattr(history_messages, "LOGS_DIR"):
+        logs_dir = tmp_path / "chat_history_logs"
+        logs_dir.mkdir(exist_ok=True)
+        monkeypatch.setattr(history_messages, "LOGS_DIR", str(logs_dir))
+    yield
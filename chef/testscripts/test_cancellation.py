@@ -0,0 +1,87 @@
+"""Offline checks that /stop aborts in-flight upstream streams (utilities/cancellation.py)."""
+
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+# utilities.perplexity refuses to import without a key.
+os.environ.setdefault("PERPLEXITY_KEY", "test-key")
+
+from utilities import cancellation, http_clients, perplexity, perplexity_cache, resilience
+
+
+class StalledStream(httpx.AsyncByteStream):
+    """One token, then silence, like an upstream that stalls mid-answer."""
+
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        yield ("data: " + json.dumps({"choices": [{"delta": {"content": "Use a "}}]}) + "\n").encode()
+        await asyncio.sleep(30)
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    streams = []
+
+    def handler(request):
+        streams.append(StalledStream())
+        return httpx.Response(200, stream=streams[-1])
+
+    def build(name):
+        config = http_clients.HTTP_CLIENT_CONFIG.get(name) or {}
+        return httpx.AsyncClient(base_url=config.get("base_url", ""), transport=httpx.MockTransport(handler))
+
+    monkeypatch.setattr(http_clients, "_build_async_client", build)
+    perplexity_cache.clear_perplexity_cache()
+    resilience.reset_resilience()
+    yield streams
+    perplexity_cache.clear_perplexity_cache()
+
+
+def _search(token, on_delta=None):
+    async def scenario():
+        with cancellation.cancel_scope(token):
+            return await perplexity.search_perplexity_async("reheat pizza", stream_callback=on_delta)
+
+    return asyncio.run(scenario())
+
+
+def test_stop_from_another_thread_closes_a_stalled_stream(upstream):
+    token = cancellation.CancelToken()
+
+    def on_delta(text):
+        # Like /stop arriving on the Telegram thread while the search waits for its next line.
+        threading.Timer(0.05, token.cancel).start()
+
+    started = time.monotonic()
+    result = _search(token, on_delta)
+
+    assert time.monotonic() - started < 2
+    assert result == "Use a\n\n[Stopped by user]"
+    assert upstream[0].closed
+    assert token.release_ms is not None and token.release_ms < 1000
+    assert cancellation.cancellation_stats()["guards_cancelled"] >= 1
+
+
+def test_already_stopped_turn_sends_nothing_upstream(upstream):
+    token = cancellation.CancelToken()
+    token.cancel("stop")
+
+    assert _search(token).startswith("Stopped by user before first token.")
+    assert upstream == []
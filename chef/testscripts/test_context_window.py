@@ -0,0 +1,84 @@
+"""Offline checks for token-budgeted context windows and background summaries (uses mongomock)."""
+
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import context_window, history_messages
+
+SYSTEM = {"role": "system", "content": "You are a chef."}
+
+
+def _history(count, size=400):
+    roles = ("user", "assistant")
+    return [{"role": roles[index % 2], "content": f"{index:04d}" + "x" * size} for index in range(count)]
+
+
+def test_window_keeps_newest_turns_within_budget_and_skips_summarized_ones():
+    history = _history(40)
+    window = context_window.build_context(SYSTEM, history, message_count=100, budget=1200)
+
+    sent = window["messages"]
+    assert sent[0] == SYSTEM
+    assert sent[-1] == history[-1]
+    assert window["estimated_tokens"] <= 1200
+    # Messages 60..99 are in the tail; everything before the window is unsummarized.
+    assert window["window_start"] == 100 - (len(sent) - 1)
+    # Trimmed windows start on an aligned index so the provider-cached prefix survives a few turns.
+    assert window["window_start"] % context_window.CONTEXT_WINDOW_ALIGN == 0
+    assert window["needs_summary"] is True
+
+    summary = {"text": "Making risotto for four.", "covers": window["window_start"]}
+    with_summary = context_window.build_context(SYSTEM, history, message_count=100, summary=summary, budget=1200)
+    assert with_summary["messages"][1]["content"].endswith("Making risotto for four.")
+    assert with_summary["needs_summary"] is False
+
+    # A short session with a trusted running estimate skips the per-message pass.
+    short = context_window.build_context(SYSTEM, history[:2], message_count=2, session_tokens=10, budget=1200)
+    assert short["messages"] == [SYSTEM] + history[:2]
+    assert short["needs_summary"] is False
+
+
+def test_appends_keep_running_estimate_and_summary_is_refreshed_off_the_hot_path(monkeypatch):
+    database = mongomock.MongoClient()["chef_test"]
+    monkeypatch.setattr(history_messages, "_get_mongo_collection", lambda bot_mode: database["chat_sessions"])
+    monkeypatch.setattr(history_messages, "_get_mode_store_collection", lambda: database["bot_modes"])
+    monkeypatch.setattr(context_window, "CONTEXT_TOKEN_BUDGET", 600)
+    summarized = []
+
+    def fake_summarizer(previous, messages):
+        summarized.append([entry["content"][:4] for entry in messages])
+        return f"{previous or ''} {len(messages)} turns".strip()
+
+    monkeypatch.setattr(context_window, "summarize_with_xai", fake_summarizer)
+    history_messages._session_handles.clear()
+    history_messages.invalidate_history_cache()
+
+    message_object = {"user_id": "42", "bot_mode": "general", "user_message": "hi"}
+    for message in _history(12):
+        doc = history_messages.message_history_process(message_object, message)
+
+    stored = database["chat_sessions"].find_one({"_id": message_object["chat_session_id"]})
+    assert stored["message_count"] == 12
+    assert stored["token_estimate"] == sum(context_window.estimate_tokens(entry) for entry in stored["messages"])
+    assert doc["token_estimate"] == stored["token_estimate"]
+
+    assert history_messages.schedule_context_summary("42", doc)
+    assert context_window.wait_for_summaries(timeout=5)
+
+    stored = database["chat_sessions"].find_one({"_id": message_object["chat_session_id"]})
+    covers = stored["context_summary"]["covers"]
+    assert summarized == [[f"{index:04d}" for index in range(covers)]]
+    assert 0 < covers <= 12 - context_window.CONTEXT_MIN_RECENT_MESSAGES
+    # The next turn refetches (the summary write bumped history_version) and sends summary + tail.
+    doc = history_messages.message_history_process(message_object, {"role": "user", "content": "next"})
+    assert doc["context_summary"]["covers"] == covers
+    history_messages._session_handles.clear()
+    history_messages.invalidate_history_cache()
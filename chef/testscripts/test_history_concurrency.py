@@ -0,0 +1,78 @@
+"""Stress check: concurrent turns on one session against a real local mongod.
+
+Run with a throwaway server, e.g.:
+    docker run -d -p 27017:27017 mongo:7
+    MONGODB_TEST_URI=mongodb://localhost:27017 python -m pytest -q test_history_concurrency.py
+Skipped when no server answers; every run uses (and drops) its own database.
+"""
+
+import os
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pymongo = pytest.importorskip("pymongo")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import history_messages
+
+MONGODB_TEST_URI = os.environ.get("MONGODB_TEST_URI", "mongodb://localhost:27017")
+WORKERS = int(os.environ.get("HISTORY_STRESS_WORKERS", "8"))
+TURNS_PER_WORKER = int(os.environ.get("HISTORY_STRESS_TURNS", "25"))
+
+
+@pytest.fixture
+def live_db(monkeypatch):
+    client = pymongo.MongoClient(MONGODB_TEST_URI, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command("ping")
+    except Exception as exc:
+        pytest.skip(f"no mongod at {MONGODB_TEST_URI}: {exc}")
+    database = client[f"chef_stress_{uuid.uuid4().hex[:8]}"]
+    monkeypatch.setattr(history_messages, "_get_mongo_collection", lambda bot_mode: database["chat_sessions"])
+    monkeypatch.setattr(history_messages, "_get_mode_store_collection", lambda: database["bot_modes"])
+    history_messages._session_handles.clear()
+    history_messages.invalidate_history_cache()
+    yield database
+    history_messages._session_handles.clear()
+    history_messages.invalidate_history_cache()
+    client.drop_database(database.name)
+    client.close()
+
+
+def test_parallel_turns_never_lose_messages(live_db):
+    history_messages.set_user_active_session("42")
+    history_messages.set_user_bot_mode("42", "general")
+
+    def run_worker(worker):
+        for turn in range(TURNS_PER_WORKER):
+            message_object = {"user_id": "42", "bot_mode": "general", "user_message": f"w{worker}t{turn}"}
+            doc = history_messages.message_history_process(
+                message_object, {"role": "user", "content": f"w{worker}t{turn}"}
+            )
+            if turn % 5 == 0:
+                history_messages.update_session_system_prompt(doc, "42", f"h{worker}", worker)
+            if turn % 7 == 0:
+                # Whole-object rewrite racing the other workers' appends.
+                snapshot = history_messages.get_full_history_message_object("42", bot_mode="general")
+                snapshot["session_info"] = {"archived_by": worker}
+                history_messages.archive_message_history(snapshot, "42")
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool:
+        list(pool.map(run_worker, range(WORKERS)))
+
+    sessions = list(live_db["chat_sessions"].find({}))
+    assert len(sessions) == 1
+    messages = sessions[0]["messages"]
+    contents = [entry["content"] for entry in messages if entry.get("role") == "user"]
+    expected = {f"w{worker}t{turn}" for worker in range(WORKERS) for turn in range(TURNS_PER_WORKER)}
+    assert sorted(contents) == sorted(expected)
+    # Prompts are stored by reference, so no racing refresh may leave text in the messages array.
+    assert [entry["role"] for entry in messages].count("system") == 0
+    assert sessions[0]["system_prompt_hash"].startswith("h")
+    assert sessions[0]["session_info"]["archived_by"] in range(WORKERS)
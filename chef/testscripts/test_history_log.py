@@ -0,0 +1,108 @@
+"""Offline checks for the append-only JSONL history used when MONGODB_URI is unset."""
+
+import json
+import os
+import sys
+import time
+
+import pytest
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import history_log, history_messages
+
+
+@pytest.fixture
+def logs_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv("MONGODB_URI", raising=False)
+    monkeypatch.setattr(history_messages, "LOGS_DIR", str(tmp_path))
+    monkeypatch.setattr(history_messages, "HISTORY_TAIL_MESSAGES", 2)
+    monkeypatch.setattr(history_log, "HISTORY_FSYNC", "never")
+    return tmp_path
+
+
+def _lines(path):
+    return path.read_text().splitlines()
+
+
+def test_each_turn_appends_one_line_and_reads_the_tail(logs_dir):
+    message_object = {"user_id": "42", "bot_mode": "general", "user_message": "hi"}
+    for index in range(4):
+        doc = history_messages.message_history_process(
+            message_object, {"role": "user", "content": f"m{index}"}
+        )
+
+    log_file = logs_dir / "42_history.jsonl"
+    # Before example: the whole JSON file was rewritten per turn. After example: session line + 4 appends.
+    assert len(_lines(log_file)) == 5
+    assert [entry["content"] for entry in doc["messages"]] == ["m2", "m3"]
+    assert history_messages.get_user_bot_mode("42") == "general"
+
+    full = history_messages.get_full_history_message_object("42", bot_mode="general")
+    assert full["messages"][0]["role"] == "system"
+    assert [entry["content"] for entry in full["messages"][1:]] == ["m0", "m1", "m2", "m3"]
+
+
+def test_legacy_json_file_is_imported_once(logs_dir):
+    legacy = {
+        "user_id": "7",
+        "chat_session_id": "7_legacy",
+        "bot_mode": "cheflog",
+        "messages": [{"role": "system", "content": "sys"}, {"role": "user", "content": "old"}],
+    }
+    legacy_file = logs_dir / "7_history.json"
+    legacy_file.write_text(json.dumps(legacy, indent=2))
+    before = legacy_file.read_text()
+    imports = history_log.history_log_stats()["legacy_imports"]
+
+    data = history_messages.get_full_history_message_object("7", bot_mode="cheflog")
+    history_messages.get_full_history_message_object("7", bot_mode="cheflog")
+
+    assert data["chat_session_id"] == "7_legacy"
+    assert data["messages"] == legacy["messages"]
+    # The source (possibly a tracked file) is left as it was; the .jsonl takes over.
+    assert legacy_file.read_text() == before
+    assert history_log.history_log_stats()["legacy_imports"] == imports + 1
+
+
+def test_torn_line_is_skipped_and_compaction_drops_it(logs_dir):
+    history_log.start_session(str(logs_dir), "9", {"user_id": "9", "chat_session_id": "9_s"})
+    history_log.append_message(str(logs_dir), "9", {"role": "user", "content": "kept"})
+    log_file = logs_dir / "9_history.jsonl"
+    with open(log_file, "ab") as handle:
+        handle.write(b'{"t":"msg","m":{"role":"user","con')  # crash mid-write
+    history_log.append_message(str(logs_dir), "9", {"role": "user", "content": "after crash"})
+    history_log.update_state(str(logs_dir), "9", {"bot_mode": "general"})
+
+    contents = [m["content"] for m in history_log.load_session(str(logs_dir), "9")["messages"]]
+    assert contents == ["kept", "after crash"]
+
+    assert history_log.compact(history_log.log_path(str(logs_dir), "9"))
+    assert len(_lines(log_file)) == 3
+    data = history_log.load_session(str(logs_dir), "9", last_n=1)
+    assert data["bot_mode"] == "general"
+    assert data["messages"] == [{"role": "user", "content": "after crash"}]
+    assert data["message_count"] == 2
+
+
+def test_dead_bytes_and_age_trigger_compaction(logs_dir, monkeypatch):
+    monkeypatch.setattr(history_log, "HISTORY_COMPACT_DEAD_BYTES", 200)
+    scheduled = []
+    monkeypatch.setattr(history_log, "schedule_compaction", scheduled.append)
+    path = history_log.log_path(str(logs_dir), "5")
+    history_log.start_session(str(logs_dir), "5", {"user_id": "5", "chat_session_id": "5_s"})
+
+    # Two small mode switches: far below HISTORY_COMPACT_SET_RECORDS and the byte threshold.
+    history_log.update_state(str(logs_dir), "5", {"bot_mode": "general"})
+    history_log.update_state(str(logs_dir), "5", {"bot_mode": "cheflog"})
+    assert scheduled == []
+    # ...but an hour later the sweep picks the log up anyway.
+    history_log.sweep_stale_logs(time.monotonic() + history_log.HISTORY_COMPACT_INTERVAL_SEC)
+    assert path in scheduled
+
+    # One large prompt refresh crosses HISTORY_COMPACT_DEAD_BYTES on its own.
+    scheduled.clear()
+    history_log.update_state(str(logs_dir), "5", {"system_message": {"role": "system", "content": "x" * 300}})
+    assert scheduled == [path]
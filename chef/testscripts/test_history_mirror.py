@@ -0,0 +1,64 @@
+"""Offline checks for incremental JSONL -> Mongo history mirroring (uses mongomock)."""
+
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import history_log, history_messages, history_mirror
+
+
+@pytest.fixture
+def mirror(tmp_path, monkeypatch):
+    sessions = mongomock.MongoClient()["chef_test"]["chat_sessions"]
+    monkeypatch.setenv("MONGODB_URI", "mongodb://fake")
+    monkeypatch.setattr(history_messages, "HISTORY_BACKEND", "file")
+    monkeypatch.setattr(history_messages, "LOGS_DIR", str(tmp_path))
+    monkeypatch.setattr(history_messages, "_get_mongo_collection", lambda bot_mode: sessions)
+    monkeypatch.setattr(history_messages, "_get_mode_store_collection", lambda: None)
+    monkeypatch.setattr(history_log, "HISTORY_FSYNC", "never")
+    monkeypatch.setattr(history_mirror, "HISTORY_MIRROR_DEBOUNCE_SEC", 60.0)
+    return sessions
+
+
+def _append(role, content):
+    history_messages.message_history_process(
+        {"user_id": "42", "bot_mode": "general"}, {"role": role, "content": content}
+    )
+
+
+def test_turns_are_pushed_as_deltas_after_the_first_snapshot(mirror):
+    _append("user", "hi")
+    _append("assistant", "hello")
+    history_mirror.flush_all()
+    session_id = history_log.read_state(history_messages.LOGS_DIR, "42")["chat_session_id"]
+    doc = mirror.find_one({"_id": session_id})
+    assert [m["content"] for m in doc["messages"]] == ["", "hi", "hello"]
+    assert doc["mirror_count"] == 2
+
+    _append("user", "next")
+    # Before example: the whole session was $set again. After example: only "next" is pushed.
+    assert history_mirror.flush_user(history_messages.LOGS_DIR, "42", lambda mode: mirror) == 1
+    doc = mirror.find_one({"_id": session_id})
+    assert [m["content"] for m in doc["messages"]][-2:] == ["hello", "next"]
+    assert doc["mirror_count"] == 3
+
+
+def test_diverged_remote_is_rewritten_once(mirror):
+    _append("user", "hi")
+    history_mirror.flush_all()
+    session_id = history_log.read_state(history_messages.LOGS_DIR, "42")["chat_session_id"]
+    mirror.update_one({"_id": session_id}, {"$set": {"mirror_count": 99}})
+
+    _append("user", "again")
+    history_mirror.flush_all()
+
+    doc = mirror.find_one({"_id": session_id})
+    assert [m["content"] for m in doc["messages"]] == ["", "hi", "again"]
+    assert doc["mirror_count"] == 2
@@ -0,0 +1,228 @@
+"""Offline checks for per-turn Mongo round-trips in message_history_process (uses mongomock)."""
+
+import os
+import sys
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import history_messages, prompt_registry
+
+
+class _CountingCollection:
+    """Wraps a mongomock collection and records each method that reaches the server."""
+
+    def __init__(self, collection, calls):
+        self._collection = collection
+        self._calls = calls
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            self._calls.append(name)
+            return attr(*args, **kwargs)
+
+        return wrapper
+
+
+@pytest.fixture
+def stores(monkeypatch):
+    database = mongomock.MongoClient()["chef_test"]
+    calls = []
+    sessions = _CountingCollection(database["chat_sessions"], calls)
+    modes = _CountingCollection(database["bot_modes"], calls)
+    monkeypatch.setattr(history_messages, "_get_mongo_collection", lambda bot_mode: sessions)
+    monkeypatch.setattr(history_messages, "_get_mode_store_collection", lambda: modes)
+    monkeypatch.setattr(history_messages, "HISTORY_TAIL_MESSAGES", 3)
+    monkeypatch.setattr(history_messages, "SESSION_HANDLE_TTL_SEC", 60.0)
+    history_messages._session_handles.clear()
+    history_messages.invalidate_history_cache()
+    yield database, calls
+    history_messages._session_handles.clear()
+    history_messages.invalidate_history_cache()
+
+
+def _turn(user_message):
+    return {"user_id": "42", "bot_mode": "general", "user_message": user_message}
+
+
+def test_warm_turn_is_one_write_per_append(stores):
+    database, calls = stores
+    history_messages.message_history_process(_turn("hi"), {"role": "user", "content": "hi"})
+
+    calls.clear()
+    message_object = _turn("next")
+    doc = history_messages.message_history_process(message_object, {"role": "user", "content": "next"})
+    history_messages.message_history_process(
+        message_object, {"role": "assistant", "content": "ok"}, return_history=False
+    )
+
+    # Before example: find + find_one_and_update (mode) + find (session) + find_one_and_update per append.
+    # After example:  one conditional update_one per append and no reads once the session is warm.
+    assert calls == ["update_one", "update_one"]
+    assert [entry["content"] for entry in doc["messages"]] == ["hi", "next"]
+    stored = database["chat_sessions"].find_one({"_id": message_object["chat_session_id"]})
+    assert stored["history_version"] == 3
+    assert len(stored["messages"]) == 3
+
+
+def test_version_mismatch_refetches_the_session(stores):
+    database, calls = stores
+    message_object = _turn("hi")
+    history_messages.message_history_process(message_object, {"role": "user", "content": "hi"})
+    doc = history_messages.message_history_process(message_object, {"role": "user", "content": "again"})
+    history_messages.update_session_system_prompt(doc, "42", "abc", 1)
+    cached = history_messages._cached_session(message_object["chat_session_id"])
+    assert [entry["content"] for entry in cached["messages"]] == ["hi", "again"]
+    assert cached["doc"]["system_prompt_hash"] == "abc"
+
+    # Another instance appends to the same session behind this instance's cache.
+    database["chat_sessions"].update_one(
+        {"_id": message_object["chat_session_id"]},
+        {"$push": {"messages": {"role": "assistant", "content": "elsewhere"}}, "$inc": {"history_version": 1}},
+    )
+    calls.clear()
+    doc = history_messages.message_history_process(message_object, {"role": "user", "content": "mine"})
+
+    assert calls == ["update_one", "find_one_and_update"]
+    assert [entry["content"] for entry in doc["messages"]] == ["again", "elsewhere", "mine"]
+    assert history_messages.history_cache_stats()["conflicts"] >= 1
+
+
+def test_mode_lookups_are_served_from_the_write_through_cache(stores):
+    database, calls = stores
+    history_messages.set_user_active_session("42")
+    history_messages.set_user_bot_mode("42", "cheflog")
+
+    calls.clear()
+    # Before example: get_user_handler + message_history_process ran three find_one calls per message.
+    assert history_messages.get_user_bot_mode("42") == "cheflog"
+    assert history_messages.get_user_bot_mode("42") == "cheflog"
+    assert history_messages.get_user_active_session("42")["chat_session_id"]
+    assert calls == []
+
+    # Another instance switches the mode; its change event carries a newer mode_version.
+    remote = database["bot_modes"].find_one_and_update(
+        {"user_id": "42"}, {"$set": {"bot_mode": "dietlog"}, "$inc": {"mode_version": 1}}, return_document=True
+    )
+    history_messages._remember_mode_store_doc("42", remote)
+    history_messages._remember_mode_store_doc("42", {**remote, "bot_mode": "general", "mode_version": 1})
+    assert history_messages.get_user_bot_mode("42") == "dietlog"
+
+    history_messages.invalidate_user_mode_cache("42")
+    assert history_messages.get_user_bot_mode("42") == "dietlog"
+    assert calls == ["find_one"]
+
+
+def test_stale_archive_keeps_messages_appended_since_it_was_read(stores):
+    database, _ = stores
+    message_object = _turn("hi")
+    history_messages.message_history_process(message_object, {"role": "user", "content": "hi"})
+    snapshot = history_messages.get_full_history_message_object("42", bot_mode="general")
+
+    # A parallel turn lands after the snapshot was read.
+    history_messages.message_history_process(message_object, {"role": "user", "content": "parallel"})
+    snapshot["session_info"] = {"note": "archived"}
+    history_messages.archive_message_history(snapshot, "42")
+
+    stored = database["chat_sessions"].find_one({"_id": message_object["chat_session_id"]})
+    # Before example: the blind $set wrote the snapshot back and "parallel" vanished.
+    assert [entry["content"] for entry in stored["messages"]] == ["hi", "parallel"]
+    assert stored["session_info"] == {"note": "archived"}
+    assert stored["history_version"] == snapshot["history_version"] == 3
+
+
+def test_append_returns_only_the_tail(stores):
+    database, _ = stores
+    message_object = _turn("m0")
+    for index in range(6):
+        doc = history_messages.message_history_process(
+            message_object, {"role": "user", "content": f"m{index}"}
+        )
+    assert [entry["content"] for entry in doc["messages"]] == ["m3", "m4", "m5"]
+    assert doc["chat_session_id"] == message_object["chat_session_id"]
+    stored = database["chat_sessions"].find_one({"_id": doc["chat_session_id"]})
+    assert len(stored["messages"]) == 6
+
+
+def _register(text, content_hash):
+    return prompt_registry.register_prompt(prompt_registry.CompiledPrompt(text, content_hash, "general", "telegram", {}))
+
+
+def test_system_prompt_is_stored_by_reference(stores, monkeypatch):
+    database, _ = stores
+    monkeypatch.delenv("MONGODB_URI", raising=False)
+    message_object = _turn("hi")
+    doc = history_messages.message_history_process(message_object, {"role": "user", "content": "hi"})
+    # A session written before prompts were stored by reference.
+    database["chat_sessions"].update_one(
+        {"_id": doc["chat_session_id"]},
+        {"$push": {"messages": {"$each": [{"role": "system", "content": "old inline prompt"}], "$position": 0}}},
+    )
+
+    history_messages.update_session_system_prompt(doc, "42", "abc", 1)
+    history_messages.update_session_system_prompt(doc, "42", "def", 2)
+
+    stored = database["chat_sessions"].find_one({"_id": doc["chat_session_id"]})
+    # Before example: messages[0] carried the full prompt text. After example: only the reference.
+    assert stored["messages"] == [{"role": "user", "content": "hi"}]
+    assert (stored["system_prompt_hash"], stored["system_prompt_version"]) == ("def", 2)
+
+    _register("You are ChefBot v2", "def")
+    full = history_messages.get_full_history_message_object("42", bot_mode="general")
+    assert full["messages"][0] == {"role": "system", "content": "You are ChefBot v2"}
+
+
+def test_bucketed_appends_split_messages_and_read_the_tail(stores, monkeypatch):
+    database, _ = stores
+    monkeypatch.setattr(history_messages, "HISTORY_STORAGE", "bucketed")
+    monkeypatch.setattr(history_messages, "HISTORY_BUCKET_SIZE", 2)
+    message_object = _turn("m0")
+    for index in range(5):
+        doc = history_messages.message_history_process(
+            message_object, {"role": "user", "content": f"m{index}"}
+        )
+    session_id = message_object["chat_session_id"]
+
+    header = database["chat_sessions"].find_one({"_id": session_id})
+    assert "messages" not in header
+    assert header["message_count"] == 5
+    buckets = list(database["chat_sessions_buckets"].find({"session_id": session_id}).sort("_id", 1))
+    assert [bucket["count"] for bucket in buckets] == [2, 2, 1]
+
+    assert [entry["content"] for entry in doc["messages"]] == ["m2", "m3", "m4"]
+    tail = history_messages.get_session_messages(session_id, bot_mode="general", last_n=2)
+    assert [entry["content"] for entry in tail] == ["m3", "m4"]
+
+    _register("You are ChefBot", "abc")
+    history_messages.update_session_system_prompt(doc, "42", "abc", 1)
+    assert "system_message" not in database["chat_sessions"].find_one({"_id": session_id})
+    full = history_messages.get_full_history_message_object("42", bot_mode="general")
+    assert full["messages"][0] == {"role": "system", "content": "You are ChefBot"}
+    assert len(full["messages"]) == 6
+
+
+def test_migration_moves_inline_messages_into_buckets(stores, monkeypatch):
+    database, _ = stores
+    monkeypatch.setattr(history_messages, "HISTORY_BUCKET_SIZE", 2)
+    messages = [{"role": "system", "content": "sys"}] + [
+        {"role": "user", "content": f"m{index}"} for index in range(3)
+    ]
+    sessions = database["chat_sessions"]
+    sessions.insert_one({"_id": "s1", "user_id": "42", "messages": messages})
+
+    moved = history_messages.migrate_session_to_buckets(sessions, sessions.find_one({"_id": "s1"}))
+
+    assert moved == 3
+    header = sessions.find_one({"_id": "s1"})
+    assert header["storage"] == "bucketed"
+    assert header["system_message"] == {"role": "system", "content": "sys"}
+    assert history_messages.get_session_messages("s1", bot_mode="general") == messages
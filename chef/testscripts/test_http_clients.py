@@ -0,0 +1,76 @@
+"""Offline checks for the pooled HTTP client registry (connection reuse counters)."""
+
+import asyncio
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import http_clients
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_sync_client_reuses_one_connection():
+    server = _start_server()
+    http_clients.HTTP_CLIENT_CONFIG["local_sync"] = {"base_url": f"http://127.0.0.1:{server.server_port}"}
+    try:
+        client = http_clients.get_sync_client("local_sync")
+        assert http_clients.get_sync_client("local_sync") is client
+        for _ in range(3):
+            assert client.get("/").text == "ok"
+        stats = http_clients.get_client_stats()["local_sync"]
+        # Before example: 3 calls -> 3 TCP connects. After example: 1 connect, 2 reused.
+        assert stats["requests"] == 3
+        assert stats["new_connections"] == 1
+        assert stats["reused"] == 2
+    finally:
+        http_clients.close_sync_clients()
+        server.shutdown()
+
+
+def test_prewarm_opens_the_connection_used_by_the_first_call():
+    server = _start_server()
+    http_clients.HTTP_CLIENT_CONFIG["local_async"] = {"base_url": f"http://127.0.0.1:{server.server_port}"}
+
+    async def scenario():
+        try:
+            await http_clients.prewarm_async_clients(("local_async",))
+            response = await http_clients.get_async_client("local_async").get("/")
+            return response.text
+        finally:
+            await http_clients.close_async_clients()
+
+    try:
+        assert asyncio.run(scenario()) == "ok"
+        stats = http_clients.get_client_stats()["local_async"]
+        assert stats["prewarmed"] == 1
+        assert stats["requests"] == 2
+        assert stats["new_connections"] == 1
+    finally:
+        server.shutdown()
@@ -0,0 +1,85 @@
+"""Offline checks for the search_perplexity result cache (mocked Perplexity/Gemini transport)."""
+
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+# utilities.perplexity refuses to import without a key.
+os.environ.setdefault("PERPLEXITY_KEY", "test-key")
+
+from utilities import http_clients, perplexity, perplexity_cache
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.host)
+        if request.url.host == "generativelanguage.googleapis.com":
+            text = json.loads(request.content)["content"]["parts"][0]["text"]
+            # "reheat" questions point the same way, anything else is orthogonal.
+            values = [1.0, 0.05] if "reheat" in text else [0.0, 1.0]
+            return httpx.Response(200, json={"embedding": {"values": values}})
+        lines = [
+            "data: " + json.dumps({"choices": [{"delta": {"content": token}}], "citations": ["https://r.com/a"]})
+            for token in ("Use a ", "skillet.")
+        ]
+        return httpx.Response(200, text="\n".join(lines))
+
+    def build(name):
+        config = http_clients.HTTP_CLIENT_CONFIG.get(name) or {}
+        return httpx.AsyncClient(base_url=config.get("base_url", ""), transport=httpx.MockTransport(handler))
+
+    monkeypatch.setattr(http_clients, "_build_async_client", build)
+    perplexity_cache.clear_perplexity_cache()
+    yield requests
+    perplexity_cache.clear_perplexity_cache()
+
+
+def _search(query):
+    streamed = []
+    result = asyncio.run(perplexity.search_perplexity_async(query, stream_callback=streamed.append))
+    return result, "".join(streamed)
+
+
+def test_repeated_question_is_served_from_cache_and_still_streams(upstream):
+    first, first_streamed = _search([{"role": "user", "content": "Best way to REHEAT pizza??"}])
+    second, second_streamed = _search([{"role": "user", "content": "best way to reheat pizza"}])
+
+    assert upstream == ["api.perplexity.ai"]
+    assert second == first
+    assert second_streamed == first_streamed == "Use a skillet."
+    # Same question after a different exchange is a different key.
+    _search(
+        [
+            {"role": "user", "content": "cooking a steak"},
+            {"role": "assistant", "content": "Sear it."},
+            {"role": "user", "content": "best way to reheat pizza"},
+        ]
+    )
+    assert upstream == ["api.perplexity.ai", "api.perplexity.ai"]
+    stats = perplexity_cache.perplexity_cache_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 2
+
+
+def test_near_duplicates_match_by_embedding_when_enabled(upstream, monkeypatch):
+    monkeypatch.setattr(perplexity_cache, "PERPLEXITY_CACHE_SIMILARITY", 0.95)
+    monkeypatch.setenv("GEMINI_API_KEY", "test-key")
+
+    _search("how do I reheat pizza")
+    result, streamed = _search("pizza reheating tips")
+    _search("knife sharpening angle")
+
+    assert upstream.count("api.perplexity.ai") == 2
+    assert streamed == "Use a skillet."
+    assert perplexity_cache.perplexity_cache_stats()["near_hits"] == 1
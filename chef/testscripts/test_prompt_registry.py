@@ -0,0 +1,79 @@
+"""Offline checks for the compiled system prompt registry."""
+
+import os
+import sys
+
+import pytest
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import prompt_registry
+
+
+def _make_compile_fn(path, calls):
+    def compile_fn(bot_mode, source_interface):
+        calls.append((bot_mode, source_interface))
+        with open(path) as handle:
+            return handle.read() + f"|{source_interface}", [path]
+    return compile_fn
+
+
+def test_prompt_compiled_once_and_reloaded_on_mtime_change(tmp_path, monkeypatch):
+    monkeypatch.setattr(prompt_registry, "PROMPT_MTIME_CHECK_SEC", 0)
+    prompt_registry.invalidate_prompts()
+    path = tmp_path / "instructions.txt"
+    path.write_text("v1")
+    calls = []
+    compile_fn = _make_compile_fn(str(path), calls)
+
+    first = prompt_registry.get_compiled_prompt("general", "telegram", compile_fn)
+    second = prompt_registry.get_compiled_prompt("general", "telegram", compile_fn)
+    # Before example: two turns -> two file reads. After example: one compile, same object.
+    assert first is second
+    assert len(calls) == 1
+    assert first.text == "v1|telegram"
+
+    path.write_text("v2")
+    os.utime(path, ns=(1, first.source_mtimes[str(path)] + 1_000_000))
+    third = prompt_registry.get_compiled_prompt("general", "telegram", compile_fn)
+    assert third.text == "v2|telegram"
+    assert third.content_hash != first.content_hash
+    assert len(calls) == 2
+
+
+def test_frontends_get_separate_entries_and_invalidate_drops_them(tmp_path):
+    prompt_registry.invalidate_prompts()
+    path = tmp_path / "instructions.txt"
+    path.write_text("base")
+    calls = []
+    compile_fn = _make_compile_fn(str(path), calls)
+
+    web = prompt_registry.get_compiled_prompt("general", "web", compile_fn)
+    telegram = prompt_registry.get_compiled_prompt("general", "telegram", compile_fn)
+    assert web.content_hash != telegram.content_hash
+
+    assert prompt_registry.invalidate_prompts("general") == 2
+    prompt_registry.get_compiled_prompt("general", "web", compile_fn)
+    assert len(calls) == 3
+
+
+def test_prompts_are_registered_once_by_hash_and_resolved_from_the_store(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    store = mongomock.MongoClient()["chef_test"]["system_prompts"]
+    monkeypatch.setattr(prompt_registry, "_get_prompt_store", lambda: store)
+    monkeypatch.setattr(prompt_registry, "_prompt_texts", {})
+    monkeypatch.setattr(prompt_registry, "_prompt_versions", {})
+
+    first = prompt_registry.CompiledPrompt("v1", prompt_registry.prompt_hash("v1"), "general", "web", {})
+    second = prompt_registry.CompiledPrompt("v2", prompt_registry.prompt_hash("v2"), "general", "web", {})
+    assert prompt_registry.register_prompt(first) == 1
+    assert prompt_registry.register_prompt(second) == 2
+    assert prompt_registry.register_prompt(first) == 1
+    assert store.count_documents({}) == 2
+
+    # Another instance: nothing in memory, so the text comes from the registry collection once.
+    monkeypatch.setattr(prompt_registry, "_prompt_texts", {})
+    assert prompt_registry.resolve_prompt_text(second.content_hash) == "v2"
+    assert prompt_registry.resolve_prompt_text("missing") is None
@@ -0,0 +1,130 @@
+"""Offline checks for hedging, circuit breaking and request deadlines (utilities/resilience.py)."""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import resilience
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(resilience, "RESILIENCE_HEDGE_MIN_SAMPLES", 3)
+    monkeypatch.setattr(resilience, "RESILIENCE_HEDGE_MIN_DELAY_SEC", 0.01)
+    monkeypatch.setattr(resilience, "RESILIENCE_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(resilience, "RESILIENCE_BREAKER_COOLDOWN_SEC", 0.05)
+    resilience.reset_resilience()
+    yield
+    resilience.reset_resilience()
+
+
+def _unavailable():
+    request = httpx.Request("POST", "https://api.x.ai/v1/chat/completions")
+    return httpx.HTTPStatusError("503", request=request, response=httpx.Response(503, request=request))
+
+
+def test_slow_first_token_is_hedged_and_the_loser_never_streams():
+    streamed, cancelled = [], []
+    calls = {"count": 0}
+
+    async def attempt(on_first_token):
+        calls["count"] += 1
+        number = calls["count"]
+        try:
+            # Warm-up calls answer in ~20ms; call 4 stalls, its hedge (call 5) answers normally.
+            await asyncio.sleep(1.0 if number == 4 else 0.02)
+            await on_first_token()
+            streamed.append(number)
+            return f"answer {number}"
+        except asyncio.CancelledError:
+            cancelled.append(number)
+            raise
+
+    async def scenario():
+        for _ in range(3):
+            await resilience.call_provider("xai:test", attempt)
+        return await resilience.call_provider("xai:test", attempt)
+
+    assert asyncio.run(scenario()) == "answer 5"
+    assert streamed == [1, 2, 3, 5]
+    assert cancelled == [4]
+    stats = resilience.resilience_stats()
+    assert stats["hedges"] == 1 and stats["hedge_wins"] == 1
+
+
+def test_breaker_opens_fails_over_and_closes_after_half_open_probe():
+    primary_calls = []
+    primary_up = {"value": False}
+
+    async def primary(on_first_token):
+        primary_calls.append(1)
+        if not primary_up["value"]:
+            raise _unavailable()
+        return "primary"
+
+    async def fallback(on_first_token):
+        return "fallback"
+
+    async def scenario():
+        results = [
+            await resilience.call_provider("xai:main", primary, fallback=("xai:mini", fallback)) for _ in range(3)
+        ]
+        await asyncio.sleep(0.06)
+        primary_up["value"] = True
+        results.append(await resilience.call_provider("xai:main", primary, fallback=("xai:mini", fallback)))
+        return results
+
+    assert asyncio.run(scenario()) == ["fallback", "fallback", "fallback", "primary"]
+    # The third call skipped the open breaker without touching the primary.
+    assert len(primary_calls) == 3
+    stats = resilience.resilience_stats()
+    assert stats["rejected"] == 1 and stats["breaker_opened"] == 1
+    assert stats["providers"]["xai:main"]["state"] == "closed"
+
+
+def test_request_deadline_bounds_a_stalled_call():
+    async def stalled(on_first_token):
+        await asyncio.sleep(5)
+
+    async def scenario():
+        with resilience.request_deadline(0.05):
+            await resilience.call_provider("perplexity", stalled)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(scenario())
+    assert resilience.resilience_stats()["deadline_exceeded"] == 1
+
+
+def test_router_reports_a_deadline_as_a_timeout(monkeypatch, tmp_path):
+    from utilities import history_messages, http_clients
+
+    monkeypatch.delenv("MONGODB_URI", raising=False)
+    monkeypatch.setenv("XAI_API_KEY", "test-key")
+    monkeypatch.setattr(history_messages, "LOGS_DIR", str(tmp_path))
+
+    async def stalled(request):
+        await asyncio.sleep(5)
+
+    def build(name):
+        config = http_clients.HTTP_CLIENT_CONFIG.get(name) or {}
+        return httpx.AsyncClient(base_url=config.get("base_url", ""), transport=httpx.MockTransport(stalled))
+
+    monkeypatch.setattr(http_clients, "_build_async_client", build)
+    from message_router import MessageRouter
+
+    async def scenario():
+        with resilience.request_deadline(0.05):
+            return await MessageRouter().route_message_async(
+                message_object={"user_id": "66", "bot_mode": "general", "user_message": "hi"}
+            )
+
+    # Before example: "Error processing your message: " (str(TimeoutError()) is empty).
+    assert asyncio.run(scenario()) == "Error processing your message: request timed out"
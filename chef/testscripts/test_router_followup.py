@@ -0,0 +1,70 @@
+"""Offline check that a TOOL_MAX_ROUNDS > 1 follow-up streams natively (mocked xAI and Perplexity)."""
+
+import json
+import os
+import sys
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+# utilities.perplexity refuses to import without a key.
+os.environ.setdefault("PERPLEXITY_KEY", "test-key")
+
+from utilities import history_messages, http_clients, perplexity_cache, resilience, tool_engine
+
+
+def _sse(*deltas):
+    return "".join("data: " + json.dumps({"choices": [{"delta": delta}]}) + "\n\n" for delta in deltas) + "data: [DONE]\n\n"
+
+
+@pytest.fixture
+def upstream(monkeypatch, tmp_path):
+    monkeypatch.delenv("MONGODB_URI", raising=False)
+    monkeypatch.setenv("XAI_API_KEY", "test-key")
+    monkeypatch.setattr(history_messages, "LOGS_DIR", str(tmp_path))
+    monkeypatch.setattr(tool_engine, "TOOL_MAX_ROUNDS", 2)
+    xai_calls = []
+
+    def handler(request):
+        body = json.loads(request.content or b"{}")
+        if request.url.host == "api.perplexity.ai":
+            return httpx.Response(200, text=_sse({"content": "Rest 5 minutes."}))
+        xai_calls.append(body)
+        if any(message.get("role") == "tool" for message in body["messages"]):
+            return httpx.Response(200, text=_sse({"content": "Rest it "}, {"content": "5 minutes."}))
+        call = {"index": 0, "id": "c0", "type": "function"}
+        call["function"] = {"name": "search_perplexity", "arguments": json.dumps({"query": "steak rest"})}
+        return httpx.Response(200, text=_sse({"tool_calls": [call]}))
+
+    def build(name):
+        config = http_clients.HTTP_CLIENT_CONFIG.get(name) or {}
+        return httpx.AsyncClient(base_url=config.get("base_url", ""), transport=httpx.MockTransport(handler))
+
+    monkeypatch.setattr(http_clients, "_build_async_client", build)
+    perplexity_cache.clear_perplexity_cache()
+    resilience.reset_resilience()
+    yield xai_calls
+    perplexity_cache.clear_perplexity_cache()
+
+
+def test_followup_round_streams_once_and_replaces_the_tool_output(upstream):
+    from message_router import MessageRouter
+
+    deltas = []
+    message_object = {"user_id": "88", "bot_mode": "general", "source_interface": "web", "user_message": "steak?"}
+    result = MessageRouter().route_message(
+        message_object=message_object, stream=True, stream_callback=lambda delta: deltas.append(delta.to_dict())
+    )
+
+    assert result == "Rest it 5 minutes."
+    assert [call.get("stream") for call in upstream] == [True, True]
+    follow_up = [delta for delta in deltas if delta["text"] in ("Rest it ", "5 minutes.")]
+    # Before example: the finished follow-up was replayed word by word after streaming. After example:
+    # its two upstream deltas arrive once, the first one replacing the search results on screen.
+    assert [(delta["text"], delta["reset"]) for delta in follow_up] == [("Rest it ", True), ("5 minutes.", False)]
+    assert deltas[-1] == follow_up[-1]
@@ -0,0 +1,61 @@
+"""Offline checks for the xAI payloads route_message builds (mocked transport, file-mode history)."""
+
+import json
+import os
+import sys
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import history_messages, http_clients
+
+
+@pytest.fixture
+def router(monkeypatch, tmp_path):
+    monkeypatch.delenv("MONGODB_URI", raising=False)
+    monkeypatch.setenv("XAI_API_KEY", "test-key")
+    monkeypatch.setattr(history_messages, "LOGS_DIR", str(tmp_path))
+    payloads = []
+
+    def handler(request):
+        body = json.loads(request.content or b"{}")
+        payloads.append(body)
+        usage = {"prompt_tokens": 100, "completion_tokens": 3, "prompt_tokens_details": {"cached_tokens": 64}}
+        return httpx.Response(200, json={"choices": [{"message": {"content": "Sure."}}], "usage": usage})
+
+    def build(name):
+        config = http_clients.HTTP_CLIENT_CONFIG.get(name) or {}
+        return httpx.AsyncClient(base_url=config.get("base_url", ""), transport=httpx.MockTransport(handler))
+
+    monkeypatch.setattr(http_clients, "_build_async_client", build)
+    import message_router
+
+    monkeypatch.setattr(message_router, "_prompt_cache_stats", {})
+    return message_router, message_router.MessageRouter(), payloads
+
+
+def _turn(text):
+    return {"user_id": "77", "bot_mode": "general", "source_interface": "web", "user_message": text}
+
+
+def test_payload_prefix_is_stable_and_cached_tokens_are_recorded(router):
+    message_router, instance, payloads = router
+    instance.route_message(message_object=_turn("how long to rest steak?"))
+    instance.route_message(message_object=_turn("and for pork?"))
+
+    first, second = (payload["messages"] for payload in payloads)
+    # The frontend note rides at the end; everything before it is a prefix of the next turn.
+    assert first[-1]["role"] == "system" and "Web UI" in first[-1]["content"]
+    assert "Frontend context" not in first[0]["content"]
+    assert second[: len(first) - 1] == first[:-1]
+    assert [entry["role"] for entry in second[len(first) - 1:]] == ["assistant", "user", "system"]
+
+    stats = message_router.prompt_cache_stats()["general"]
+    assert stats["calls"] == 2
+    assert stats["cached_tokens"] == 128
+    assert stats["cache_hit_ratio"] == 0.64
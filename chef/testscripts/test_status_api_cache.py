@@ -0,0 +1,120 @@
+"""Offline checks for the cached /latest_status endpoint (ETag, TTL cache, long-poll)."""
+
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+pytest.importorskip("flask")
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+import status_api
+
+HEADERS = {"x-api-key": "secret"}
+
+
+@pytest.fixture
+def status_collection(monkeypatch):
+    collection = mongomock.MongoClient()["chef_test"]["user_recipe_status"]
+    finds = []
+    original_find_one = collection.find_one
+
+    def counting_find_one(*args, **kwargs):
+        finds.append(args)
+        return original_find_one(*args, **kwargs)
+
+    monkeypatch.setattr(collection, "find_one", counting_find_one)
+    monkeypatch.setattr(status_api, "_get_status_collection", lambda: collection)
+    monkeypatch.setattr(status_api, "API_KEY", "secret")
+    monkeypatch.setattr(status_api, "MONGODB_URI", "mongodb://fake")
+    monkeypatch.setattr(status_api, "STATUS_CHANGE_STREAM_ENABLED", False)
+    monkeypatch.setattr(status_api, "STATUS_CACHE_TTL_SEC", 60.0)
+    monkeypatch.setitem(status_api._watcher_state, "running", False)
+    status_api._status_cache.clear()
+    collection.insert_one({"user_id": "123", "latest_step": "whisk eggs", "updated_at": datetime.now(timezone.utc)})
+    return collection, finds
+
+
+def test_repeat_polls_hit_the_cache_and_return_304(status_collection):
+    _, finds = status_collection
+    client = status_api.app.test_client()
+
+    first = client.get("/latest_status?user_id=123", headers=HEADERS)
+    assert first.status_code == 200
+    assert first.get_json()["latest_step"] == "whisk eggs"
+    etag = first.headers["ETag"]
+
+    second = client.get("/latest_status?user_id=123", headers={**HEADERS, "If-None-Match": etag})
+    # Before example: every poll ran find_one. After example: one read, then 304 from memory.
+    assert second.status_code == 304
+    assert second.headers["ETag"] == etag
+    assert len(finds) == 1
+
+
+def test_long_poll_wakes_when_the_step_changes(status_collection, monkeypatch):
+    collection, _ = status_collection
+    monkeypatch.setitem(status_api._watcher_state, "running", True)  # as if a change stream were live
+    client = status_api.app.test_client()
+    etag = client.get("/latest_status?user_id=123", headers=HEADERS).headers["ETag"]
+
+    def change_step():
+        time.sleep(0.2)
+        collection.insert_one(
+            {"user_id": "123", "latest_step": "fold in flour", "updated_at": datetime.now(timezone.utc)}
+        )
+        status_api.invalidate_status("123")  # what the change stream watcher does per event
+
+    threading.Thread(target=change_step).start()
+    started = time.monotonic()
+    response = client.get("/latest_status?user_id=123&wait=5", headers={**HEADERS, "If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.get_json()["latest_step"] == "fold in flour"
+    assert response.headers["ETag"] != etag
+    assert time.monotonic() - started < 4
+
+
+def test_long_poll_times_out_with_304(status_collection):
+    client = status_api.app.test_client()
+    etag = client.get("/latest_status?user_id=123", headers=HEADERS).headers["ETag"]
+    response = client.get("/latest_status?user_id=123&wait=0.3", headers={**HEADERS, "If-None-Match": etag})
+    assert response.status_code == 304
+
+
+def test_invalidation_during_a_miss_is_not_overwritten_by_the_stale_read(status_collection, monkeypatch):
+    collection, _ = status_collection
+    original_fetch = status_api._fetch_latest_status
+    calls = []
+
+    def racing_fetch(user_id):
+        payload = original_fetch(user_id)
+        if not calls:
+            # The change stream event arrives after find_one returned but before the cache write.
+            later = datetime.now(timezone.utc) + timedelta(seconds=1)
+            collection.insert_one({"user_id": "123", "latest_step": "fold in flour", "updated_at": later})
+            status_api.invalidate_status("123")
+        calls.append(payload["latest_step"])
+        return payload
+
+    monkeypatch.setattr(status_api, "_fetch_latest_status", racing_fetch)
+    payload, _ = status_api.get_latest_status("123")
+
+    assert calls == ["whisk eggs", "fold in flour"]
+    assert payload["latest_step"] == "fold in flour"
+    assert status_api._status_cache["123"]["payload"]["latest_step"] == "fold in flour"
+
+
+def test_cache_is_bounded_and_evicts_the_least_recently_used(status_collection, monkeypatch):
+    monkeypatch.setattr(status_api, "STATUS_CACHE_MAX_ENTRIES", 2)
+    for user_id in ("123", "a", "123", "b"):
+        status_api.get_latest_status(user_id)
+
+    # "123" was touched again after "a", so "a" is the one that goes.
+    assert list(status_api._status_cache) == ["123", "b"]
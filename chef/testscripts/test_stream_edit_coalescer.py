@@ -0,0 +1,79 @@
+"""Offline checks for the adaptive Telegram stream edit coalescer."""
+
+import asyncio
+import os
+import sys
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+import stream_edit_coalescer
+from stream_edit_coalescer import StreamEditCoalescer, edit_interval_for
+
+
+def test_interval_grows_with_length_and_recent_429s():
+    short = edit_interval_for(50)
+    long = edit_interval_for(3000)
+    throttled = edit_interval_for(50, recent_429s=2)
+    assert short < long
+    assert short < throttled
+    assert edit_interval_for(100000, recent_429s=10) == stream_edit_coalescer.STREAM_EDIT_MAX_INTERVAL_SEC
+
+
+def test_token_burst_becomes_few_edits_and_final_is_flushed():
+    async def scenario():
+        sent = []
+
+        async def send_edit(text):
+            sent.append(text)
+
+        coalescer = StreamEditCoalescer("chat-a", send_edit, rate_limit_probe=lambda chat_id: 0)
+        coalescer.start()
+        text = ""
+        # Before example: 200 tokens -> up to one edit per token window.
+        # After example:  the first token shows right away, the rest fold into the final flush.
+        for index in range(200):
+            text += f"w{index} "
+            coalescer.update(text)
+            await asyncio.sleep(0)
+        await asyncio.sleep(0.05)
+        await coalescer.finish(text.strip())
+        return sent, coalescer.stats
+
+    sent, stats = asyncio.run(scenario())
+    assert sent[0] == "w0 "
+    assert sent[-1].endswith("w199")
+    assert len(sent) <= 3
+    assert stats["first_edit_ms"] is not None
+
+
+def test_finish_skips_noop_final_edit():
+    async def scenario():
+        sent = []
+
+        async def send_edit(text):
+            sent.append(text)
+
+        coalescer = StreamEditCoalescer("chat-b", send_edit, rate_limit_probe=lambda chat_id: 0)
+        coalescer.start()
+        coalescer.update("done")
+        await asyncio.sleep(0.02)
+        await coalescer.finish("done")
+        return sent, coalescer.stats
+
+    sent, stats = asyncio.run(scenario())
+    assert sent == ["done"]
+    assert stats["skipped_noop"] == 1
+
+
+def test_edit_budgets_are_bounded_per_chat(monkeypatch):
+    monkeypatch.setattr(stream_edit_coalescer, "STREAM_EDIT_BUDGET_MAX_CHATS", 2)
+    monkeypatch.setattr(stream_edit_coalescer, "_chat_edit_budgets", stream_edit_coalescer.OrderedDict())
+    first = stream_edit_coalescer._edit_budget(1)
+    stream_edit_coalescer._edit_budget(2)
+    assert stream_edit_coalescer._edit_budget(1) is first  # chat 1 is now the most recent
+    stream_edit_coalescer._edit_budget(3)
+
+    # Before example: one bucket per chat forever. After example: the least recently streamed chat goes.
+    assert list(stream_edit_coalescer._chat_edit_budgets) == [1, 3]
@@ -0,0 +1,67 @@
+"""Offline checks for the seq-numbered delta streaming protocol."""
+
+import asyncio
+import os
+import sys
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities.stream_protocol import DeltaAccumulator, DeltaEmitter, StreamDelta
+
+
+def _collect(scenario):
+    seen = []
+    asyncio.run(scenario(DeltaEmitter(seen.append)))
+    return seen
+
+
+def test_emitter_numbers_deltas_and_sends_only_the_tail_on_finish():
+    async def scenario(emitter):
+        await emitter.emit("Search ")
+        await emitter.emit("result")
+        await emitter.finish("Search result\n\nCitations:\n[1] https://r.com/a\n")
+
+    seen = _collect(scenario)
+    assert [delta.seq for delta in seen] == [1, 2, 3]
+    assert [delta.text for delta in seen] == ["Search ", "result", "\n\nCitations:\n[1] https://r.com/a\n"]
+    assert not any(delta.reset for delta in seen)
+
+
+def test_finish_resets_when_final_text_is_not_an_extension():
+    async def scenario(emitter):
+        await emitter.emit("Let me search")
+        await emitter.finish("Tool answer")
+
+    seen = _collect(scenario)
+    assert seen[-1].reset is True
+    assert seen[-1].text == "Tool answer"
+
+
+def test_follow_up_stream_replaces_tool_results_on_its_first_token():
+    async def scenario(emitter):
+        await emitter.emit("Search result")
+        emitter.replace_on_next_emit()
+        await emitter.emit("Rest ")
+        await emitter.emit("it 5 minutes.")
+        await emitter.finish("Rest it 5 minutes.")
+
+    seen = _collect(scenario)
+    assert [(delta.text, delta.reset) for delta in seen] == [
+        ("Search result", False),
+        ("Rest ", True),
+        ("it 5 minutes.", False),
+    ]
+
+
+def test_accumulator_rebuilds_text_and_ignores_stale_seq():
+    accumulator = DeltaAccumulator()
+    assert accumulator.apply(StreamDelta(1, "Hel"))
+    assert accumulator.apply(StreamDelta(2, "lo"))
+    assert accumulator.text == "Hello"
+    # Before example: a replayed delta doubled the text. After example: it is dropped.
+    assert not accumulator.apply(StreamDelta(2, "lo"))
+    assert accumulator.apply(StreamDelta(3, "Fresh", reset=True))
+    assert accumulator.text == "Fresh"
+    assert accumulator.length == 5
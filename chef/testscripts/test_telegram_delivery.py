@@ -0,0 +1,101 @@
+"""Offline checks for the rate-limit-aware Telegram delivery queue."""
+
+import asyncio
+import os
+import sys
+import time
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+import telegram_delivery
+from telegram_delivery import TelegramDeliveryQueue, TokenBucket
+
+
+def test_token_bucket_reservations_space_out_bursts():
+    bucket = TokenBucket(rate_per_sec=1.0, capacity=1.0)
+    now = bucket.updated_at
+    assert bucket.reserve(now) == 0.0
+    assert abs(bucket.reserve(now) - 1.0) < 1e-6
+    assert abs(bucket.reserve(now) - 2.0) < 1e-6
+    # Three seconds later the backlog has drained but no extra burst was banked.
+    assert bucket.reserve(now + 3.0) == 0.0
+    assert abs(bucket.reserve(now + 3.0) - 1.0) < 1e-6
+
+
+def _fake_queue(responses, calls):
+    queue = TelegramDeliveryQueue(per_chat_rate=1000.0, per_chat_burst=1000.0, global_rate=1000.0)
+
+    async def fake_post(item):
+        calls.append((item["method"], dict(item["payload"])))
+        await asyncio.sleep(0.05)
+        return responses.pop(0) if responses else ({"ok": True, "result": {"message_id": 1}}, None)
+
+    queue._post = fake_post
+    return queue
+
+
+def test_pending_sends_for_one_chat_are_merged():
+    calls = []
+    queue = _fake_queue([], calls)
+    # Before example: three short replies -> three sendMessage calls.
+    # After example:  parts still waiting in the queue share one call.
+    futures = [queue.submit("sendMessage", 7, {"chat_id": 7, "text": f"part {i}"}, "tok") for i in range(3)]
+    results = [future.result(timeout=5) for future in futures]
+
+    assert all(result["ok"] for result in results)
+    assert "\n\n".join(payload["text"] for _, payload in calls) == "part 0\n\npart 1\n\npart 2"
+    assert len(calls) < 3
+    assert queue.snapshot()["merged_sends"] == 3 - len(calls)
+    assert queue.snapshot()["queue_depth"] == 0
+
+
+def test_pending_edits_keep_only_latest_text():
+    calls = []
+    queue = _fake_queue([], calls)
+    futures = [
+        queue.submit("editMessageText", 7, {"chat_id": 7, "message_id": 5, "text": text}, "tok")
+        for text in ("a", "ab", "abc")
+    ]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert calls[-1][1]["text"] == "abc"
+    assert len(calls) < 3
+
+
+def test_retry_after_is_honored_before_resending():
+    calls = []
+    rate_limited = {"ok": False, "error_code": 429, "parameters": {"retry_after": 0.2}}
+    queue = _fake_queue([(rate_limited, 0.2)], calls)
+
+    result = queue.submit("sendMessage", 9, {"chat_id": 9, "text": "hi"}, "tok").result(timeout=5)
+
+    assert result["ok"] is True
+    assert len(calls) == 2
+    snapshot = queue.snapshot()
+    assert snapshot["rate_limited"] == 1
+    assert snapshot["max_delay_ms"] >= 200
+    assert queue.recent_rate_limits(9) == 1
+    # Once the 429 is older than RATE_LIMIT_MEMORY_SEC the chat's entry goes away.
+    queue._prune_rate_limits(time.monotonic() + telegram_delivery.RATE_LIMIT_MEMORY_SEC + 1)
+    assert 9 not in queue._rate_limit_events
+
+
+def test_status_send_is_never_merged_with_a_queued_reply():
+    calls = []
+    replies = [({"ok": True, "result": {"message_id": number}}, None) for number in (101, 102, 103)]
+    queue = _fake_queue(replies, calls)
+    # A reminder is still waiting on the chat bucket when the stream posts its "Thinking..." line.
+    reminder = queue.submit("sendMessage", 7, {"chat_id": 7, "text": "Check the oven"}, "tok")
+    status = queue.submit("sendMessage", 7, {"chat_id": 7, "text": "Thinking..."}, "tok", mergeable=False)
+    late = queue.submit("sendMessage", 7, {"chat_id": 7, "text": "Timer done"}, "tok")
+
+    reminder_id = reminder.result(timeout=5)["result"]["message_id"]
+    status_id = status.result(timeout=5)["result"]["message_id"]
+    late_id = late.result(timeout=5)["result"]["message_id"]
+
+    # Before example: both texts went out as one message and stream edits overwrote the reminder.
+    assert reminder_id != status_id and late_id != status_id
+    assert [payload["text"] for _, payload in calls] == ["Check the oven", "Thinking...", "Timer done"]
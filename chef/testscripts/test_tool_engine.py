@@ -0,0 +1,55 @@
+"""Offline checks for concurrent tool execution and ordered streaming (utilities/tool_engine.py)."""
+
+import asyncio
+import os
+import sys
+import time
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from utilities import tool_engine
+
+
+def _call(query):
+    return {"id": query, "function": {"name": "search_perplexity", "arguments": f'{{"query": "{query}"}}'}}
+
+
+def test_calls_run_concurrently_and_stream_in_call_order():
+    emitted = []
+
+    async def emit(text):
+        emitted.append(text)
+
+    async def execute(tool_call, stream_callback):
+        query = tool_call["id"]
+        # The second call finishes first; its deltas must still come after the first call's.
+        await asyncio.sleep(0.05 if query == "steak" else 0.01)
+        for token in (query, " rest"):
+            await stream_callback(token)
+        return f"{query} rest\n[1] https://example.com/{query}"
+
+    started = time.monotonic()
+    outputs = asyncio.run(
+        tool_engine.run_tool_calls([_call("steak"), _call("pork")], execute, emit=emit, deadline=None)
+    )
+
+    assert time.monotonic() - started < 0.09
+    assert outputs == ["steak rest\n[1] https://example.com/steak", "pork rest\n[1] https://example.com/pork"]
+    assert "".join(emitted) == tool_engine.combine_tool_outputs(outputs)
+
+
+def test_calls_past_the_deadline_become_tool_errors():
+    async def execute(tool_call, stream_callback):
+        await asyncio.sleep(0.5 if tool_call["id"] == "slow" else 0)
+        return "fast answer"
+
+    outputs = asyncio.run(
+        tool_engine.run_tool_calls(
+            [_call("fast"), _call("slow")], execute, deadline=tool_engine.deadline_after(0.05)
+        )
+    )
+
+    assert outputs[0] == "fast answer"
+    assert outputs[1].startswith("Tool error:")
@@ -0,0 +1,146 @@
+"""Offline checks for the per-user turn scheduler used by telegram_bot.handle_message."""
+
+import asyncio
+import os
+import sys
+
+CHEFMAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "chefmain")
+if CHEFMAIN_DIR not in sys.path:
+    sys.path.insert(0, CHEFMAIN_DIR)
+
+from turn_scheduler import TurnScheduler
+
+
+def test_same_user_turns_run_in_arrival_order():
+    async def scenario():
+        scheduler = TurnScheduler(max_concurrent_turns=4)
+        events = []
+
+        def make_turn(label, delay):
+            async def turn():
+                events.append(f"start:{label}")
+                await asyncio.sleep(delay)
+                events.append(f"end:{label}")
+                return label
+            return turn
+
+        # Before example: the short second turn could finish before the long first one.
+        # After example:  the second turn starts only after the first ends.
+        results = await asyncio.gather(
+            scheduler.submit_turn("u1", make_turn("first", 0.05)),
+            scheduler.submit_turn("u1", make_turn("second", 0.0)),
+        )
+        return results, events
+
+    results, events = asyncio.run(scenario())
+    assert results == ["first", "second"]
+    assert events == ["start:first", "end:first", "start:second", "end:second"]
+
+
+def test_different_users_run_in_parallel_up_to_limit():
+    async def scenario():
+        scheduler = TurnScheduler(max_concurrent_turns=2)
+        running = {"now": 0, "peak": 0}
+
+        async def turn():
+            running["now"] += 1
+            running["peak"] = max(running["peak"], running["now"])
+            await asyncio.sleep(0.02)
+            running["now"] -= 1
+
+        await asyncio.gather(*(scheduler.submit_turn(f"u{i}", turn) for i in range(5)))
+        return running["peak"]
+
+    assert asyncio.run(scenario()) == 2
+
+
+def test_control_runs_during_turn_and_ahead_of_queued_turns():
+    async def scenario():
+        scheduler = TurnScheduler(max_concurrent_turns=1)
+        events = []
+        first_started = asyncio.Event()
+        release_first = asyncio.Event()
+
+        async def long_turn():
+            events.append("turn:long")
+            first_started.set()
+            await release_first.wait()
+
+        async def queued_turn():
+            events.append("turn:queued")
+
+        async def stop_command():
+            events.append("control:stop")
+            release_first.set()
+
+        long_task = asyncio.create_task(scheduler.submit_turn("u1", long_turn))
+        await first_started.wait()
+        queued_task = asyncio.create_task(scheduler.submit_turn("u1", queued_turn))
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth("u1") == 1
+        await scheduler.submit_control("u1", stop_command)
+        await asyncio.gather(long_task, queued_task)
+        return events, scheduler.queue_depth()
+
+    events, depth = asyncio.run(scenario())
+    assert events == ["turn:long", "control:stop", "turn:queued"]
+    assert depth == 0
+
+
+def test_failed_turn_does_not_block_next_turn():
+    async def scenario():
+        scheduler = TurnScheduler()
+
+        async def failing():
+            raise RuntimeError("boom")
+
+        async def ok():
+            return "ok"
+
+        first = asyncio.create_task(scheduler.submit_turn("u1", failing))
+        second = asyncio.create_task(scheduler.submit_turn("u1", ok))
+        results = await asyncio.gather(first, second, return_exceptions=True)
+        return results
+
+    first, second = asyncio.run(scenario())
+    assert isinstance(first, RuntimeError)
+    assert second == "ok"
+
+
+def test_burst_from_one_user_does_not_delay_stop_or_other_users():
+    async def scenario():
+        scheduler = TurnScheduler(max_concurrent_turns=4)
+        # Stands in for python-telegram-bot's concurrent_updates(4) update processor.
+        update_slots = asyncio.Semaphore(4)
+        release = asyncio.Event()
+        events = []
+
+        async def dispatch(handler):
+            async with update_slots:
+                return await handler()
+
+        async def handle_message(user_id, turn):
+            # Mirrors telegram_bot.handle_message: enqueue and give the update slot back.
+            return scheduler.enqueue_turn(user_id, turn)
+
+        async def stuck_turn():
+            await release.wait()
+
+        async def other_user_turn():
+            events.append("u2:turn")
+
+        async def stop_command():
+            events.append("u1:stop")
+            release.set()
+
+        burst = [await dispatch(lambda: handle_message("u1", stuck_turn)) for _ in range(10)]
+        await asyncio.sleep(0)
+        assert scheduler.queue_depth("u1") == 9
+
+        other = await asyncio.wait_for(dispatch(lambda: handle_message("u2", other_user_turn)), 0.5)
+        await asyncio.wait_for(other, 0.5)
+        await asyncio.wait_for(dispatch(lambda: scheduler.submit_control("u1", stop_command)), 0.5)
+        await asyncio.wait_for(asyncio.gather(*burst), 1)
+        return events
+
+    assert asyncio.run(scenario()) == ["u2:turn", "u1:stop"]
@@ -203,7 +203,7 @@ function handleEvent(
       setState(prev => ({
         ...prev,
         phase: 'answering',
-        content: prev.content + (data.text || ''),
+        content: (data.reset ? '' : prev.content) + (data.text || ''),
       }));
       break;
     case 'done':
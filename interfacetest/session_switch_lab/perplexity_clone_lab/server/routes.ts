@@ -113,9 +113,9 @@ export async function registerRoutes(
           botMode: "general",
         },
         {
-          onContent: (delta: string) => {
-            if (delta) {
-              sendEvent("content", { text: delta });
+          onContent: (delta: string, meta) => {
+            if (delta || meta.reset) {
+              sendEvent("content", { text: delta, seq: meta.seq, reset: meta.reset });
             }
           },
         },
@@ -18,8 +18,14 @@ interface CallSharedBackendResult {
   botMode: string;
 }
 
+interface ContentDeltaMeta {
+  seq: number;
+  reset: boolean;
+}
+
 interface StreamHandlers {
-  onContent?: (delta: string) => void;
+  // reset=true means drop the text streamed so far and continue from this delta.
+  onContent?: (delta: string, meta: ContentDeltaMeta) => void;
 }
 
 function resolveSharedBackendUrl(): string {
@@ -98,6 +104,7 @@ export async function streamSharedBackend(
   let buffer = "";
   let eventType = "";
   let donePayload: any = null;
+  let lastSeq = 0;
 
   const processBlock = (block: string) => {
     const lines = block.split("\n");
@@ -118,8 +125,13 @@ export async function streamSharedBackend(
       return;
     }
     if (eventType === "content") {
+      const seq = Number(data?.seq || 0);
+      // Skip replayed/out-of-order deltas; older backends send no seq at all.
+      if (seq && seq <= lastSeq) return;
+      if (seq) lastSeq = seq;
       const delta = String(data?.text || "");
-      if (delta) handlers.onContent?.(delta);
+      const reset = Boolean(data?.reset);
+      if (delta || reset) handlers.onContent?.(delta, { seq, reset });
     } else if (eventType === "done") {
       donePayload = data;
     } else if (eventType === "error") {